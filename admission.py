@@ -0,0 +1,71 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class AdmissionError(Exception):
+    # Raised when image work cannot be admitted. status is the HTTP status
+    # to answer with; retry_after is in seconds, or None if retrying won't help.
+
+    def __init__(self, message, status, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def bytes_per_pixel(mode):
+    # Pillow keeps every multi-band mode in 4 bytes per pixel
+    return 1 if mode in ('1', 'L', 'P') else 4
+
+
+def estimate_cost(width, height, mode=None, copies=3):
+    # Decoded pixel memory for an operation that holds `copies` full-size
+    # images at once (decoded source, transposed/rotated copy, result).
+    # Unknown modes are charged as 4 bytes per pixel.
+    return width * height * bytes_per_pixel(mode) * copies
+
+
+class PixelBudget:
+    # Per-process cap on decoded pixel memory. Work that does not fit waits
+    # up to max_wait seconds for running work to finish, then is turned away
+    # with a 429. Work larger than the whole budget is refused with a 503.
+
+    def __init__(self, budget_bytes, max_wait):
+        self.budget_bytes = budget_bytes
+        self.max_wait = max_wait
+        self.in_use = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, cost, max_wait=None):
+        # Blocks until cost fits in the budget. max_wait overrides the
+        # default wait, for callers such as background jobs that can wait longer.
+        self.check(cost)
+
+        max_wait = self.max_wait if max_wait is None else max_wait
+        deadline = time.monotonic() + max_wait
+        with self._condition:
+            while self.in_use + cost > self.budget_bytes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise AdmissionError('The server is busy with other images, please try again shortly',
+                                         429, retry_after=max(1, round(max_wait)))
+                self._condition.wait(remaining)
+            self.in_use += cost
+
+    def check(self, cost):
+        # For work queued to run later: refused now if it could never fit
+        if cost > self.budget_bytes:
+            raise AdmissionError('This image is too large to process on this server', 503)
+
+    def release(self, cost):
+        with self._condition:
+            self.in_use -= cost
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, cost, max_wait=None):
+        self.acquire(cost, max_wait)
+        try:
+            yield
+        finally:
+            self.release(cost)
@@ -0,0 +1,197 @@
+import io
+import multiprocessing
+import os
+import re
+import tempfile
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from PIL import Image, ImageOps
+
+from imaging import CropError, OUTPUT_EXTENSIONS, check_output_size, encode_image, export_sizes, parse_aspect, source_metadata
+
+
+def parse_batch_spec(data, max_pixels):
+    # One crop applied to every picture in a batch:
+    #   {"mode": "aspect", "aspect": "16:9"}             largest centred box
+    #   {"mode": "resolution", "width": 1080, "height": 1080}
+    #   {"mode": "relative", "x": 0.1, "y": 0.1, "width": 0.5, "height": 0.5}
+    mode = data.get('mode')
+    if mode not in ('aspect', 'resolution', 'relative'):
+        raise CropError('Batch mode must be aspect, resolution or relative')
+    # Checked here, so a bad spec is one 400 rather than an error per picture
+    if mode == 'aspect':
+        return {'mode': mode, 'aspect': parse_aspect(data.get('aspect'))}
+    try:
+        if mode == 'resolution':
+            spec = {'mode': mode, 'width': int(data['width']), 'height': int(data['height'])}
+            check_output_size(spec['width'], spec['height'], max_pixels)
+        else:
+            spec = {'mode': mode}
+            for name in ('x', 'y', 'width', 'height'):
+                spec[name] = float(data[name])
+            # The box must lie inside the picture, give or take float rounding
+            if not (0 <= spec['x'] < 1 and 0 <= spec['y'] < 1 and 0 < spec['width'] <= 1 - spec['x'] + 1e-9
+                    and 0 < spec['height'] <= 1 - spec['y'] + 1e-9):
+                raise ValueError
+    except CropError:
+        raise
+    except (KeyError, TypeError, ValueError):
+        raise CropError(f'Invalid settings for {mode} batch crop')
+    return spec
+
+
+def centred_box(width, height, aspect):
+    if width / height > aspect:
+        crop_width, crop_height = round(height * aspect), height
+    else:
+        crop_width, crop_height = width, round(width / aspect)
+    left = (width - crop_width) // 2
+    top = (height - crop_height) // 2
+    return left, top, left + crop_width, top + crop_height
+
+
+def crop_to_spec(source, spec):
+    # Runs in a pool process. Returns the encoded crop in the source format.
+    with Image.open(source) as img:
+        fmt = img.format
+        icc_profile, exif = source_metadata(img)
+        img = ImageOps.exif_transpose(img)
+        if spec['mode'] == 'relative':
+            # At least one pixel, however small the picture
+            left = min(img.width - 1, round(spec['x'] * img.width))
+            top = min(img.height - 1, round(spec['y'] * img.height))
+            box = (
+                left,
+                top,
+                max(left + 1, min(img.width, round((spec['x'] + spec['width']) * img.width))),
+                max(top + 1, min(img.height, round((spec['y'] + spec['height']) * img.height))),
+            )
+            img = img.crop(box)
+        elif spec['mode'] == 'aspect':
+            img = img.crop(centred_box(img.width, img.height, spec['aspect']))
+        else:
+            size = (spec['width'], spec['height'])
+            img = img.crop(centred_box(img.width, img.height, size[0] / size[1]))
+            img = img.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+        return encode_image(img, fmt, icc_profile=icc_profile, exif=exif).getvalue()
+
+
+def export_bundle(source, box, targets, name):
+    # Every size of an export preset as (filename, bytes, error) ready for
+    # stream_zip(). Picklable, so queued exports can run it in the pool.
+    return [
+        (f"{entry_name(name)}_{entry_name(target['label'])}{OUTPUT_EXTENSIONS[fmt]}", output.getvalue(), None)
+        for target, output, fmt in export_sizes(source, box, targets)
+    ]
+
+
+def entry_name(text):
+    # One path segment for a ZIP entry: no separators, control characters
+    # or leading dots, whatever a stored preset or filename holds
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', str(text)).lstrip('.') or '_'
+
+
+_pool = None
+
+
+def get_pool(max_workers):
+    # One pool per worker process, created on first use. Pool processes come
+    # from a forkserver rather than a fork of this process, which by now runs
+    # the job, mail and metrics threads and could be holding one of their locks.
+    global _pool
+    if _pool is None:
+        context = multiprocessing.get_context('forkserver')
+        # Imported once in the server, not again in every pool process
+        context.set_forkserver_preload(['batch'])
+        _pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+    return _pool
+
+
+def run_batch(items, spec, max_workers):
+    # items: (name, source) pairs. Yields (name, bytes or None, error) as each
+    # finishes. At most two tasks per worker are in flight, so finished images
+    # waiting to be zipped stay bounded.
+    pool = get_pool(max_workers)
+    pending = {}
+    items = iter(items)
+    while True:
+        for name, source in items:
+            pending[pool.submit(crop_to_spec, source, spec)] = name
+            if len(pending) >= max_workers * 2:
+                break
+        if not pending:
+            return
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            name = pending.pop(future)
+            try:
+                yield name, future.result(), None
+            except Exception as e:
+                yield name, None, str(e)
+
+
+class _ZipBuffer(io.RawIOBase):
+    # Unseekable sink, so zipfile writes data descriptors instead of going
+    # back to patch local headers, and each entry can be sent as it is done.
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def write_zip(path, results):
+    # stream_zip() into a file, renamed into place once it is complete
+    # Own temp name, so a second run of the same job can't write into this one
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in stream_zip(results):
+                out.write(chunk)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def stream_zip(results):
+    # results: (name, bytes or None, error). Failures are listed in errors.txt.
+    buffer = _ZipBuffer()
+    errors = []
+    used_names = set()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        for name, data, error in results:
+            if error:
+                errors.append(f'{name}: {error}')
+                continue
+            archive.writestr(unique_name(name, used_names), data)
+            yield buffer.take()
+        if errors:
+            archive.writestr('errors.txt', '\n'.join(errors) + '\n')
+    yield buffer.take()
+
+
+def unique_name(name, used_names):
+    base, ext = os.path.splitext(name)
+    candidate, n = name, 1
+    while candidate in used_names:
+        n += 1
+        candidate = f'{base}_{n}{ext}'
+    used_names.add(candidate)
+    return candidate
@@ -0,0 +1,74 @@
+# Checks that a resumable upload survives a refused /complete: with the
+# pixel budget full, /uploads/<id>/complete answers 429 and keeps every
+# chunk, and calling it again once there is room stores the picture.
+# Exits non-zero otherwise.
+#
+#   python -m benchmarks.chunked_upload
+import hashlib
+import io
+import os
+import sys
+import tempfile
+
+RUN_DIR = tempfile.mkdtemp()
+os.environ['CHUNK_UPLOAD_FOLDER'] = os.path.join(RUN_DIR, 'chunks')
+os.environ.setdefault('CROP_JOB_THREADS', '0')
+
+from benchmarks.common import logged_in_client
+from benchmarks.images import photo_like
+
+CHUNK_SIZE = 256 * 1024
+
+
+def main():
+    from main import pixel_budget
+
+    output = io.BytesIO()
+    photo_like(2).save(output, 'JPEG', quality=90)
+    content = output.getvalue()
+    client = logged_in_client('chunked@example.com')
+
+    response = client.post('/uploads', json={'filename': 'chunked.jpg', 'size': len(content),
+                                             'sha256': hashlib.sha256(content).hexdigest(),
+                                             'chunk_size': CHUNK_SIZE})
+    assert response.status_code == 201, response.get_json()
+    upload = response.get_json()
+    for index in range(upload['chunk_count']):
+        chunk = content[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE]
+        assert client.put(f"/uploads/{upload['upload_id']}/chunks/{index}", data=chunk).status_code == 200
+
+    failures = []
+    # Fill the budget so the upload is refused after a short wait
+    max_wait, pixel_budget.max_wait = pixel_budget.max_wait, 0.1
+    pixel_budget.acquire(pixel_budget.budget_bytes)
+    try:
+        response = client.post(f"/uploads/{upload['upload_id']}/complete")
+    finally:
+        pixel_budget.release(pixel_budget.budget_bytes)
+        pixel_budget.max_wait = max_wait
+    if response.status_code != 429:
+        failures.append(f'busy complete: expected 429, got {response.status_code}')
+
+    status = client.get(f"/uploads/{upload['upload_id']}").get_json()
+    if status.get('missing') != [] or len(status.get('received', [])) != upload['chunk_count']:
+        failures.append(f'chunks lost after the 429: {status}')
+
+    response = client.post(f"/uploads/{upload['upload_id']}/complete")
+    if response.status_code != 200:
+        failures.append(f'retried complete: expected 200, got {response.status_code} {response.get_json()}')
+    else:
+        picture_id = response.get_json()['picture_id']
+        if client.get(f"/uploads/{upload['upload_id']}").status_code != 404:
+            failures.append('upload session still there after completing')
+        if os.path.exists(os.path.join(os.environ['CHUNK_UPLOAD_FOLDER'], upload['upload_id'])):
+            failures.append('chunks still on disk after completing')
+        client.post(f'/delete-picture/{picture_id}')
+
+    for failure in failures:
+        print(f'failed: {failure}')
+    print('ok' if not failures else f'{len(failures)} failures')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# Shared setup for the benchmark scripts. Run them from the repo root, e.g.
+#   python -m benchmarks.crop_submission
+import datetime
+import functools
+import os
+import resource
+import sys
+import tempfile
+
+# Keep benchmark data out of instance/users.db and static/uploads
+os.environ.setdefault('DB_URI', 'sqlite://')
+os.environ.setdefault('UPLOAD_FOLDER', tempfile.mkdtemp(prefix='pic_editor_uploads_'))
+# and no outbox thread polling underneath the measurements
+os.environ.setdefault('MAIL_SEND_IN_BACKGROUND', '0')
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return rss / 1024
+
+
+@functools.cache
+def get_app():
+    # One app per benchmark process, with the schema in place
+    from main import create_app, init_db
+
+    app = create_app()
+    with app.app_context():
+        init_db()
+    return app
+
+
+def logged_in_client(email='bench@example.com'):
+    from main import db, User
+    app = get_app()
+
+    with app.app_context():
+        user = User.query.filter_by(email=email).first()
+        if not user:
+            user = User(
+                email=email,
+                name='bench',
+                password='',
+                date_of_signup=datetime.date.today(),
+                time_of_signup=datetime.datetime.now().time(),
+                end_date_premium=datetime.date.today(),
+                premium_level=0,
+                points=0,
+                picture_count=100,
+                verified=True,
+            )
+            db.session.add(user)
+            db.session.commit()
+        user_id = user.id
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(user_id)
+        sess['_fresh'] = True
+    return client
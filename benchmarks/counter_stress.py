@@ -0,0 +1,153 @@
+# Hammers the upvote toggle and the credit ledger from many threads at once
+# and checks that no update was lost. Exits non-zero on any mismatch.
+#
+#   python -m benchmarks.counter_stress [--threads 16] [--ops 200]
+#
+# Runs against a throwaway SQLite file (threads cannot share an in-memory
+# database). For contrast, the read-modify-write increment the credit code
+# used to do is run the same way and its lost updates are reported.
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+DB_DIR = tempfile.mkdtemp()
+os.environ['DB_URI'] = f"sqlite:///{os.path.join(DB_DIR, 'stress.db')}"
+os.environ.setdefault('CROP_JOB_THREADS', '0')
+
+from benchmarks.common import get_app, logged_in_client
+
+
+def run_threads(count, target):
+    errors = []
+
+    def wrapped(n):
+        try:
+            target(n)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=wrapped, args=(n,)) for n in range(count)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return time.perf_counter() - start
+
+
+def stress_upvotes(threads, ops):
+    from main import db, Feedback, FeedbackUpvote
+    app = get_app()
+
+    # Two threads per user, so the same user's clicks race each other too
+    clients = [logged_in_client(f'voter{n // 2}@example.com') for n in range(threads)]
+    with app.app_context():
+        feedback = [Feedback(user_id=1, title=f'Stress {n}', feedback='', upvote_count=0) for n in range(4)]
+        db.session.add_all(feedback)
+        db.session.commit()
+        feedback_ids = [f.id for f in feedback]
+
+    def click(n):
+        for op in range(ops):
+            response = clients[n].post(f'/upvote/{feedback_ids[op % len(feedback_ids)]}')
+            assert response.status_code == 200, response.status_code
+
+    elapsed = run_threads(threads, click)
+
+    failures = 0
+    with app.app_context():
+        for feedback_id in feedback_ids:
+            stored = db.session.get(Feedback, feedback_id).upvote_count
+            votes = FeedbackUpvote.query.filter_by(feedback_id=feedback_id).count()
+            if stored != votes:
+                failures += 1
+                print(f'feedback {feedback_id}: count {stored}, votes {votes}')
+    total = threads * ops
+    print(f'upvotes: {total} toggles in {elapsed:.1f} s ({total / elapsed:.0f}/s), '
+          f"{'counts match votes' if not failures else f'{failures} counts wrong'}")
+    return failures
+
+
+def stress_credits(threads, ops):
+    from main import db, User, add_credits, compact_credits, credit_balance
+    app = get_app()
+
+    logged_in_client('credits@example.com')
+    with app.app_context():
+        user = User.query.filter_by(email='credits@example.com').first()
+        user_id, start_balance = user.id, user.picture_count
+
+    done = threading.Event()
+
+    def buy(n):
+        with app.app_context():
+            for _ in range(ops):
+                add_credits(user_id, 1, 'stress')
+                db.session.commit()
+
+    def compact():
+        # Compaction keeps running underneath the writers
+        with app.app_context():
+            while not done.is_set():
+                compact_credits()
+                time.sleep(0.01)
+
+    compactor = threading.Thread(target=compact)
+    compactor.start()
+    elapsed = run_threads(threads, buy)
+    done.set()
+    compactor.join()
+
+    with app.app_context():
+        balance = credit_balance(user_id)
+        compact_credits()
+        stored = db.session.get(User, user_id).picture_count
+    expected = start_balance + threads * ops
+    ok = balance == expected and stored == expected
+    total = threads * ops
+    print(f'credits: {total} ledger entries in {elapsed:.1f} s ({total / elapsed:.0f}/s), '
+          f'balance {balance}, after compaction {stored}, expected {expected}')
+    return 0 if ok else 1
+
+
+def naive_credits(threads, ops):
+    # The old read, add in Python, commit pattern
+    from main import db, User
+    app = get_app()
+
+    with app.app_context():
+        user = User.query.filter_by(email='credits@example.com').first()
+        user_id, start = user.id, user.picture_count
+
+    def buy(n):
+        with app.app_context():
+            for _ in range(ops):
+                user = db.session.execute(db.select(User).where(User.id == user_id)).scalar()
+                user.picture_count = user.picture_count + 1
+                db.session.commit()
+
+    run_threads(threads, buy)
+    with app.app_context():
+        gained = db.session.get(User, user_id).picture_count - start
+    print(f'read-modify-write for comparison: {threads * ops - gained} of {threads * ops} increments lost')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--ops', type=int, default=200)
+    args = parser.parse_args()
+
+    failures = stress_upvotes(args.threads, args.ops)
+    failures += stress_credits(args.threads, args.ops)
+    naive_credits(args.threads, args.ops)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# Compares the legacy urlencoded base64 data URL submission to
+# /save-cropped-image with the raw Blob and multipart paths.
+#
+#   python -m benchmarks.crop_submission [--sizes 1 10 40]
+#
+# Each (path, size) runs in its own process so peak RSS is not shared.
+import argparse
+import base64
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+from urllib.parse import quote
+
+from benchmarks.common import logged_in_client, peak_rss_mb
+
+PATHS = ('urlencoded', 'blob', 'multipart')
+
+
+def run_case(path, size_mb, repeat):
+    client = logged_in_client()
+    payload = os.urandom(size_mb * 1024 * 1024)
+
+    timings = []
+    for _ in range(repeat):
+        if path == 'urlencoded':
+            data_url = 'data:image/png;base64,' + base64.b64encode(payload).decode()
+            body = 'cropped_image=' + quote(data_url, safe='') + '&original_filename=bench.png'
+            kwargs = {'data': body, 'content_type': 'application/x-www-form-urlencoded'}
+        elif path == 'blob':
+            kwargs = {'data': payload, 'content_type': 'image/png',
+                      'query_string': {'original_filename': 'bench.png'}}
+        else:
+            kwargs = {'data': {'cropped_image': (io.BytesIO(payload), 'bench.png', 'image/png'),
+                               'original_filename': 'bench.png'},
+                      'content_type': 'multipart/form-data'}
+
+        start = time.perf_counter()
+        response = client.post('/save-cropped-image', **kwargs)
+        received = sum(len(chunk) for chunk in response.response)
+        response.close()
+        timings.append(time.perf_counter() - start)
+        assert received == len(payload), f'{path}: got {received} bytes back'
+        del kwargs
+
+    return {
+        'path': path,
+        'size_mb': size_mb,
+        'best_ms': round(min(timings) * 1000, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 40])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--case', nargs=2, metavar=('PATH', 'SIZE_MB'))
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(args.case[0], int(args.case[1]), args.repeat)))
+        return
+
+    print(f"{'path':<12}{'size MB':>8}{'best ms':>10}{'peak RSS MB':>13}")
+    for size_mb in args.sizes:
+        for path in PATHS:
+            output = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.crop_submission', '--case', path, str(size_mb),
+                 '--repeat', str(args.repeat)],
+                check=True, capture_output=True, text=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{result['path']:<12}{result['size_mb']:>8}{result['best_ms']:>10}{result['peak_rss_mb']:>13}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+# Concurrent reads and writes against each database engine profile (see
+# database.py), from several processes at once the way gunicorn workers
+# share a database. Readers load a user and a page of their library;
+# writers add a picture or bump a user's points. Reports operations per
+# second, p50/p99 latency and "database is locked" and other errors, and
+# exits non-zero if a tuned profile had any errors.
+#
+#   python -m benchmarks.db_profiles [--processes 4] [--threads 1] [--seconds 10] [--write-share 0.2]
+#                                    [--postgres postgresql://user@host/scratch]
+#                                    [--output results.json] [--baseline old.json] [--tolerance 0.2]
+#
+# SQLite runs on a temp file with the untuned defaults ("none") and the
+# "sqlite" profile. With --postgres it also runs "none" and "postgresql"
+# against that database, which must be a scratch one: the benchmark
+# creates the schema there and adds rows to it.
+import argparse
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.report import check, environment, save, summarize
+
+USERS = 200
+PICTURES_PER_USER = 100
+
+
+def child_env(uri, profile, processes, threads, run_dir):
+    return dict(os.environ, DB_URI=uri, DB_PROFILE=profile, WEB_CONCURRENCY=str(processes),
+                WEB_THREADS=str(threads), CROP_JOB_THREADS='0', MAIL_SEND_IN_BACKGROUND='0',
+                METRICS_DIR=os.path.join(run_dir, 'metrics'))
+
+
+def seed():
+    # Schema plus USERS users with PICTURES_PER_USER pictures each
+    from main import create_app, init_db, db, User, Picture
+
+    app = create_app()
+    with app.app_context():
+        init_db()
+        first = db.session.execute(db.select(db.func.max(User.id))).scalar() or 0
+        today = datetime.date.today()
+        db.session.execute(db.insert(User), [
+            dict(email=f'db{first + n}@example.com', name='db', password='', date_of_signup=today,
+                 time_of_signup=datetime.datetime.now().time(), end_date_premium=today, premium_level=0,
+                 points=0, picture_count=0, verified=True) for n in range(USERS)])
+        user_ids = [user_id for user_id, in db.session.execute(
+            db.select(User.id).where(User.email.like('db%@example.com')).order_by(User.id.desc()).limit(USERS))]
+        db.session.execute(db.insert(Picture), [
+            dict(user_id=user_id, filename=f'{n}.jpg', original_path=f'ab/cd/{n}.jpg', cropped_path='',
+                 upload_date=today - datetime.timedelta(days=n)) for user_id in user_ids for n in range(PICTURES_PER_USER)])
+        db.session.commit()
+    print(json.dumps(user_ids))
+
+
+def work(start_at, seconds, threads, write_share, user_ids):
+    # One worker process: `threads` threads doing reads and writes until the deadline
+    from sqlalchemy.exc import OperationalError
+    from main import create_app, db, User, Picture
+
+    app = create_app()
+    results = {'read': [], 'write': [], 'locked': 0, 'errors': []}
+    lock = threading.Lock()
+
+    def run(seed):
+        rng = random.Random(seed)
+        timings = {'read': [], 'write': []}
+        locked = 0
+        errors = []
+        with app.app_context():
+            while time.time() < start_at:
+                time.sleep(0.001)
+            deadline = start_at + seconds
+            while time.time() < deadline:
+                user_id = rng.choice(user_ids)
+                kind = 'write' if rng.random() < write_share else 'read'
+                start = time.perf_counter()
+                try:
+                    if kind == 'read':
+                        db.session.get(User, user_id)
+                        (Picture.query.filter_by(user_id=user_id)
+                         .order_by(Picture.upload_date.desc(), Picture.id.desc()).limit(50).all())
+                    elif rng.random() < 0.5:
+                        db.session.add(Picture(user_id=user_id, filename='new.jpg', original_path='ab/cd/new.jpg',
+                                               cropped_path='', upload_date=datetime.date.today()))
+                    else:
+                        db.session.execute(db.update(User).where(User.id == user_id)
+                                           .values(points=User.points + 1))
+                    db.session.commit()
+                    timings[kind].append(time.perf_counter() - start)
+                except OperationalError as e:
+                    db.session.rollback()
+                    if 'locked' in str(e) or 'busy' in str(e):
+                        locked += 1
+                    else:
+                        errors.append(str(e.orig))
+                finally:
+                    db.session.remove()
+        with lock:
+            for kind in timings:
+                results[kind] += timings[kind]
+            results['locked'] += locked
+            results['errors'] += errors[:5]
+
+    workers = [threading.Thread(target=run, args=(os.getpid() * 100 + n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    print(json.dumps(results))
+
+
+def run_profile(uri, profile, args, run_dir):
+    env = child_env(uri, profile, args.processes, args.threads, run_dir)
+    setup = subprocess.run([sys.executable, '-m', 'benchmarks.db_profiles', '--seed'],
+                           capture_output=True, text=True, env=env)
+    if setup.returncode:
+        sys.exit(setup.stderr)
+    user_ids = json.loads(setup.stdout.splitlines()[-1])
+
+    # Processes import and connect first, then all start at the same moment
+    start_at = time.time() + 5
+    children = [subprocess.Popen([sys.executable, '-m', 'benchmarks.db_profiles', '--work', str(start_at),
+                                  str(args.seconds), str(args.threads), str(args.write_share)],
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 text=True, env=env)
+                for _ in range(args.processes)]
+    reads, writes, locked, errors = [], [], 0, []
+    for child in children:
+        out, err = child.communicate(json.dumps(user_ids))
+        if child.returncode:
+            sys.exit(err)
+        result = json.loads(out.splitlines()[-1])
+        reads += result['read']
+        writes += result['write']
+        locked += result['locked']
+        errors += result['errors']
+    return reads, writes, locked, errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--write-share', type=float, default=0.2)
+    parser.add_argument('--postgres')
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--seed', action='store_true')
+    parser.add_argument('--work', nargs=4, metavar=('START_AT', 'SECONDS', 'THREADS', 'WRITE_SHARE'))
+    args = parser.parse_args()
+
+    if args.seed:
+        return seed()
+    if args.work:
+        start_at, seconds, threads, write_share = args.work
+        return work(float(start_at), float(seconds), int(threads), float(write_share), json.loads(sys.stdin.read()))
+
+    run_dir = tempfile.mkdtemp(prefix='pic_editor_db_')
+    runs = [('sqlite', f"sqlite:///{os.path.join(run_dir, f'{profile}.db')}", profile) for profile in ('none', 'sqlite')]
+    if args.postgres:
+        runs += [('postgresql', args.postgres, profile) for profile in ('none', 'postgresql')]
+
+    print(f'{args.processes} processes x {args.threads} threads, {args.seconds:g} s, '
+          f'{args.write_share:.0%} writes')
+    print(f"{'database':<12}{'profile':<12}{'reads/s':>9}{'writes/s':>10}{'read p50':>10}{'read p99':>10}"
+          f"{'write p50':>11}{'write p99':>11}{'locked':>8}{'errors':>8}")
+    cases = []
+    failures = 0
+    for database, uri, profile in runs:
+        reads, writes, locked, errors = run_profile(uri, profile, args, run_dir)
+        read, write = summarize(reads or [0]), summarize(writes or [0])
+        print(f"{database:<12}{profile:<12}{len(reads) / args.seconds:>9.0f}{len(writes) / args.seconds:>10.0f}"
+              f"{read['p50_ms']:>10.1f}{read['p99_ms']:>10.1f}{write['p50_ms']:>11.1f}{write['p99_ms']:>11.1f}"
+              f"{locked:>8}{len(errors):>8}")
+        for error in errors[:3]:
+            print(f'  {error}')
+        cases.append({'name': f'{database} {profile} read', **read, 'per_s': round(len(reads) / args.seconds, 1)})
+        cases.append({'name': f'{database} {profile} write', **write, 'per_s': round(len(writes) / args.seconds, 1),
+                      'locked': locked, 'errors': len(errors)})
+        if profile != 'none' and (locked or errors):
+            failures += 1
+    print('times in ms')
+
+    if args.output:
+        save(args.output, 'db_profiles', args, cases)
+    if args.baseline:
+        current = {'suite': 'db_profiles', 'environment': environment(), 'args': vars(args), 'cases': cases}
+        failures += check(args.baseline, current, args.tolerance)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+# Signups per second with the verification email sent inside the request
+# (the old path: a fresh SMTP connection per signup) against the outbox,
+# where register only queues the email and a background sender delivers
+# it over one reused connection. Checks every email reaches the server,
+# including ones the server turns away once. Exits non-zero otherwise.
+#
+#   python -m benchmarks.email_outbox [--signups 200] [--threads 8] [--handshake-ms 300]
+#
+# The SMTP server is a local aiosmtpd stand-in (pip install aiosmtpd) that
+# sleeps for --handshake-ms on EHLO, standing in for the connect, STARTTLS
+# and login round trips of a real provider, and --data-ms per message.
+# Password hashing is cut to 1000 rounds so it doesn't hide the email cost;
+# pass --real-hash to keep the production setting.
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from aiosmtpd.controller import Controller
+
+DB_DIR = tempfile.mkdtemp()
+os.environ['DB_URI'] = f"sqlite:///{os.path.join(DB_DIR, 'outbox.db')}"
+os.environ.setdefault('CROP_JOB_THREADS', '0')
+os.environ['MAIL_SEND_IN_BACKGROUND'] = '0'
+os.environ['MAIL_USE_TLS'] = '0'
+os.environ.pop('EMAIL_PASSWORD', None)
+
+from benchmarks.common import get_app
+
+
+class SlowServer:
+    # aiosmtpd handler that records recipients and adds latency
+    def __init__(self, handshake, data):
+        self.handshake = handshake
+        self.data = data
+        self.received = Counter()
+        self.connections = 0
+        self.refused_once = set()
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        self.connections += 1
+        await asyncio.sleep(self.handshake)
+        session.host_name = hostname
+        return responses
+
+    async def handle_DATA(self, server, session, envelope):
+        await asyncio.sleep(self.data)
+        for address in envelope.rcpt_tos:
+            # Addresses marked "retry" are turned away the first time
+            if 'retry' in address and address not in self.refused_once:
+                self.refused_once.add(address)
+                return '451 Try again later'
+        for address in envelope.rcpt_tos:
+            self.received[address] += 1
+        return '250 OK'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def signup_all(client_count, emails):
+    app = get_app()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    errors = []
+    latencies = []
+
+    def signup(n):
+        client = app.test_client()
+        for email in emails[n::client_count]:
+            start = time.perf_counter()
+            response = client.post('/register', data={'email': email, 'password': 'pw', 'name': 'bench'})
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 302 or '/login' not in response.headers['Location']:
+                errors.append(f'{email}: {response.status_code} {response.headers.get("Location")}')
+
+    threads = [threading.Thread(target=signup, args=(n,)) for n in range(client_count)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if errors:
+        print(f'{len(errors)} signups failed, first: {errors[0]}')
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000
+    return len(emails) / elapsed, f'p50 {p50:.0f} ms, p95 {p95:.0f} ms'
+
+
+def old_path(port):
+    # The register flow before the outbox: a new SMTP session per signup,
+    # inside the request. Swapped in for queue_verification_email.
+    import main
+    from mailer import SMTPConnection, build_message
+
+    def send_now(email, token):
+        connection = SMTPConnection('127.0.0.1', port, starttls=False)
+        try:
+            connection.send(build_message(main.config['MAIL_SENDER'], email,
+                                          f'Verify Your {main.APP_NAME} Account', token))
+        finally:
+            connection.close()
+
+    return send_now
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--signups', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--handshake-ms', type=float, default=300)
+    parser.add_argument('--data-ms', type=float, default=5)
+    parser.add_argument('--real-hash', action='store_true')
+    args = parser.parse_args()
+
+    port = free_port()
+    os.environ['MAIL_SERVER'] = '127.0.0.1'
+    os.environ['MAIL_PORT'] = str(port)
+    handler = SlowServer(args.handshake_ms / 1000, args.data_ms / 1000)
+    controller = Controller(handler, hostname='127.0.0.1', port=port)
+    controller.start()
+
+    import main as app_module
+    from main import db, OutboxEmail, outbox_sender
+    app = get_app()
+
+    if not args.real_hash:
+        hash_password = app_module.generate_password_hash
+        app_module.generate_password_hash = lambda password, **kwargs: hash_password(password, 'pbkdf2:sha256:1000')
+
+    failures = 0
+    try:
+        # Old path
+        queue = app_module.queue_verification_email
+        app_module.queue_verification_email = old_path(port)
+        emails = [f'old{n}@example.com' for n in range(args.signups)]
+        rate, latency = signup_all(args.threads, emails)
+        app_module.queue_verification_email = queue
+        delivered = sum(1 for email in emails if handler.received[email])
+        print(f'old path: {rate:.1f} signups/s ({latency}), '
+              f'{delivered}/{args.signups} delivered, {handler.connections} SMTP connections')
+        failures += delivered != args.signups
+
+        # Outbox: register returns at commit, the sender delivers behind it
+        connections = handler.connections
+        outbox_sender.backoff_seconds = 0.2
+        sender = threading.Thread(target=outbox_sender.run_forever)
+        sender.start()
+        emails = [f'outbox{n}@example.com' for n in range(args.signups - 5)]
+        emails += [f'retry{n}@example.com' for n in range(5)]
+        start = time.perf_counter()
+        rate, latency = signup_all(args.threads, emails)
+
+        deadline = time.monotonic() + 60 + args.signups * (args.handshake_ms + args.data_ms) / 1000
+        with app.app_context():
+            while time.monotonic() < deadline:
+                waiting = OutboxEmail.query.filter(OutboxEmail.status.in_(('pending', 'sending'))).count()
+                if not waiting:
+                    break
+                time.sleep(0.05)
+            drained = time.perf_counter() - start
+            statuses = Counter(status for status, in db.session.execute(db.select(OutboxEmail.status)))
+            retried = OutboxEmail.query.filter(OutboxEmail.attempts > 1).count()
+        outbox_sender.stop()
+        sender.join()
+
+        delivered = sum(1 for email in emails if handler.received[email])
+        duplicates = sum(1 for email in emails if handler.received[email] > 1)
+        print(f'outbox: {rate:.1f} signups/s ({latency}), all delivered after {drained:.1f} s, '
+              f'{delivered}/{args.signups} delivered, {duplicates} duplicates, {retried} retried, '
+              f'{handler.connections - connections} SMTP connections, outbox {dict(statuses)}')
+        failures += delivered != args.signups or duplicates or statuses.get('sent') != args.signups or retried != 5
+    finally:
+        controller.stop()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
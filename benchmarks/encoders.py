@@ -0,0 +1,49 @@
+# Output size and encode time for each output format the cropper offers.
+#
+#   python -m benchmarks.encoders [--megapixels 12] [--repeat 3]
+import argparse
+import statistics
+import time
+
+from PIL import features
+
+from benchmarks.images import photo_like
+from imaging import DEFAULT_QUALITY, OUTPUT_FORMATS, encode_image
+
+# (label, format, quality); None picks the default for the format
+PRESETS = [
+    ('source PNG', 'PNG', None),
+    ('jpeg q75', 'JPEG', 75),
+    ('jpeg default', 'JPEG', None),
+    ('jpeg q95', 'JPEG', 95),
+    ('webp default', 'WEBP', None),
+    ('avif default', 'AVIF', None),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--megapixels', type=float, default=12)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    img = photo_like(args.megapixels)
+    raw_mb = img.width * img.height * 3 / 1e6
+    print(f"{img.width}x{img.height}, {raw_mb:.1f} MB raw RGB; output formats: {', '.join(OUTPUT_FORMATS)}")
+    print(f"{'preset':<14}{'quality':>8}{'size KB':>10}{'ratio':>8}{'encode ms':>11}")
+    for label, fmt, quality in PRESETS:
+        if fmt == 'AVIF' and not features.check('avif'):
+            print(f"{label:<14}  skipped, no AVIF support in this Pillow build")
+            continue
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            output = encode_image(img, fmt, quality, metadata='strip')
+            timings.append(time.perf_counter() - start)
+        size = len(output.getvalue())
+        print(f"{label:<14}{quality or DEFAULT_QUALITY.get(fmt, '-'):>8}{size / 1024:>10.0f}"
+              f"{raw_mb * 1e6 / size:>8.1f}{statistics.median(timings) * 1000:>11.0f}")
+
+
+if __name__ == '__main__':
+    main()
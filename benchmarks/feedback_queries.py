@@ -0,0 +1,92 @@
+# Checks that the feedback page runs the same number of SQL statements
+# however much feedback there is, with the first-page and user caches cold
+# and warm and for a later page. Exits non-zero if any count grows with the rows.
+#
+#   python -m benchmarks.feedback_queries [--sizes 10 1000 10000]
+import argparse
+import os
+import re
+import sys
+import time
+
+os.environ.setdefault('CROP_JOB_THREADS', '0')
+
+from sqlalchemy import event
+
+from benchmarks.common import get_app, logged_in_client
+
+
+class StatementCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def seed(total, email):
+    from main import db, Feedback, FeedbackUpvote, User
+    app = get_app()
+
+    client = logged_in_client(email)
+    with app.app_context():
+        db.session.execute(db.delete(FeedbackUpvote))
+        db.session.execute(db.delete(Feedback))
+        user_id = User.query.filter_by(email=email).first().id
+        db.session.execute(db.insert(Feedback), [
+            dict(user_id=user_id, title=f'Idea {n}', feedback='More export sizes', upvote_count=n % 50)
+            for n in range(total)
+        ])
+        ids = db.session.execute(db.select(Feedback.id)).scalars().all()
+        # The user has voted on every third item
+        db.session.execute(db.insert(FeedbackUpvote), [
+            dict(user_id=user_id, feedback_id=feedback_id) for feedback_id in ids[::3]
+        ])
+        db.session.commit()
+    return client
+
+
+def measure(client, counter, url):
+    counter.count = 0
+    start = time.perf_counter()
+    response = client.get(url)
+    elapsed = time.perf_counter() - start
+    assert response.status_code == 200, response.status_code
+    return counter.count, elapsed * 1000, response.get_data(as_text=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 10000])
+    args = parser.parse_args()
+
+    from main import db, feedback_page_cache, user_snapshots
+    app = get_app()
+
+    with app.app_context():
+        counter = StatementCounter(db.engine)
+
+    results = {}
+    print(f"{'rows':>7}{'cold':>6}{'warm':>6}{'page 2':>8}{'cold ms':>9}{'warm ms':>9}")
+    for total in args.sizes:
+        client = seed(total, 'feedback@example.com')
+        feedback_page_cache.clear()
+        user_snapshots.clear()
+        cold, cold_ms, html = measure(client, counter, '/feedback')
+        warm, warm_ms, _ = measure(client, counter, '/feedback')
+        cursor = re.search(r'cursor=([\w-]+)', html)
+        # Too few rows for a second page
+        second = measure(client, counter, f'/feedback?cursor={cursor.group(1)}')[0] if cursor else None
+        results[total] = (cold, warm, second)
+        print(f"{total:>7}{cold:>6}{warm:>6}{second if second is not None else '-':>8}{cold_ms:>9.1f}{warm_ms:>9.1f}")
+
+    first_pages = {(cold, warm) for cold, warm, _ in results.values()}
+    second_pages = {second for _, _, second in results.values() if second is not None}
+    if len(first_pages) > 1 or len(second_pages) > 1:
+        print('Statement counts change with the number of rows')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
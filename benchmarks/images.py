@@ -0,0 +1,84 @@
+# Synthetic photo-like test images, made the same way every time so runs
+# on different days and machines use identical inputs. Files are cached in
+# BENCH_IMAGE_DIR (default: a folder in the system temp dir) because the big
+# PNGs and GIFs take a while to make.
+#
+#   python -m benchmarks.images [--sizes 0.5 2 12 24 50] [--formats JPEG PNG GIF]
+import argparse
+import os
+import tempfile
+
+import numpy as np
+from PIL import Image, ImageChops, ImageFilter
+
+SIZES_MP = (0.5, 2, 12, 24, 50)
+FORMATS = ('JPEG', 'PNG', 'GIF')
+EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif'}
+
+IMAGE_DIR = os.environ.get('BENCH_IMAGE_DIR', os.path.join(tempfile.gettempdir(), 'pic_editor_bench_images'))
+
+
+def dimensions(megapixels):
+    # 3:2, like most camera sensors
+    width = int((megapixels * 1e6 * 1.5) ** 0.5)
+    return width, int(width / 1.5)
+
+
+def photo_like(megapixels, seed=0):
+    # Smooth gradients with blurred noise, closer to a photo than flat colour
+    w, h = dimensions(megapixels)
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:h, 0:w].astype(np.float32)
+    base = np.stack([x / w * 200, y / h * 180, (x + y) / (w + h) * 220], axis=-1)
+    noise = rng.normal(0, 25, (h // 4, w // 4, 3)).astype(np.float32)
+    noise = np.asarray(Image.fromarray(np.clip(noise + 128, 0, 255).astype(np.uint8))
+                       .resize((w, h), Image.Resampling.BICUBIC)
+                       .filter(ImageFilter.GaussianBlur(2)), dtype=np.float32) - 128
+    return Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8))
+
+
+def large_photo_like(megapixels, seed=0):
+    # photo_like() holds several float copies of the image, too much at
+    # 50 MP. This draws it at a quarter of the size, scales it up and adds
+    # fine grain with Pillow, so memory stays at a few copies of the RGB.
+    w, h = dimensions(megapixels)
+    img = photo_like(megapixels / 16, seed).resize((w, h), Image.Resampling.BICUBIC)
+    grain = Image.effect_noise((w, h), 12).convert('RGB')
+    return ImageChops.add(img, grain, offset=-128)
+
+
+def make_image(megapixels, fmt, seed=0):
+    img = photo_like(megapixels, seed) if megapixels <= 12 else large_photo_like(megapixels, seed)
+    if fmt == 'GIF':
+        img = img.quantize(256)
+    return img
+
+
+def fixture(megapixels, fmt):
+    # Path to the cached test image, made first if needed
+    path = os.path.join(IMAGE_DIR, f'{megapixels:g}mp{EXTENSIONS[fmt]}')
+    if not os.path.exists(path):
+        os.makedirs(IMAGE_DIR, exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        make_image(megapixels, fmt).save(temp_path, fmt, **({'quality': 90} if fmt == 'JPEG' else {}))
+        os.replace(temp_path, path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=float, nargs='+', default=list(SIZES_MP))
+    parser.add_argument('--formats', nargs='+', default=list(FORMATS), choices=FORMATS)
+    args = parser.parse_args()
+
+    print(f'{IMAGE_DIR}')
+    print(f"{'image':<12}{'pixels':>14}{'file MB':>9}")
+    for megapixels in args.sizes:
+        for fmt in args.formats:
+            path = fixture(megapixels, fmt)
+            w, h = dimensions(megapixels)
+            print(f'{os.path.basename(path):<12}{f"{w}x{h}":>14}{os.path.getsize(path) / 1e6:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
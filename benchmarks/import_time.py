@@ -0,0 +1,93 @@
+# What a fresh worker pays before serving its first request: importing
+# main and calling create_app(), measured in new interpreters with
+# `-X importtime`. Prints the median and the slowest imports under main,
+# and exits non-zero if the median is over budget or any module that is
+# meant to load on first use was imported at boot.
+#
+#   python -m benchmarks.import_time [--runs 5] [--budget-ms 1000] [--top 12]
+#
+# The budget is for this repo's CI-sized machines; on a slower box pass a
+# bigger one rather than deleting the check.
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# Imported by the routes that need them, never at boot
+LAZY_MODULES = ('openai', 'stripe', 'requests', 'numpy', 'smart_crop', 'phash', 'email.mime.text')
+
+BOOT = '''
+import sys, time
+start = time.perf_counter()
+import main
+main.create_app()
+print('boot_us', int((time.perf_counter() - start) * 1e6))
+print('loaded', ','.join(m for m in {lazy!r} if m in sys.modules))
+'''
+
+
+def parse_importtime(stderr):
+    # [(depth, module, cumulative us)] in the order -X importtime prints them
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue  # the header line
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        rows.append((depth, name.strip(), int(cumulative)))
+    return rows
+
+
+def boot_once():
+    env = dict(os.environ, DB_URI='sqlite://', CROP_JOB_THREADS='0', MAIL_SEND_IN_BACKGROUND='0')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', BOOT.format(lazy=LAZY_MODULES)],
+                            capture_output=True, text=True, env=env,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    if result.returncode:
+        sys.exit(result.stderr)
+    out = dict(line.split(' ', 1) if ' ' in line else (line, '') for line in result.stdout.splitlines())
+    rows = parse_importtime(result.stderr)
+    # Direct imports of main are listed just before it, one level deeper
+    main_at = next(n for n, (depth, name, _) in enumerate(rows) if name == 'main' and depth == 0)
+    start = main_at
+    while start > 0 and rows[start - 1][0] > 0:
+        start -= 1
+    children = [(name, us) for depth, name, us in rows[start:main_at] if depth == 1]
+    loaded = [m for m in out.get('loaded', '').split(',') if m]
+    return int(out['boot_us']), rows[main_at][2], children, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=1000)
+    parser.add_argument('--top', type=int, default=12)
+    args = parser.parse_args()
+
+    runs = [boot_once() for _ in range(args.runs)]
+    boot_ms = statistics.median(run[0] for run in runs) / 1000
+    import_ms = statistics.median(run[1] for run in runs) / 1000
+
+    # Slowest direct imports of main, from the median run
+    _, _, children, loaded = sorted(runs, key=lambda run: run[0])[len(runs) // 2]
+    print(f"{'module':<24} {'cumulative ms':>13}")
+    for name, us in sorted(children, key=lambda child: -child[1])[:args.top]:
+        print(f'{name:<24} {us / 1000:>13.1f}')
+    print(f'\nimport main: {import_ms:.0f} ms, import main + create_app(): {boot_ms:.0f} ms '
+          f'(median of {args.runs}, budget {args.budget_ms:.0f} ms)')
+
+    failures = 0
+    if loaded:
+        print(f"loaded at boot but should not be: {', '.join(loaded)}")
+        failures += 1
+    if boot_ms > args.budget_ms:
+        print('over budget')
+        failures += 1
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
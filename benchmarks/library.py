@@ -0,0 +1,67 @@
+# Library page times for a small and a very large library. With keyset
+# pagination the first, middle and last pages should all cost about the
+# same, whatever the library size.
+#
+#   python -m benchmarks.library [--sizes 50 50000] [--repeat 20]
+import argparse
+import datetime
+import os
+import statistics
+import time
+
+os.environ.setdefault('CROP_JOB_THREADS', '0')
+
+from benchmarks.common import get_app, logged_in_client
+from pagination import encode_cursor
+
+
+def seed(count, email):
+    from main import db, Picture, User
+    app = get_app()
+
+    client = logged_in_client(email)
+    with app.app_context():
+        user_id = User.query.filter_by(email=email).first().id
+        start = datetime.date(2015, 1, 1)
+        rows = [dict(user_id=user_id, filename=f'{n}.jpg', original_path=f'ab/cd/{n}.jpg', cropped_path='',
+                     upload_date=start + datetime.timedelta(days=n // 20)) for n in range(count)]
+        db.session.execute(db.insert(Picture), rows)
+        db.session.commit()
+        # Cursors for a page halfway through and the last page
+        ordered = (Picture.query.filter_by(user_id=user_id)
+                   .order_by(Picture.upload_date.desc(), Picture.id.desc()).all())
+        cursors = {}
+        for label, position in (('middle', count // 2), ('last', max(0, count - 51))):
+            row = ordered[position]
+            cursors[label] = encode_cursor([row.upload_date, row.id])
+    return client, cursors
+
+
+def time_page(client, cursor, repeat):
+    url = '/api/pictures' + (f'?cursor={cursor}' if cursor else '')
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get(url)
+        timings.append(time.perf_counter() - start)
+        assert response.status_code == 200
+    return statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 50000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'pictures':>9}{'first ms':>10}{'middle ms':>11}{'last ms':>9}")
+    for count in args.sizes:
+        client, cursors = seed(count, f'library{count}@example.com')
+        first = time_page(client, None, args.repeat)
+        middle = time_page(client, cursors['middle'], args.repeat)
+        last = time_page(client, cursors['last'], args.repeat)
+        print(f"{count:>9}{first:>10.2f}{middle:>11.2f}{last:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+# End-to-end load on the image pipeline, the way a browser drives it: each
+# virtual user logs in, then repeatedly uploads a picture to /picture and
+# crops it with /save-cropped-image. Reports flows per second, p50/p95/p99
+# for each step and peak RSS per worker.
+#
+#   python -m benchmarks.load [--target client|gunicorn] [--workers 2] [--users 4] [--flows 10]
+#                             [--megapixels 2] [--format JPEG]
+#                             [--output results.json] [--baseline old.json] [--tolerance 0.2]
+#
+# --target client runs the app in this process through the Flask test
+# client, which is quick to start and easy to profile, but shares the GIL
+# with the driver. --target gunicorn starts `gunicorn 'main:create_app()'`
+# with --workers sync workers on a free port, as in production.
+#
+# The run gets its own database and cache folders in a temp dir. Every
+# upload has a few unique bytes after the image data so it is stored and
+# decoded as a new picture rather than matched to an earlier one; the
+# pictures are deleted again at the end. Exits non-zero if any request
+# failed, or with --baseline if something regressed (see benchmarks.report).
+import argparse
+import datetime
+import io
+import os
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+RUN_DIR = tempfile.mkdtemp(prefix='pic_editor_load_')
+os.environ['DB_URI'] = f"sqlite:///{os.path.join(RUN_DIR, 'load.db')}"
+for name in ('UPLOAD_FOLDER', 'RENDITION_FOLDER', 'JOB_RESULT_FOLDER', 'CHUNK_UPLOAD_FOLDER', 'METRICS_DIR'):
+    os.environ[name] = os.path.join(RUN_DIR, name.lower())
+os.environ['CROP_JOB_THREADS'] = '0'
+os.environ['MAIL_SEND_IN_BACKGROUND'] = '0'
+
+from benchmarks.common import get_app, peak_rss_mb
+from benchmarks.images import FORMATS, dimensions, fixture
+from benchmarks.report import check, environment, save, summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = 'load-test'
+MIMETYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'GIF': 'image/gif'}
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+PICTURE_ID = re.compile(r'cropData\.picture_id = (\d+);')
+
+
+class ClientSession:
+    # The Flask test client, in this process
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, url, files=None, **kwargs):
+        if files:
+            kwargs['data'] = {name: (io.BytesIO(content), filename, mimetype)
+                              for name, (filename, content, mimetype) in files.items()}
+        response = self.client.open(url, method=method, **kwargs)
+        try:
+            return response.status_code, response.headers.get('Content-Type', ''), response.get_data()
+        finally:
+            response.close()
+
+
+class HTTPSession:
+    # A real HTTP client, against the gunicorn server
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def request(self, method, url, **kwargs):
+        response = self.session.request(method, self.base_url + url, allow_redirects=False, timeout=300, **kwargs)
+        return response.status_code, response.headers.get('Content-Type', ''), response.content
+
+
+class VirtualUser(threading.Thread):
+    def __init__(self, session, email, picture, fmt, size, flows, start_line):
+        super().__init__()
+        self.session = session
+        self.email = email
+        self.picture = picture
+        self.fmt = fmt
+        self.size = size
+        self.flows = flows
+        self.start_line = start_line
+        self.timings = {'login': [], 'upload': [], 'crop': [], 'flow': []}
+        self.picture_ids = []
+        self.errors = []
+        self.uploads = 0
+
+    def timed(self, step, method, url, **kwargs):
+        start = time.perf_counter()
+        result = self.session.request(method, url, **kwargs)
+        self.timings[step].append(time.perf_counter() - start)
+        return result
+
+    def login(self):
+        status, _, body = self.session.request('GET', '/login')
+        token = CSRF_TOKEN.search(body.decode())
+        if status != 200 or not token:
+            raise AssertionError(f'GET /login: {status}')
+        status, _, _ = self.timed('login', 'POST', '/login',
+                                  data={'csrf_token': token.group(1), 'email': self.email, 'password': PASSWORD})
+        if status != 302:
+            raise AssertionError(f'POST /login: {status}')
+
+    def flow(self):
+        # Unique trailing bytes give the upload its own content hash
+        self.uploads += 1
+        content = self.picture + f'\0{self.email}:{self.uploads}'.encode()
+        start = time.perf_counter()
+        status, _, body = self.timed('upload', 'POST', '/picture', files={
+            'file': (f'load.{self.fmt.lower()}', content, MIMETYPES[self.fmt])})
+        picture_id = PICTURE_ID.search(body.decode(errors='replace'))
+        if status != 200 or not picture_id:
+            raise AssertionError(f'POST /picture: {status}')
+        self.picture_ids.append(int(picture_id.group(1)))
+
+        w, h = self.size
+        status, content_type, body = self.timed('crop', 'POST', '/save-cropped-image', json={
+            'picture_id': self.picture_ids[-1], 'x': w / 4, 'y': h / 4, 'width': w / 2, 'height': h / 2})
+        if status != 200 or not content_type.startswith('image/') or not body:
+            raise AssertionError(f'POST /save-cropped-image: {status} {content_type}')
+        self.timings['flow'].append(time.perf_counter() - start)
+
+    def run(self):
+        try:
+            self.login()
+            # One untimed flow, so first-use imports and caches are out of the way
+            self.flow()
+            for step in ('upload', 'crop', 'flow'):
+                self.timings[step].clear()
+            # Everyone starts the timed flows together
+            self.start_line.wait()
+            for _ in range(self.flows):
+                self.flow()
+        except threading.BrokenBarrierError:
+            self.errors.append(f'{self.email}: another user failed to warm up')
+        except Exception as e:
+            self.start_line.abort()
+            self.errors.append(f'{self.email}: {e}')
+
+
+def create_users(count):
+    from werkzeug.security import generate_password_hash
+    from main import db, User
+    app = get_app()
+
+    emails = [f'load{n}@example.com' for n in range(count)]
+    with app.app_context():
+        password = generate_password_hash(PASSWORD)
+        for email in emails:
+            db.session.add(User(email=email, name='load', password=password,
+                                date_of_signup=datetime.date.today(),
+                                time_of_signup=datetime.datetime.now().time(),
+                                end_date_premium=datetime.date.today(),
+                                premium_level=0, points=0, picture_count=0, verified=True))
+        db.session.commit()
+    return emails
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(workers, port):
+    import requests
+
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--timeout', '300',
+                               '--bind', f'127.0.0.1:{port}', '--log-level', 'warning', 'main:create_app()'],
+                              cwd=ROOT, env=os.environ.copy())
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            sys.exit(f'gunicorn exited with {server.returncode}')
+        try:
+            requests.get(f'http://127.0.0.1:{port}/login', timeout=5)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    server.kill()
+    sys.exit('gunicorn did not start within 60 s')
+
+
+def worker_peak_rss_mb(master_pid):
+    # VmHWM of each gunicorn worker, from /proc (Linux only)
+    peaks = []
+    try:
+        with open(f'/proc/{master_pid}/task/{master_pid}/children') as f:
+            pids = f.read().split()
+        for pid in pids:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        peaks.append(round(int(line.split()[1]) / 1024, 1))
+    except OSError:
+        pass
+    return peaks
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--target', choices=('client', 'gunicorn'), default='client')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--flows', type=int, default=10)
+    parser.add_argument('--megapixels', type=float, default=2)
+    parser.add_argument('--format', choices=FORMATS, default='JPEG')
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    with open(fixture(args.megapixels, args.format), 'rb') as f:
+        picture = f.read()
+    emails = create_users(args.users)
+
+    server = None
+    try:
+        if args.target == 'gunicorn':
+            port = free_port()
+            server = start_gunicorn(args.workers, port)
+            sessions = [HTTPSession(f'http://127.0.0.1:{port}') for _ in emails]
+        else:
+            sessions = [ClientSession(get_app()) for _ in emails]
+
+        start_line = threading.Barrier(args.users + 1)
+        users = [VirtualUser(session, email, picture, args.format, dimensions(args.megapixels), args.flows, start_line)
+                 for session, email in zip(sessions, emails)]
+        for user in users:
+            user.start()
+        try:
+            start_line.wait()
+        except threading.BrokenBarrierError:
+            pass
+        start = time.perf_counter()
+        for user in users:
+            user.join()
+        elapsed = time.perf_counter() - start
+
+        if server:
+            rss = worker_peak_rss_mb(server.pid)
+        else:
+            rss = [round(peak_rss_mb(), 1)]
+
+        # Delete what the run stored, untimed
+        for user in users:
+            for picture_id in user.picture_ids:
+                user.session.request('POST', f'/delete-picture/{picture_id}')
+    finally:
+        if server:
+            server.send_signal(signal.SIGTERM)
+            server.wait(30)
+        shutil.rmtree(RUN_DIR, ignore_errors=True)
+
+    errors = [error for user in users for error in user.errors]
+    for error in errors[:5]:
+        print(f'failed: {error}')
+    if errors:
+        sys.exit(f'{len(errors)} of {args.users} users failed')
+
+    w, h = dimensions(args.megapixels)
+    flows = args.users * args.flows
+    print(f'{args.target}' + (f', {args.workers} workers' if server else '') +
+          f', {args.users} users x {args.flows} flows, {args.format} {w}x{h} ({len(picture) / 1e6:.1f} MB)')
+    print(f"{'step':<8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    cases = []
+    for step in ('login', 'upload', 'crop', 'flow'):
+        case = {'name': step, **summarize([t for user in users for t in user.timings[step]])}
+        cases.append(case)
+        print(f"{step:<8}{case['p50_ms']:>9.1f}{case['p95_ms']:>9.1f}{case['p99_ms']:>9.1f}")
+    cases[-1]['per_s'] = round(flows / elapsed, 2)
+    cases.append({'name': 'workers', 'peak_rss_mb': max(rss, default=None), 'worker_rss_mb': rss})
+    print(f'{flows / elapsed:.2f} flows/s ({flows} in {elapsed:.1f} s), '
+          f"peak RSS per {'worker' if server else 'process'}: {', '.join(f'{mb:.0f} MB' for mb in rss)}")
+
+    if args.output:
+        save(args.output, 'load', args, cases)
+    if args.baseline:
+        current = {'suite': 'load', 'environment': environment(), 'args': vars(args), 'cases': cases}
+        sys.exit(1 if check(args.baseline, current, args.tolerance) else 0)
+
+
+if __name__ == '__main__':
+    main()
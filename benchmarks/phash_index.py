@@ -0,0 +1,74 @@
+# Build time, memory and query latency of the near-duplicate HashIndex as
+# the number of hashes grows, checked against a brute-force scan.
+#
+#   python -m benchmarks.phash_index [--sizes 1000 10000 100000 1000000] [--queries 200]
+#
+# Hashes are random 64-bit values, the worst case for the index, with a
+# cluster of near-duplicates planted around each query.
+import argparse
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+from benchmarks.report import percentile
+from phash import HashIndex, hamming
+
+
+def run(count, queries, distances, rng):
+    hashes = [rng.getrandbits(64) for _ in range(count)]
+    probes = rng.sample(range(count), min(queries, count))
+    # Near-duplicates of each probe, a few bits away
+    for n, probe in enumerate(probes):
+        for extra in range(3):
+            flipped = hashes[probe]
+            for bit in rng.sample(range(64), rng.randint(1, max(distances))):
+                flipped ^= 1 << bit
+            hashes[(probe + extra + 1) % count] = flipped
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    index = HashIndex(enumerate(hashes))
+    build = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0] / 1024 / 1024
+    tracemalloc.stop()
+
+    failures = 0
+    for distance in distances:
+        # First touch of the arrays and the flip masks is a one-off cost
+        index.search(hashes[0], distance)
+        timings = []
+        for probe in probes:
+            start = time.perf_counter()
+            index.search(hashes[probe], distance)
+            timings.append(time.perf_counter() - start)
+        # Brute force on a sample of probes; too slow to do for all at 1M
+        for probe in probes[:5]:
+            expected = sorted(key for key, value in enumerate(hashes) if hamming(value, hashes[probe]) <= distance)
+            if sorted(key for key, _ in index.search(hashes[probe], distance)) != expected:
+                failures += 1
+        print(f"{count:>9}{distance:>6}{build:>9.2f}{memory:>9.1f}"
+              f"{statistics.median(timings) * 1000:>9.3f}{percentile(timings, 0.99) * 1000:>9.3f}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--distances', type=int, nargs='+', default=[4, 6, 10])
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    failures = 0
+    print(f"{'hashes':>9}{'k':>6}{'build s':>9}{'MB':>9}{'p50 ms':>9}{'p99 ms':>9}")
+    for count in args.sizes:
+        failures += run(count, args.queries, args.distances, rng)
+    if failures:
+        print(f'{failures} searches disagreed with brute force')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# Micro-benchmarks for each step of a crop, on the synthetic images from
+# benchmarks.images: decode, crop and encode exactly as crop_image() runs
+# them for /save-cropped-image, and the legacy base64 data URL submission
+# as save_cropped_image handles it (form parse, split, b64decode).
+#
+#   python -m benchmarks.pipeline [--sizes 0.5 2 12 50] [--formats JPEG PNG GIF] [--repeat 5]
+#                                 [--output results.json] [--baseline old.json] [--tolerance 0.2]
+#
+# Each (format, size) runs in its own process so peak RSS is per case.
+# With --baseline, exits non-zero if a step regressed (see benchmarks.report).
+import argparse
+import base64
+import json
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from urllib.parse import parse_qsl, quote
+
+from benchmarks.common import peak_rss_mb
+from benchmarks.images import FORMATS, dimensions, fixture
+from benchmarks.report import check, environment, save, summarize
+from imaging import crop_image, parse_crop_box
+
+STEPS = ('decode', 'crop', 'encode', 'base64')
+
+
+def legacy_submission(body):
+    # What save_cropped_image does with the urlencoded data URL form
+    form = dict(parse_qsl(body.decode(), keep_blank_values=True))
+    header, image_data = form['cropped_image'].split(',', 1)
+    return base64.b64decode(image_data)
+
+
+def run_case(fmt, megapixels, repeat):
+    path = fixture(megapixels, fmt)
+    w, h = dimensions(megapixels)
+    # The middle half of the picture, as a Cropper.js getData() box
+    box = parse_crop_box({'x': w / 4, 'y': h / 4, 'width': w / 2, 'height': h / 2})
+
+    timings = {step: [] for step in STEPS}
+    totals = []
+
+    @contextmanager
+    def stage(name):
+        start = time.perf_counter()
+        yield
+        timings[name].append(time.perf_counter() - start)
+
+    # One untimed run first, so the file is in the page cache
+    for n in range(repeat + 1):
+        if n == 1:
+            for step in timings:
+                timings[step].clear()
+        start = time.perf_counter()
+        output, mimetype = crop_image(path, box, stage=stage)
+        cropped = output.getvalue()
+
+        data_url = f'data:{mimetype};base64,' + base64.b64encode(cropped).decode()
+        body = ('cropped_image=' + quote(data_url, safe='') + '&original_filename=bench.png').encode()
+        del data_url
+        with stage('base64'):
+            decoded = legacy_submission(body)
+        assert decoded == cropped
+        del body, decoded
+        if n:
+            totals.append(time.perf_counter() - start)
+
+    label = f'{fmt} {megapixels:g}mp'
+    cases = [{'name': f'{label} {step}', **summarize(timings[step])} for step in STEPS]
+    cases.append({'name': f'{label} total', **summarize(totals), 'per_s': round(len(totals) / sum(totals), 3),
+                  'output_kb': round(len(cropped) / 1024), 'peak_rss_mb': round(peak_rss_mb(), 1)})
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=float, nargs='+', default=[0.5, 2, 12, 50])
+    parser.add_argument('--formats', nargs='+', default=list(FORMATS), choices=FORMATS)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--case', nargs=2, metavar=('FORMAT', 'MEGAPIXELS'))
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(args.case[0], float(args.case[1]), args.repeat)))
+        return
+
+    print(f"{'case':<16}" + ''.join(f'{step + " p50":>13}' for step in STEPS)
+          + f"{'total p95':>11}{'total p99':>11}{'crops/s':>9}{'peak MB':>9}")
+    cases = []
+    for megapixels in args.sizes:
+        for fmt in args.formats:
+            # Made here, so making the image doesn't count towards the case's peak RSS
+            fixture(megapixels, fmt)
+            result = subprocess.run([sys.executable, '-m', 'benchmarks.pipeline', '--case', fmt, str(megapixels),
+                                     '--repeat', str(args.repeat)], capture_output=True, text=True)
+            if result.returncode:
+                sys.exit(result.stderr)
+            case = json.loads(result.stdout)
+            cases += case
+            steps, total = case[:-1], case[-1]
+            print(f"{fmt + f' {megapixels:g} MP':<16}" + ''.join(f"{step['p50_ms']:>13.1f}" for step in steps)
+                  + f"{total['p95_ms']:>11.1f}{total['p99_ms']:>11.1f}{total['per_s']:>9.2f}{total['peak_rss_mb']:>9.0f}")
+    print('times in ms')
+
+    if args.output:
+        save(args.output, 'pipeline', args, cases)
+    if args.baseline:
+        current = {'suite': 'pipeline', 'environment': environment(), 'args': vars(args), 'cases': cases}
+        sys.exit(1 if check(args.baseline, current, args.tolerance) else 0)
+
+
+if __name__ == '__main__':
+    main()
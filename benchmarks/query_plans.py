@@ -0,0 +1,127 @@
+# Query-plan regression check for the hot lookups. Drives the auth,
+# dashboard, library, cropper and feedback routes, records every SELECT
+# they run, and asks the database how it would execute each one: EXPLAIN
+# QUERY PLAN on SQLite, EXPLAIN (with sequential scans discouraged) on
+# PostgreSQL. Exits non-zero if any of them reads a whole table.
+#
+#   python -m benchmarks.query_plans            # throwaway SQLite database
+#   DB_URI=postgresql://... python -m benchmarks.query_plans
+#
+# The PostgreSQL database should be an empty scratch one; rows are added.
+import io
+import os
+import re
+import sys
+
+os.environ.setdefault('CROP_JOB_THREADS', '0')
+
+from PIL import Image
+from sqlalchemy import event
+
+from benchmarks.common import get_app, logged_in_client
+
+# Tables small and bounded enough that a scan is the right plan
+SCAN_ALLOWED = set()
+
+ROUTES = [
+    ('POST', '/login', {'email': 'plans@example.com', 'password': 'wrong'}),
+    ('POST', '/register', {'email': 'plans@example.com', 'password': 'x', 'name': 'plans'}),
+    ('POST', '/resend-verification', {'email': 'plans@example.com'}),
+    ('GET', '/verify/not-a-token', None),
+    ('GET', '/user-dashboard', None),
+    ('GET', '/library', None),
+    ('GET', '/api/pictures', None),
+    ('GET', '/picture/{picture_id}/thumbnail', None),
+    ('GET', '/crop-picture/{picture_id}', None),
+    ('GET', '/picture/{picture_id}/similar', None),
+    ('GET', '/feedback', None),
+    ('POST', '/upvote/{feedback_id}', None),
+    # Last, so the seeded picture's original and previews are removed again
+    ('POST', '/delete-picture/{picture_id}', None),
+]
+
+
+def capture(engine):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT') and not executemany:
+            statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', record)
+    return statements
+
+
+def seed(client):
+    from main import db, Feedback
+    app = get_app()
+
+    image = io.BytesIO()
+    Image.new('RGB', (1200, 800), (40, 90, 160)).save(image, 'JPEG')
+    image.seek(0)
+    response = client.post('/picture', data={'file': (image, 'plans.jpg')}, content_type='multipart/form-data')
+    picture_id = int(re.search(rb'picture_id = (\d+)', response.data).group(1))
+    with app.app_context():
+        feedback = Feedback(user_id=1, title='Plans', feedback='', upvote_count=0)
+        db.session.add(feedback)
+        db.session.commit()
+        return {'picture_id': picture_id, 'feedback_id': feedback.id}
+
+
+def full_scans_sqlite(conn, statement, parameters):
+    rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+    plan = [row[-1] for row in rows]
+    scans = []
+    for detail in plan:
+        match = re.match(r'SCAN (\w+)(?: AS \w+)?$', detail)
+        if match and match.group(1) not in SCAN_ALLOWED:
+            scans.append(match.group(1))
+    return scans, plan
+
+
+def full_scans_postgresql(conn, statement, parameters):
+    # Tables here are tiny, so the planner would scan them anyway; with
+    # sequential scans priced out, one is only chosen if no index fits
+    conn.exec_driver_sql('SET enable_seqscan = off')
+    plan = [row[0] for row in conn.exec_driver_sql('EXPLAIN ' + statement, parameters).all()]
+    scans = [table for table in re.findall(r'Seq Scan on (\w+)', '\n'.join(plan)) if table not in SCAN_ALLOWED]
+    return scans, plan
+
+
+def main():
+    from main import db
+    app = get_app()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    client = logged_in_client('plans@example.com')
+    ids = seed(client)
+
+    with app.app_context():
+        statements = capture(db.engine)
+    for method, url, form in ROUTES:
+        response = client.open(url.format(**ids), method=method, data=form)
+        assert response.status_code < 500, (url, response.status_code)
+
+    checked = set()
+    failures = 0
+    with app.app_context(), db.engine.connect() as conn:
+        dialect = conn.dialect.name
+        explain = full_scans_postgresql if dialect == 'postgresql' else full_scans_sqlite
+        for statement, parameters in statements:
+            if statement in checked:
+                continue
+            checked.add(statement)
+            scans, plan = explain(conn, statement, parameters)
+            if scans:
+                failures += 1
+                print(f"FULL SCAN of {', '.join(scans)}:\n  {' '.join(statement.split())}")
+                for line in plan:
+                    print(f'    {line}')
+        conn.rollback()
+
+    print(f'{len(checked)} distinct queries checked on {dialect}, {failures} with full scans')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
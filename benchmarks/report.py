@@ -0,0 +1,119 @@
+# Results files for the image pipeline benchmarks, so two runs can be
+# compared. A results file is JSON:
+#
+#   {"suite": ..., "environment": {...}, "args": {...},
+#    "cases": [{"name": ..., "p50_ms": ..., "per_s": ..., "peak_rss_mb": ...}, ...]}
+#
+# Compare a run with a saved baseline; exits non-zero if any case got
+# slower, lost throughput or used more memory than the tolerance allows:
+#
+#   python -m benchmarks.report BASELINE.json CURRENT.json [--tolerance 0.2]
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+
+import PIL
+
+# Metrics where a smaller number is better; per_s metrics are the other way
+LOWER_IS_BETTER = ('p50_ms', 'p95_ms', 'p99_ms', 'peak_rss_mb')
+HIGHER_IS_BETTER = ('per_s',)
+
+# Arguments that don't change what is measured
+OUTPUT_ARGS = ('output', 'baseline', 'tolerance', 'case')
+
+# Differences below these are noise, whatever the ratio
+FLOORS = {'p50_ms': 2.0, 'p95_ms': 5.0, 'p99_ms': 10.0, 'peak_rss_mb': 10.0, 'per_s': 0.0}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(seconds):
+    # p50/p95/p99 in milliseconds for a list of timings in seconds
+    return {f'p{round(fraction * 100)}_ms': round(percentile(seconds, fraction) * 1000, 2)
+            for fraction in (0.5, 0.95, 0.99)}
+
+
+def environment():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=root, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+    }
+
+
+def save(path, suite, args, cases):
+    with open(path, 'w') as f:
+        json.dump({'suite': suite, 'environment': environment(), 'args': vars(args), 'cases': cases}, f, indent=2)
+        f.write('\n')
+
+
+def compare(baseline, current, tolerance):
+    # Messages for each metric that regressed by more than tolerance (0.2 = 20%)
+    if baseline['suite'] != current['suite']:
+        return [f"different suites: {baseline['suite']} and {current['suite']}"]
+    old_cases = {case['name']: case for case in baseline['cases']}
+    regressions = []
+    for case in current['cases']:
+        old = old_cases.get(case['name'])
+        if not old:
+            continue
+        for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            if old.get(metric) is None or case.get(metric) is None:
+                continue
+            change = case[metric] - old[metric]
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            if change > max(old[metric] * tolerance, FLOORS[metric]):
+                regressions.append(f"{case['name']} {metric}: {old[metric]} -> {case[metric]}")
+    return regressions
+
+
+def check(baseline_path, current, tolerance):
+    # Prints regressions against a saved baseline, returns how many there were
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    different = sorted(name for name in set(baseline['args']) | set(current['args'])
+                       if name not in OUTPUT_ARGS and baseline['args'].get(name) != current['args'].get(name))
+    if different:
+        print(f"note: baseline ran with different {', '.join(different)}")
+    if baseline['environment'].get('cpus') != current['environment'].get('cpus'):
+        print(f"note: baseline ran on {baseline['environment'].get('cpus')} CPUs, "
+              f"this run on {current['environment'].get('cpus')}")
+    regressions = compare(baseline, current, tolerance)
+    for message in regressions:
+        print(f'regression: {message}')
+    if not regressions:
+        print(f"no regressions against {baseline['environment'].get('commit') or baseline_path}")
+    return len(regressions)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    with open(args.current) as f:
+        current = json.load(f)
+    sys.exit(1 if check(args.baseline, current, args.tolerance) else 0)
+
+
+if __name__ == '__main__':
+    main()
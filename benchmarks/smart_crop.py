@@ -0,0 +1,123 @@
+# Accuracy and speed of the local smart-crop engine.
+#
+#   python -m benchmarks.smart_crop [--megapixels 24] [--repeat 5]
+#
+# The fixtures are drawn on the fly so no binary files are checked in. Each
+# has a subject on a lightly noisy background and the box the engine is
+# expected to frame it with, or a list of boxes where two subjects are
+# equally good; a result passes at IoU >= 0.7 with one of them.
+import argparse
+import io
+import statistics
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from smart_crop import smart_crop
+
+MIN_IOU = 0.7
+
+
+def face_right(draw, w, h):
+    draw.ellipse((int(w * 0.70), int(h * 0.30), int(w * 0.85), int(h * 0.60)), fill=(224, 172, 140))
+
+
+def stripes_left(draw, w, h):
+    for x in range(int(w * 0.05), int(w * 0.30), max(2, w // 100)):
+        draw.line((x, int(h * 0.2), x, int(h * 0.7)), fill=(10, 10, 10), width=max(1, w // 300))
+
+
+def face_top_portrait(draw, w, h):
+    draw.ellipse((int(w * 0.35), int(h * 0.08), int(w * 0.65), int(h * 0.30)), fill=(210, 160, 125))
+
+
+def two_faces(draw, w, h):
+    # Mirror images of each other, so the window sums tie between them
+    for left in (0.08, 0.77):
+        draw.ellipse((int(w * left), int(h * 0.30), int(w * (left + 0.15)), int(h * 0.60)), fill=(224, 172, 140))
+
+
+def checker_bottom(draw, w, h):
+    step = max(4, w // 60)
+    for y in range(int(h * 0.6), int(h * 0.95), step):
+        for x in range(int(w * 0.40), int(w * 0.75), step):
+            if (x // step + y // step) % 2:
+                draw.rectangle((x, y, x + step - 1, y + step - 1), fill=(250, 250, 250))
+
+
+# name, size (w, h), background, painter, aspect, expected box (or boxes) as fractions (x, y, w, h)
+FIXTURES = [
+    ('face_right_square', (1200, 800), (70, 110, 150), face_right, 1.0, (0.575, 0.15, 0.4, 0.6)),
+    ('stripes_left_wide', (1200, 800), (200, 200, 190), stripes_left, 16 / 9, (0.0, 0.155, 0.7, 0.59)),
+    ('face_top_portrait', (800, 1200), (40, 60, 40), face_top_portrait, 1.0, (0.2, 0.0, 0.6, 0.4)),
+    ('checker_bottom_square', (1600, 900), (30, 30, 60), checker_bottom, 1.0, (0.294, 0.0, 0.5625, 1.0)),
+    ('two_faces_square', (1600, 800), (70, 110, 150), two_faces, 1.0,
+     [(0.036, 0.15, 0.3, 0.6), (0.664, 0.15, 0.3, 0.6)]),
+    ('face_right_portrait', (1200, 800), (90, 90, 90), face_right, 2 / 3, (0.642, 0.15, 0.267, 0.6)),
+]
+
+
+def render(size, background, painter, fmt='JPEG'):
+    rng = np.random.default_rng(0)
+    noise = rng.normal(0, 3, (size[1], size[0], 3))
+    base = np.clip(np.array(background, dtype=np.float32) + noise, 0, 255).astype(np.uint8)
+    img = Image.fromarray(base)
+    painter(ImageDraw.Draw(img), *size)
+    output = io.BytesIO()
+    img.save(output, fmt, quality=90)
+    return output.getvalue()
+
+
+def iou(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    iw = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    ih = max(0, min(ay + ah, by + bh) - max(ay, by))
+    inter = iw * ih
+    return inter / (aw * ah + bw * bh - inter)
+
+
+def check_fixtures():
+    failures = 0
+    print(f"{'fixture':<24}{'IoU':>6}  result")
+    for name, size, background, painter, aspect, expected in FIXTURES:
+        box = smart_crop(io.BytesIO(render(size, background, painter)), aspect)
+        w, h = size
+        found = (box['x'] / w, box['y'] / h, box['width'] / w, box['height'] / h)
+        score = max(iou(found, choice) for choice in (expected if isinstance(expected, list) else [expected]))
+        ok = score >= MIN_IOU
+        failures += not ok
+        print(f"{name:<24}{score:>6.2f}  {'ok' if ok else 'FAIL'} {box}")
+    return failures
+
+
+def time_large(megapixels, repeat):
+    w = int((megapixels * 1e6 * 1.5) ** 0.5)
+    h = int(w / 1.5)
+    for fmt in ('JPEG', 'PNG'):
+        data = render((w, h), (70, 110, 150), face_right, fmt)
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            smart_crop(io.BytesIO(data), 16 / 9)
+            timings.append(time.perf_counter() - start)
+        print(f"{fmt} {w}x{h}: median {statistics.median(timings) * 1000:.1f} ms, "
+              f"best {min(timings) * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--megapixels', type=float, default=24)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    failures = check_fixtures()
+    print()
+    time_large(args.megapixels, args.repeat)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+# Engine profiles, picked from the database URI unless DB_PROFILE names one:
+#
+#   sqlite      WAL journal, so readers never block the writer and several
+#               gunicorn workers can share one file, with a busy timeout so
+#               a writer waits its turn instead of failing with "database is
+#               locked". WAL needs every process on the same host, which is
+#               how the small deployments run.
+#   postgresql  A pool per worker sized so all workers together stay under
+#               the server's max_connections, connections checked before
+#               use and replaced before the server or a proxy drops them,
+#               and a statement timeout so one bad query can't hold a
+#               worker forever.
+#   none        SQLAlchemy's defaults.
+PROFILES = ('sqlite', 'postgresql', 'none')
+
+
+def profile_for(uri, name='auto'):
+    if name != 'auto':
+        if name not in PROFILES:
+            raise ValueError(f'Unknown database profile {name!r}, expected auto or one of {", ".join(PROFILES)}')
+        return name
+    backend = make_url(uri).get_backend_name()
+    return backend if backend in PROFILES else 'none'
+
+
+def pool_size(workers, threads, max_connections):
+    # (pool_size, max_overflow) for each worker process. `threads` is how
+    # many threads in one process can use the database at once.
+    per_worker = max(1, max_connections // max(1, workers))
+    size = min(threads, per_worker)
+    return size, min(threads, per_worker - size)
+
+
+def engine_options(profile, workers=1, threads=1, max_connections=90, pool_recycle=1800, pool_timeout=10,
+                   statement_timeout_ms=30000):
+    # SQLALCHEMY_ENGINE_OPTIONS for a profile
+    if profile != 'postgresql':
+        return {}
+    size, overflow = pool_size(workers, threads, max_connections)
+    options = {
+        'pool_size': size,
+        'max_overflow': overflow,
+        'pool_pre_ping': True,
+        'pool_recycle': pool_recycle,
+        'pool_timeout': pool_timeout,
+    }
+    if statement_timeout_ms:
+        options['connect_args'] = {'options': f'-c statement_timeout={int(statement_timeout_ms)}'}
+    return options
+
+
+def sqlite_pragmas(busy_timeout_ms=15000, mmap_mb=128):
+    # Run on every new connection; journal_mode is stored in the file, the
+    # rest only last as long as the connection
+    return {
+        # First, so switching to WAL waits out another process's write too
+        'busy_timeout': int(busy_timeout_ms),
+        'journal_mode': 'WAL',
+        # Durable at each checkpoint rather than each commit; safe in WAL
+        'synchronous': 'NORMAL',
+        'mmap_size': int(mmap_mb) * 1024 * 1024,
+    }
+
+
+def tune_engine(engine, profile, pragmas):
+    # Sets the SQLite pragmas on each connection the engine opens
+    if profile != 'sqlite' or engine.dialect.name != 'sqlite':
+        return
+    in_memory = engine.url.database in (None, '', ':memory:')
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                if name == 'journal_mode' and in_memory:
+                    continue
+                cursor.execute(f'PRAGMA {name} = {value}')
+        finally:
+            cursor.close()
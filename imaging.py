@@ -0,0 +1,346 @@
+import math
+import re
+import warnings
+from collections import namedtuple
+from contextlib import nullcontext
+from io import BytesIO
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+
+# Mimetypes and file extensions for the formats we can write
+MIMETYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'GIF': 'image/gif',
+    'WEBP': 'image/webp',
+    'AVIF': 'image/avif',
+}
+OUTPUT_EXTENSIONS = {
+    'JPEG': '.jpg',
+    'PNG': '.png',
+    'GIF': '.gif',
+    'WEBP': '.webp',
+    'AVIF': '.avif',
+}
+
+# Output choices offered to the user. "source" keeps the original's format.
+OUTPUT_FORMATS = {
+    'source': None,
+    'jpeg': 'JPEG',
+    'webp': 'WEBP',
+    'avif': 'AVIF',
+}
+DEFAULT_QUALITY = {
+    'JPEG': 90,
+    'WEBP': 80,
+    'AVIF': 60,
+}
+# strip: no metadata, icc: colour profile only, all: colour profile and EXIF
+METADATA_MODES = ('strip', 'icc', 'all')
+
+EXIF_ORIENTATION = 0x0112
+
+
+# Long edges of the preview levels the cropper can load instead of the original
+PREVIEW_LEVELS = (800, 1600, 3200)
+# Long edge of the library thumbnails, made in the same pass as the previews
+THUMBNAIL_SIZE = 320
+
+
+ImageInfo = namedtuple('ImageInfo', ['format', 'width', 'height', 'mode', 'frames'])
+
+
+class CropError(ValueError):
+    pass
+
+
+class ProbeError(ValueError):
+    pass
+
+
+def probe_image(source):
+    # Format, size, mode and frame count from the file header only; no pixel
+    # data is decoded. Size limits are left to the caller, so Pillow's own
+    # decompression-bomb check is only a backstop here.
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+            with Image.open(source) as img:
+                return ImageInfo(img.format, img.width, img.height, img.mode, getattr(img, 'n_frames', 1))
+    except Image.DecompressionBombError as e:
+        raise ProbeError(str(e))
+    except (UnidentifiedImageError, OSError, SyntaxError):
+        raise ProbeError('File is not a readable image')
+
+
+# Widest and tallest aspect ratios accepted, as width / height
+MAX_ASPECT = 100
+
+
+def parse_aspect(text):
+    # "16:9" as a width / height ratio
+    parts = str(text).split(':')
+    try:
+        if len(parts) != 2:
+            raise ValueError
+        width, height = float(parts[0]), float(parts[1])
+        if not (math.isfinite(width) and math.isfinite(height) and width > 0 and height > 0):
+            raise ValueError
+    except ValueError:
+        raise CropError('Aspect must look like 16:9')
+    aspect = width / height
+    if not 1 / MAX_ASPECT <= aspect <= MAX_ASPECT:
+        raise CropError(f'Aspect must be between 1:{MAX_ASPECT} and {MAX_ASPECT}:1')
+    return aspect
+
+
+def parse_crop_box(data):
+    # Accepts the object returned by Cropper.js getData(): x, y, width, height,
+    # rotate, scaleX, scaleY. A single "scale" key is applied to both axes.
+    try:
+        box = {
+            'x': float(data['x']),
+            'y': float(data['y']),
+            'width': float(data['width']),
+            'height': float(data['height']),
+            'rotate': float(data.get('rotate') or 0),
+            'scaleX': float(data.get('scaleX', data.get('scale', 1)) or 1),
+            'scaleY': float(data.get('scaleY', data.get('scale', 1)) or 1),
+        }
+    except (KeyError, TypeError, ValueError):
+        raise CropError('Crop box needs numeric x, y, width and height')
+    # float() also takes nan, inf and 1e400, which can't be rounded to pixels
+    if not all(math.isfinite(value) for value in box.values()):
+        raise CropError('Crop box values must be finite numbers')
+    if box['width'] < 1 or box['height'] < 1:
+        raise CropError('Crop box is empty')
+    return box
+
+
+def apply_crop(img, box):
+    # Same order Cropper.js uses for getCroppedCanvas(): orientation as the
+    # browser displays it, then flip, then rotate, then cut out the box.
+    img = ImageOps.exif_transpose(img)
+    if box['scaleX'] < 0:
+        img = img.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    if box['scaleY'] < 0:
+        img = img.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+    if box['rotate'] % 360:
+        # Cropper rotates clockwise, Pillow counter-clockwise
+        img = img.rotate(-box['rotate'], expand=True, resample=Image.Resampling.BICUBIC)
+
+    left = max(0, round(box['x']))
+    top = max(0, round(box['y']))
+    right = min(img.width, round(box['x'] + box['width']))
+    bottom = min(img.height, round(box['y'] + box['height']))
+    if right <= left or bottom <= top:
+        raise CropError('Crop box is outside the image')
+    return img.crop((left, top, right, bottom))
+
+
+def rotated_size(width, height, degrees):
+    # Canvas apply_crop() rotates onto; expand=True grows it to fit the corners
+    radians = math.radians(degrees % 360)
+    cos, sin = abs(math.cos(radians)), abs(math.sin(radians))
+    return math.ceil(width * cos + height * sin), math.ceil(width * sin + height * cos)
+
+
+def parse_encode_options(data):
+    # Output format, quality and metadata handling from a crop request
+    output = data.get('output') or 'source'
+    if output not in OUTPUT_FORMATS:
+        raise CropError(f'Unknown output format: {output}')
+    metadata = data.get('metadata') or 'icc'
+    if metadata not in METADATA_MODES:
+        raise CropError(f'Metadata must be one of {", ".join(METADATA_MODES)}')
+    quality = data.get('quality')
+    if quality not in (None, ''):
+        try:
+            quality = int(quality)
+        except (TypeError, ValueError):
+            raise CropError('Quality must be a number from 1 to 100')
+        if not 1 <= quality <= 100:
+            raise CropError('Quality must be a number from 1 to 100')
+    else:
+        quality = None
+    return {'format': OUTPUT_FORMATS[output], 'quality': quality, 'metadata': metadata}
+
+
+def source_metadata(img):
+    # ICC profile and EXIF of an opened original. Orientation is dropped from
+    # the EXIF because the pixels are written already rotated.
+    exif = img.getexif()
+    if not exif:
+        return img.info.get('icc_profile'), None
+    # Work on a copy; exif_transpose() still needs the original's orientation
+    exif_copy = Image.Exif()
+    exif_copy.load(exif.tobytes())
+    exif_copy.pop(EXIF_ORIENTATION, None)
+    return img.info.get('icc_profile'), exif_copy.tobytes()
+
+
+def encode_image(img, fmt, quality=None, metadata='icc', icc_profile=None, exif=None):
+    # Encodes to a file-like object positioned at the start
+    save_kwargs = {}
+    quality = quality or DEFAULT_QUALITY.get(fmt)
+    if fmt == 'JPEG':
+        img = flatten(img)
+        # Full chroma resolution only where the quality asked for is high
+        save_kwargs.update(quality=quality, optimize=True, progressive=True,
+                           subsampling='4:4:4' if quality >= 90 else '4:2:0')
+    elif fmt == 'WEBP':
+        save_kwargs.update(quality=quality, method=4)
+    elif fmt == 'AVIF':
+        if not features.check('avif'):
+            raise CropError('AVIF output is not available on this server')
+        save_kwargs.update(quality=quality)
+    elif fmt == 'GIF' and img.mode not in ('P', 'L'):
+        img = img.convert('P', palette=Image.Palette.ADAPTIVE)
+
+    if metadata in ('icc', 'all') and icc_profile and fmt != 'GIF':
+        save_kwargs['icc_profile'] = icc_profile
+    if metadata == 'all' and exif and fmt != 'GIF':
+        save_kwargs['exif'] = exif
+
+    output = BytesIO()
+    img.save(output, fmt, **save_kwargs)
+    output.seek(0)
+    return output
+
+
+def crop_image(source, box, fmt=None, quality=None, metadata='icc', stage=nullcontext):
+    # Crops an original and encodes it, in its own format unless fmt is given.
+    # Returns a file-like object positioned at the start and its mimetype.
+    # stage(name) wraps the decode, crop and encode steps, for timing them.
+    with Image.open(source) as img:
+        with stage('decode'):
+            img.load()
+        fmt = fmt or img.format
+        icc_profile, exif = source_metadata(img)
+        with stage('crop'):
+            cropped = apply_crop(img, box)
+        with stage('encode'):
+            output = encode_image(cropped, fmt, quality, metadata, icc_profile, exif)
+    return output, MIMETYPES.get(fmt, 'application/octet-stream')
+
+
+def preview_levels(width, height):
+    # Levels worth having for an original of this size
+    return [level for level in PREVIEW_LEVELS if level < max(width, height)]
+
+
+def flatten(img):
+    # RGB for JPEG output, with transparency composited onto white
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    return img.convert('RGB')
+
+
+def build_previews(source, levels, stage=nullcontext):
+    # Yields (level, file) for each level, largest first, as displayed
+    # (EXIF orientation applied). thumbnail() calls draft() first, so a JPEG
+    # is decoded at the smallest DCT scale that still covers the largest
+    # level, then shrunk with reduce() before the final resample. Each
+    # smaller level is made from the one before it, not from the original.
+    # stage(name) wraps the decode, resize and encode steps, for timing them.
+    levels = sorted(levels, reverse=True)
+    with Image.open(source) as img:
+        with stage('decode'):
+            img.thumbnail((levels[0], levels[0]), Image.Resampling.LANCZOS, reducing_gap=2.0)
+            img = flatten(ImageOps.exif_transpose(img))
+
+    for level in levels:
+        with stage('resize'):
+            img.thumbnail((level, level), Image.Resampling.LANCZOS, reducing_gap=2.0)
+        with stage('encode'):
+            output = BytesIO()
+            img.save(output, 'JPEG', quality=85, optimize=True)
+            output.seek(0)
+        yield level, output
+
+
+# Size labels become part of ZIP entry names, so only plain word characters
+LABEL_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,40}')
+# Longest side an export size or batch resolution may ask for
+MAX_OUTPUT_SIDE = 16384
+
+
+def check_output_size(width, height, max_pixels):
+    # Outputs are held decoded while they are made, so they get the same
+    # area limit as the originals we accept
+    if width < 1 or height < 1:
+        raise CropError('Sizes must be at least 1x1')
+    if width > MAX_OUTPUT_SIDE or height > MAX_OUTPUT_SIDE:
+        raise CropError(f'Sizes can be at most {MAX_OUTPUT_SIDE} pixels on a side')
+    if width * height > max_pixels:
+        raise CropError(f'Sizes can be at most {max_pixels // 1_000_000} megapixels')
+
+
+def parse_export_sizes(sizes, max_pixels):
+    # A preset's sizes: [{"label": "post", "width": 1080, "height": 1080,
+    # "output": "jpeg", "quality": 85}, ...]. output and quality are optional.
+    if not isinstance(sizes, list) or not sizes:
+        raise CropError('A preset needs at least one size')
+    parsed = []
+    for size in sizes:
+        try:
+            target = {
+                'label': str(size['label']),
+                'width': int(size['width']),
+                'height': int(size['height']),
+            }
+            target.update(parse_encode_options(size))
+        except (KeyError, TypeError, ValueError):
+            raise CropError('Each size needs a label, width and height')
+        check_output_size(target['width'], target['height'], max_pixels)
+        if not LABEL_PATTERN.fullmatch(target['label']):
+            raise CropError('Size labels must be 1 to 40 letters, digits, - or _')
+        if any(other['label'] == target['label'] for other in parsed):
+            raise CropError(f"Size label {target['label']} is used twice")
+        parsed.append(target)
+    return parsed
+
+
+def cover(img, width, height):
+    # Centre-crops img to the target's aspect ratio, then scales to fit exactly
+    aspect = width / height
+    if img.width / img.height > aspect:
+        crop_width, crop_height = round(img.height * aspect), img.height
+    else:
+        crop_width, crop_height = img.width, round(img.width / aspect)
+    left = (img.width - crop_width) // 2
+    top = (img.height - crop_height) // 2
+    if (crop_width, crop_height) != img.size:
+        img = img.crop((left, top, left + crop_width, top + crop_height))
+    if img.size != (width, height):
+        img = img.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    return img
+
+
+def export_sizes(source, box, targets):
+    # Yields (target, file, format) for every target from one decode of the
+    # original. Targets are made largest first and each is scaled from the
+    # smallest earlier output with the same aspect ratio that is still big
+    # enough, rather than from the full-resolution crop every time.
+    with Image.open(source) as img:
+        source_format = img.format
+        icc_profile, exif = source_metadata(img)
+        region = apply_crop(img, box)
+        region.load()
+
+    made = []
+    for target in sorted(targets, key=lambda t: t['width'] * t['height'], reverse=True):
+        width, height = target['width'], target['height']
+        base = region
+        for previous in made:
+            if (previous.width * height == previous.height * width
+                    and previous.width >= width and previous.width < base.width):
+                base = previous
+        resized = cover(base, width, height)
+        made.append(resized)
+
+        fmt = target['format'] or source_format
+        yield target, encode_image(resized, fmt, target['quality'], target['metadata'], icc_profile, exif), fmt
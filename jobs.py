@@ -0,0 +1,178 @@
+import datetime
+import os
+import socket
+import threading
+import time
+import traceback
+
+
+def worker_name(suffix):
+    return f"{socket.gethostname()}:{os.getpid()}:{suffix}"
+
+
+class JobRunner:
+    # Runs queued CropJob rows on local threads. Jobs are claimed with a
+    # single conditional UPDATE, so any number of threads and processes can
+    # share the table without a broker. A claimed job holds a lease that is
+    # renewed by a heartbeat thread while the handler runs; if its worker
+    # dies the lease runs out and another worker picks the job up again, up
+    # to max_attempts.
+    # `periodic` is a list of (seconds, function) maintenance tasks, run
+    # between jobs by whichever worker thread gets to them first.
+
+    def __init__(self, db, job_model, handlers, threads=1, lease_seconds=120, poll_seconds=1.0, periodic=()):
+        self.app = None
+        self.db = db
+        self.Job = job_model
+        self.handlers = handlers
+        self.threads = threads
+        self.lease = datetime.timedelta(seconds=lease_seconds)
+        self.poll_seconds = poll_seconds
+        self._started_pid = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._periodic = [[seconds, function, time.monotonic()] for seconds, function in periodic]
+        self._periodic_lock = threading.Lock()
+
+    def init_app(self, app):
+        # The app whose context jobs run in
+        self.app = app
+
+    def ensure_started(self):
+        # Called on every request; starts the threads once per process,
+        # including after a fork
+        if self._started_pid == os.getpid() or self.threads < 1:
+            return
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            for n in range(self.threads):
+                threading.Thread(target=self.run_forever, args=(worker_name(n),), daemon=True,
+                                 name=f'crop-job-{n}').start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run_forever(self, worker_id):
+        while not self._stop.is_set():
+            try:
+                self.run_periodic()
+                ran = self.run_one(worker_id)
+            except Exception:
+                traceback.print_exc()
+                ran = False
+            if not ran:
+                self._stop.wait(self.poll_seconds)
+
+    def run_periodic(self):
+        if not self._periodic_lock.acquire(blocking=False):
+            return
+        try:
+            for task in self._periodic:
+                seconds, function, last = task
+                if time.monotonic() - last >= seconds:
+                    task[2] = time.monotonic()
+                    with self.app.app_context():
+                        function()
+        finally:
+            self._periodic_lock.release()
+
+    def run_one(self, worker_id):
+        # Claims and runs one job. Returns False when there was nothing to do.
+        with self.app.app_context():
+            job_id = self.claim(worker_id)
+            if job_id is None:
+                return False
+
+            job = self.db.session.get(self.Job, job_id)
+            # Handlers can wait for admission or run for longer than the lease
+            # between progress reports, so it is kept alive on the side
+            done = threading.Event()
+            threading.Thread(target=self.heartbeat, args=(job_id, worker_id, done), daemon=True,
+                             name=f'crop-job-heartbeat-{job_id}').start()
+            try:
+                result_path = self.handlers[job.kind](job, lambda percent: self.report(job_id, worker_id, percent))
+            except Exception as e:
+                self.db.session.rollback()
+                self.finish(job_id, worker_id, error=f'{type(e).__name__}: {e}')
+            else:
+                self.finish(job_id, worker_id, result_path=result_path)
+            finally:
+                done.set()
+            return True
+
+    def heartbeat(self, job_id, worker_id, done):
+        # Renews the lease every third of its length until the handler returns
+        with self.app.app_context():
+            while not done.wait(self.lease.total_seconds() / 3):
+                try:
+                    self.renew(job_id, worker_id)
+                except Exception:
+                    self.db.session.rollback()
+                    traceback.print_exc()
+
+    def _now(self):
+        return datetime.datetime.now()
+
+    def claim(self, worker_id):
+        Job = self.Job
+        now = self._now()
+        session = self.db.session
+
+        # Jobs whose worker died on their last attempt are not retried
+        session.execute(
+            self.db.update(Job)
+            .where(Job.status == 'running', Job.lease_expires < now, Job.attempts >= Job.max_attempts)
+            .values(status='failed', error='Worker stopped before the job finished', updated_at=now)
+        )
+        session.commit()
+
+        claimable = self.db.or_(
+            Job.status == 'queued',
+            self.db.and_(Job.status == 'running', Job.lease_expires < now),
+        )
+        candidates = session.execute(
+            self.db.select(Job.id).where(claimable).order_by(Job.id).limit(5)
+        ).scalars().all()
+        for job_id in candidates:
+            # Only one worker's UPDATE can match while the job is still claimable
+            claimed = session.execute(
+                self.db.update(Job)
+                .where(Job.id == job_id, claimable)
+                .values(status='running', worker_id=worker_id, attempts=Job.attempts + 1,
+                        lease_expires=now + self.lease, updated_at=now)
+            ).rowcount
+            session.commit()
+            if claimed:
+                return job_id
+        return None
+
+    def report(self, job_id, worker_id, percent):
+        # Progress update, which also renews the lease
+        self.renew(job_id, worker_id, progress=max(0, min(100, int(percent))))
+
+    def renew(self, job_id, worker_id, **values):
+        now = self._now()
+        self.db.session.execute(
+            self.db.update(self.Job)
+            .where(self.Job.id == job_id, self.Job.worker_id == worker_id, self.Job.status == 'running')
+            .values(lease_expires=now + self.lease, updated_at=now, **values)
+        )
+        self.db.session.commit()
+
+    def finish(self, job_id, worker_id, result_path=None, error=None):
+        Job = self.Job
+        if error is None:
+            values = {'status': 'done', 'progress': 100, 'result_path': result_path, 'error': None}
+        else:
+            # Failed attempts go back on the queue until they run out
+            job = self.db.session.get(Job, job_id)
+            retry = job.attempts < job.max_attempts
+            values = {'status': 'queued' if retry else 'failed', 'error': error}
+        self.db.session.execute(
+            self.db.update(Job)
+            .where(Job.id == job_id, Job.worker_id == worker_id)
+            .values(updated_at=self._now(), lease_expires=None, **values)
+        )
+        self.db.session.commit()
@@ -0,0 +1,219 @@
+import datetime
+import os
+import smtplib
+import threading
+import time
+import traceback
+
+
+class SMTPConnection:
+    # One SMTP session reused for many messages, so the connect, STARTTLS
+    # and login cost is paid once per batch instead of once per email.
+    # Reconnects after max_messages (servers cap messages per session) or
+    # when the session has sat idle long enough that the server may have
+    # dropped it.
+
+    def __init__(self, host, port, username=None, password=None, starttls=True, timeout=30,
+                 max_messages=100, idle_seconds=60):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.max_messages = max_messages
+        self.idle_seconds = idle_seconds
+        self._smtp = None
+        self._sent = 0
+        self._last_used = 0.0
+
+    def _connect(self):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                smtp.starttls()
+            if self.username and self.password:
+                smtp.login(self.username, self.password)
+        except BaseException:
+            smtp.close()
+            raise
+        self._smtp = smtp
+        self._sent = 0
+
+    def send(self, message):
+        stale = self._smtp is not None and (
+            self._sent >= self.max_messages or time.monotonic() - self._last_used > self.idle_seconds)
+        if stale:
+            self.close()
+        reused = self._smtp is not None
+        if not reused:
+            self._connect()
+        try:
+            self._smtp.send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            # The server dropped a session we kept open; one fresh try
+            self.close()
+            if not reused:
+                raise
+            self._connect()
+            self._smtp.send_message(message)
+        self._sent += 1
+        self._last_used = time.monotonic()
+
+    def close_if_idle(self):
+        if self._smtp is not None and time.monotonic() - self._last_used > self.idle_seconds:
+            self.close()
+
+    def close(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self._smtp.close()
+        self._smtp = None
+
+
+def build_message(sender, to_address, subject, html):
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    message = MIMEMultipart()
+    message['From'] = sender
+    message['To'] = to_address
+    message['Subject'] = subject
+    message.attach(MIMEText(html, 'html'))
+    return message
+
+
+class OutboxSender:
+    # Sends queued outbox rows from a background thread over one reused
+    # SMTP connection. Rows are claimed with a conditional UPDATE, so
+    # several processes can run a sender without sending anything twice; a
+    # claim that is never finished (the process died) is picked up again
+    # once its lease runs out. Each lease is renewed just before its message
+    # is sent, so slow sends earlier in a batch can't let it run out. Failed
+    # sends are retried with exponential backoff up to max_attempts; refused
+    # recipients are not retried.
+
+    def __init__(self, db, message_model, connection, sender, batch_size=20, poll_seconds=2.0,
+                 max_attempts=8, backoff_seconds=30, lease_seconds=120):
+        self.app = None
+        self.db = db
+        self.Message = message_model
+        self.connection = connection
+        self.sender = sender
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.lease = datetime.timedelta(seconds=lease_seconds)
+        self._started_pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    def init_app(self, app):
+        self.app = app
+
+    def ensure_started(self):
+        # Called on every request; starts the thread once per process
+        if self._started_pid == os.getpid():
+            return
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            threading.Thread(target=self.run_forever, daemon=True, name='email-outbox').start()
+
+    def notify(self):
+        # New mail was committed; don't wait for the next poll
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            try:
+                sent = self.send_pending()
+            except Exception:
+                traceback.print_exc()
+                sent = 0
+            if not sent:
+                self.connection.close_if_idle()
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+        self.connection.close()
+
+    def _now(self):
+        return datetime.datetime.now()
+
+    def claim(self):
+        Message = self.Message
+        now = self._now()
+        session = self.db.session
+        # A sending row whose lease has run out was claimed by a sender that died
+        due = self.db.and_(Message.status.in_(('pending', 'sending')), Message.next_attempt_at <= now)
+        candidates = session.execute(
+            self.db.select(Message.id).where(due).order_by(Message.id).limit(self.batch_size)
+        ).scalars().all()
+        claimed = []
+        for message_id in candidates:
+            # next_attempt_at doubles as the lease while a row is being sent
+            if session.execute(
+                self.db.update(Message).where(Message.id == message_id, due)
+                .values(status='sending', next_attempt_at=now + self.lease)
+            ).rowcount:
+                claimed.append((message_id, now + self.lease))
+        session.commit()
+        return claimed
+
+    def renew(self, message_id, lease):
+        # Extends a claim right before sending. False if the lease ran out and
+        # another sender has claimed the message since.
+        Message = self.Message
+        renewed = self.db.session.execute(
+            self.db.update(Message)
+            .where(Message.id == message_id, Message.status == 'sending', Message.next_attempt_at == lease)
+            .values(next_attempt_at=self._now() + self.lease)
+        ).rowcount
+        self.db.session.commit()
+        return renewed > 0
+
+    def send_pending(self):
+        # Sends one batch. Returns how many messages were attempted.
+        with self.app.app_context():
+            claimed = self.claim()
+            for message_id, lease in claimed:
+                if not self.renew(message_id, lease):
+                    continue
+                message = self.db.session.get(self.Message, message_id)
+                try:
+                    self.connection.send(build_message(self.sender, message.to_address, message.subject, message.html))
+                except smtplib.SMTPRecipientsRefused as e:
+                    self.finish(message, error=str(e), retry=False)
+                except (smtplib.SMTPException, OSError) as e:
+                    self.connection.close()
+                    self.finish(message, error=f'{type(e).__name__}: {e}', retry=True)
+                else:
+                    self.finish(message)
+            return len(claimed)
+
+    def finish(self, message, error=None, retry=True):
+        now = self._now()
+        message.attempts += 1
+        if error is None:
+            message.status = 'sent'
+            message.sent_at = now
+            message.last_error = None
+        elif retry and message.attempts < self.max_attempts:
+            message.status = 'pending'
+            message.next_attempt_at = now + datetime.timedelta(
+                seconds=self.backoff_seconds * 2 ** (message.attempts - 1))
+            message.last_error = error[:500]
+        else:
+            message.status = 'failed'
+            message.last_error = error[:500]
+        self.db.session.commit()
+
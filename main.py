@@ -1,57 +1,119 @@
-from flask import Flask, render_template, redirect, url_for, flash, request, jsonify, session, make_response
+from flask import Flask, Blueprint, current_app, render_template, redirect, url_for, flash, request, jsonify, session, make_response, abort, send_file, Response
+from flask.config import Config
 from flask_bootstrap import Bootstrap5
 from flask_ckeditor import CKEditor
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, SelectField, PasswordField
 from wtforms.validators import DataRequired, Email, Length
 from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import Integer, String, Date, Time, JSON, Boolean
+from sqlalchemy import Integer, BigInteger, String, Date, Time, DateTime, JSON, Boolean
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin, login_user, LoginManager, current_user, logout_user
 from werkzeug.security import generate_password_hash, check_password_hash
-import requests
 import random
-import stripe
 import os
-import smtplib
 import json
-from flask_ckeditor import CKEditorField
 from datetime import date, time
 import datetime
 import os
-from openai import OpenAI
 import secrets
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 from werkzeug.utils import secure_filename
 from flask import send_from_directory
 from PIL import Image
 from io import BytesIO
 import base64
+import mimetypes
+import tempfile
+import shutil
+from werkzeug.exceptions import RequestEntityTooLarge
+from imaging import CropError, ProbeError, probe_image, parse_aspect, parse_crop_box, parse_encode_options, parse_export_sizes, crop_image, preview_levels, rotated_size, build_previews, MIMETYPES, OUTPUT_EXTENSIONS, THUMBNAIL_SIZE
+from uploads import EXTENSIONS, FORMATS_BY_EXTENSION, UploadError, spool_upload, chunk_count, chunk_length, write_chunk, received_chunks, ChunkReader
+from storage import content_key, preview_key, make_backend
+from renditions import RenditionCache
+from batch import parse_batch_spec, run_batch, stream_zip, write_zip, export_bundle, get_pool
+from jobs import JobRunner, worker_name
+from admission import AdmissionError, PixelBudget, estimate_cost
+from sqlalchemy.exc import IntegrityError
+from migrations import upgrade_schema
+from pagination import CursorError, keyset_page
+from cache import SignatureCache, TTLCache
+from markupsafe import Markup
+from mailer import OutboxSender, SMTPConnection
+from metrics import Metrics
+from database import profile_for, engine_options, sqlite_pragmas, tune_engine
 
 
 APP_NAME = 'Studyvant'
-stripe.api_key = os.environ.get('STRIPE_API')
 
+ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
+INSTANCE_PATH = os.path.join(ROOT_PATH, 'instance')
 
-app = Flask(__name__)
-ckeditor = CKEditor(app)
-Bootstrap5(app)
-app.config['SECRET_KEY'] = '1afjdlkafjd'
+# Settings from the environment, copied into app.config by create_app().
+# The per-process pieces below (storage, caches, job threads) are built
+# from them at import.
+config = Config(ROOT_PATH)
+config['SECRET_KEY'] = '1afjdlkafjd'
 
+# Routes, error handlers and CLI commands, registered by create_app()
+bp = Blueprint('main', __name__, cli_group=None)
+
+ckeditor = CKEditor()
+bootstrap = Bootstrap5()
 login_manager = LoginManager()
-login_manager.init_app(app)
+
+# Request, SQL and image-stage metrics, served in Prometheus format at
+# /metrics. Every worker writes its figures under METRICS_DIR, so all the
+# processes of one deploy must share it.
+config['METRICS_DIR'] = os.environ.get('METRICS_DIR', os.path.join(INSTANCE_PATH, 'metrics'))
+config['METRICS_FLUSH_SECONDS'] = float(os.environ.get('METRICS_FLUSH_SECONDS', 1))
+app_metrics = Metrics(config['METRICS_DIR'], config['METRICS_FLUSH_SECONDS'])
+
+class UserSnapshot:
+    # The logged-in user as most requests need it: enough for Flask-Login
+    # and the fields that gate features. Cached between requests so a page
+    # or AJAX call does not have to load the User row.
+    __slots__ = ('id', 'verified', 'premium_level', 'picture_count')
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, user):
+        self.id = user.id
+        self.verified = user.verified
+        self.premium_level = user.premium_level
+        self.picture_count = user.picture_count
+
+    def get_id(self):
+        return str(self.id)
+
+# USER_CACHE_SECONDS=0 turns the cross-request cache off. Other processes
+# see changes once the ttl runs out; this one sees them at once through
+# forget_user().
+config['USER_CACHE_SECONDS'] = int(os.environ.get('USER_CACHE_SECONDS', 60))
+user_snapshots = TTLCache(config['USER_CACHE_SECONDS'], max_entries=10000)
 
 @login_manager.user_loader
 def load_user(user_id):
-    return db.get_or_404(User, user_id)
+    # Flask-Login calls this at most once per request. On a cache miss the
+    # User row is loaded into the session, so anything else in the same
+    # request that needs it gets it from the identity map with db.session.get().
+    user_id = int(user_id)
+    snapshot = user_snapshots.get(user_id)
+    if snapshot is None:
+        snapshot = UserSnapshot(db.get_or_404(User, user_id))
+        user_snapshots.set(user_id, snapshot)
+    return snapshot
+
+def forget_user(user_id):
+    # Call after writing any field UserSnapshot holds
+    user_snapshots.invalidate(int(user_id))
 
 class Base(DeclarativeBase):
     pass
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DB_URI", 'sqlite:///users.db')
+config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DB_URI", 'sqlite:///users.db')
+# Engine options are set near create_app(), once the thread counts are known
 db = SQLAlchemy(model_class=Base)
-db.init_app(app)
 
 # Create a form to register new users
 class RegisterForm(FlaskForm):
@@ -85,13 +147,15 @@ class User(UserMixin, db.Model):
     password: Mapped[str] = mapped_column(String(100))
     name: Mapped[str] = mapped_column(String(100))
     premium_level: Mapped[int] = mapped_column(Integer)
-    date_of_signup: Mapped[Date] = mapped_column(Date)
+    # Indexed for the dashboard's recent sign-ups
+    date_of_signup: Mapped[Date] = mapped_column(Date, index=True)
     time_of_signup: Mapped[Time] = mapped_column(Time)
     end_date_premium: Mapped[Date] = mapped_column(Date)
     points: Mapped[int] = mapped_column(Integer)
     picture_count: Mapped[int] = mapped_column(Integer)
     verified: Mapped[bool] = mapped_column(Boolean, default=False)
-    verification_token: Mapped[str] = mapped_column(String(100), nullable=True)
+    # Indexed for /verify/<token>
+    verification_token: Mapped[str] = mapped_column(String(100), nullable=True, index=True)
 
 class Picture(db.Model):
     __tablename__ = "pictures"
@@ -102,6 +166,62 @@ class Picture(db.Model):
     cropped_path: Mapped[str] = mapped_column(String(500))
     upload_date: Mapped[Date] = mapped_column(Date)
 
+    # The library pages through a user's pictures by (upload_date, id)
+    __table_args__ = (db.Index('ix_pictures_user_upload_date', 'user_id', 'upload_date', 'id'),)
+
+# One row per distinct original, shared by every Picture with the same content
+class StoredOriginal(db.Model):
+    __tablename__ = "stored_originals"
+    content_hash: Mapped[str] = mapped_column(String(64), primary_key=True)
+    storage_key: Mapped[str] = mapped_column(String(500), unique=True)
+    format: Mapped[str] = mapped_column(String(10))
+    size: Mapped[int] = mapped_column(Integer)
+    width: Mapped[int] = mapped_column(Integer)
+    height: Mapped[int] = mapped_column(Integer)
+    ref_count: Mapped[int] = mapped_column(Integer)
+    # 64-bit dHash of the thumbnail, stored signed; see phash.py
+    phash: Mapped[int] = mapped_column(BigInteger, nullable=True)
+
+# Named set of export sizes. user_id is None for presets everyone can use.
+class ExportPreset(db.Model):
+    __tablename__ = "export_presets"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("users.id"), nullable=True, index=True)
+    name: Mapped[str] = mapped_column(String(100))
+    sizes: Mapped[list] = mapped_column(JSON)
+
+# Heavy crop work queued to run outside the request, see jobs.JobRunner
+class CropJob(db.Model):
+    __tablename__ = "crop_jobs"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("users.id"))
+    kind: Mapped[str] = mapped_column(String(20))
+    params: Mapped[dict] = mapped_column(JSON)
+    # queued, running, done or failed
+    status: Mapped[str] = mapped_column(String(10), default='queued', index=True)
+    progress: Mapped[int] = mapped_column(Integer, default=0)
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    max_attempts: Mapped[int] = mapped_column(Integer, default=3)
+    worker_id: Mapped[str] = mapped_column(String(100), nullable=True)
+    lease_expires: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=True)
+    result_path: Mapped[str] = mapped_column(String(500), nullable=True)
+    error: Mapped[str] = mapped_column(String(500), nullable=True)
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime)
+    updated_at: Mapped[datetime.datetime] = mapped_column(DateTime)
+
+# A resumable upload in progress. Chunks live on disk under
+# CHUNK_UPLOAD_FOLDER/<id>/<index> until the upload is completed.
+class UploadSession(db.Model):
+    __tablename__ = "upload_sessions"
+    id: Mapped[str] = mapped_column(String(64), primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("users.id"))
+    filename: Mapped[str] = mapped_column(String(250))
+    size: Mapped[int] = mapped_column(Integer)
+    chunk_size: Mapped[int] = mapped_column(Integer)
+    # Hex SHA-256 of the whole file, checked when the upload is completed
+    sha256: Mapped[str] = mapped_column(String(64), nullable=True)
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime)
+
 class ClassList(db.Model):
     __tablename__ = "class_list"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
@@ -115,6 +235,9 @@ class FeedbackUpvote(db.Model):
     user_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("users.id"))
     feedback_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("feedback.id"))
 
+    # One vote per user per feedback. Also serves the IN query for a page's vote state.
+    __table_args__ = (db.Index('uq_feedback_upvotes_user_feedback', 'user_id', 'feedback_id', unique=True),)
+
 # Update Feedback class to include relationship
 class Feedback(db.Model):
     __tablename__ = "feedback"
@@ -126,50 +249,492 @@ class Feedback(db.Model):
     # Add relationship to track upvoters
     upvoters = relationship('User', secondary='feedback_upvotes', backref='upvoted_feedback')
 
-with app.app_context():
+    # The feedback page lists the most upvoted first, by (upvote_count, id)
+    __table_args__ = (db.Index('ix_feedback_upvote_count', 'upvote_count', 'id'),)
+
+# Append-only record of credit changes. Entries are folded into
+# User.picture_count by compact_credits() and then marked applied.
+class CreditEntry(db.Model):
+    __tablename__ = "credit_ledger"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("users.id"))
+    delta: Mapped[int] = mapped_column(Integer)
+    reason: Mapped[str] = mapped_column(String(50))
+    applied: Mapped[bool] = mapped_column(Boolean, default=False)
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime)
+
+    __table_args__ = (db.Index('ix_credit_ledger_user_applied', 'user_id', 'applied'),)
+
+# Email waiting to be sent. Written in the same transaction as the change
+# that needs it and delivered by outbox_sender in the background.
+class OutboxEmail(db.Model):
+    __tablename__ = "email_outbox"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    to_address: Mapped[str] = mapped_column(String(250))
+    subject: Mapped[str] = mapped_column(String(250))
+    html: Mapped[str] = mapped_column(String())
+    # pending, sending, sent or failed
+    status: Mapped[str] = mapped_column(String(10), default='pending')
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    # When a pending email is next due, or when a claim on a sending one runs out
+    next_attempt_at: Mapped[datetime.datetime] = mapped_column(DateTime)
+    last_error: Mapped[str] = mapped_column(String(500), nullable=True)
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime)
+    sent_at: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=True)
+
+    __table_args__ = (db.Index('ix_email_outbox_status_due', 'status', 'next_attempt_at'),)
+
+def remove_duplicate_upvotes():
+    # Racing clicks could store the same vote twice before the unique index
+    # existed. Keep the first of each and recount, so the index can be built.
+    inspector = db.inspect(db.engine)
+    if any(index['name'] == 'uq_feedback_upvotes_user_feedback' for index in inspector.get_indexes('feedback_upvotes')):
+        return
+    keep = db.select(db.func.min(FeedbackUpvote.id)).group_by(FeedbackUpvote.user_id, FeedbackUpvote.feedback_id)
+    db.session.execute(db.delete(FeedbackUpvote).where(FeedbackUpvote.id.not_in(keep)))
+    db.session.execute(db.update(Feedback).values(upvote_count=(
+        db.select(db.func.count(FeedbackUpvote.id)).where(FeedbackUpvote.feedback_id == Feedback.id).scalar_subquery()
+    )))
+    db.session.commit()
+
+@bp.cli.command('init-db')
+def init_db_command():
+    """Create missing tables, columns and indexes."""
+    init_db()
+
+def init_db():
+    # Run once per deploy (the Procfile's release step), not on every
+    # worker start
     db.create_all()
+    remove_duplicate_upvotes()
+    upgrade_schema(db)
+
+# Export presets available to everyone without a database row
+BUILTIN_EXPORT_PRESETS = {
+    'Social media': [
+        {'label': 'post', 'width': 1080, 'height': 1080, 'output': 'jpeg'},
+        {'label': 'link-card', 'width': 1200, 'height': 630, 'output': 'jpeg'},
+        {'label': 'avatar', 'width': 400, 'height': 400, 'output': 'jpeg'},
+    ],
+    'Web': [
+        {'label': 'large', 'width': 1920, 'height': 1080, 'output': 'webp'},
+        {'label': 'medium', 'width': 1280, 'height': 720, 'output': 'webp'},
+        {'label': 'small', 'width': 640, 'height': 360, 'output': 'webp'},
+    ],
+}
+
+ALLOWED_FORMATS = set(EXTENSIONS)
+
+config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', os.path.join(ROOT_PATH, 'static/uploads'))
+config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'local')
+os.makedirs(config['UPLOAD_FOLDER'], exist_ok=True)
+
+# Originals are stored once per content hash, see store_original()
+storage = make_backend(config['STORAGE_BACKEND'], root=config['UPLOAD_FOLDER'])
+
+# Finished crops, so exporting the same box again costs no decode or encode
+config['RENDITION_FOLDER'] = os.environ.get('RENDITION_FOLDER', os.path.join(INSTANCE_PATH, 'renditions'))
+config['RENDITION_CACHE_MB'] = int(os.environ.get('RENDITION_CACHE_MB', 512))
+renditions = RenditionCache(config['RENDITION_FOLDER'], config['RENDITION_CACHE_MB'] * 1024 * 1024)
 
-UPLOAD_FOLDER = 'static/uploads'
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+# Process pool size for batch crops, per gunicorn worker
+config['BATCH_WORKERS'] = int(os.environ.get('BATCH_WORKERS', os.cpu_count() or 1))
 
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# Threads per web process that run queued crop jobs; 0 leaves them to `flask crop-worker`
+config['CROP_JOB_THREADS'] = int(os.environ.get('CROP_JOB_THREADS', 1))
+config['JOB_RESULT_FOLDER'] = os.environ.get('JOB_RESULT_FOLDER', os.path.join(INSTANCE_PATH, 'job_results'))
+os.makedirs(config['JOB_RESULT_FOLDER'], exist_ok=True)
 
-def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+# Uploads bigger than this are rejected while they are being read
+config['MAX_UPLOAD_MB'] = int(os.environ.get('MAX_UPLOAD_MB', 50))
+config['MAX_UPLOAD_BYTES'] = config['MAX_UPLOAD_MB'] * 1024 * 1024
+# Leave room for the multipart headers around the file
+config['MAX_CONTENT_LENGTH'] = config['MAX_UPLOAD_BYTES'] + 1024 * 1024
 
-@app.route('/', methods=["GET", "POST"])
+# Resumable uploads: chunks are held here until the upload is completed.
+# Clients may ask for any chunk size from 256 KB up to UPLOAD_CHUNK_MB.
+config['CHUNK_UPLOAD_FOLDER'] = os.environ.get('CHUNK_UPLOAD_FOLDER', os.path.join(INSTANCE_PATH, 'chunk_uploads'))
+config['UPLOAD_CHUNK_MB'] = int(os.environ.get('UPLOAD_CHUNK_MB', 8))
+config['UPLOAD_SESSION_HOURS'] = int(os.environ.get('UPLOAD_SESSION_HOURS', 24))
+MIN_UPLOAD_CHUNK_BYTES = 256 * 1024
+
+# Largest image we will decode, checked from the header before any decode.
+# Pillow's own bomb check is set to the same value as a backstop.
+config['MAX_IMAGE_PIXELS'] = int(os.environ.get('MAX_IMAGE_PIXELS', 100_000_000))
+Image.MAX_IMAGE_PIXELS = config['MAX_IMAGE_PIXELS']
+
+# Decoded pixel memory all image work in one process may hold at once
+config['PIXEL_BUDGET_MB'] = int(os.environ.get('PIXEL_BUDGET_MB', 1024))
+config['ADMISSION_WAIT_SECONDS'] = float(os.environ.get('ADMISSION_WAIT_SECONDS', 10))
+pixel_budget = PixelBudget(config['PIXEL_BUDGET_MB'] * 1024 * 1024, config['ADMISSION_WAIT_SECONDS'])
+
+def original_size(picture):
+    # (width, height, mode) of a picture's original, from the stored size
+    original = StoredOriginal.query.filter_by(storage_key=picture.original_path).first()
+    if not original:
+        info = probe_image(original_source(picture))
+        return info.width, info.height, info.mode
+    return original.width, original.height, None
+
+def original_cost(picture, copies=3):
+    # Admission cost of decoding a picture's original
+    return estimate_cost(*original_size(picture), copies=copies)
+
+def crop_cost(picture, box, targets=()):
+    # original_cost() plus what a crop makes on top of it: the larger canvas
+    # a rotation expands to, and every export size, which export_sizes()
+    # holds all at once
+    width, height, mode = original_size(picture)
+    cost = estimate_cost(width, height, mode)
+    if box['rotate'] % 360:
+        growth = estimate_cost(*rotated_size(width, height, box['rotate']), mode, copies=1)
+        cost += max(0, growth - estimate_cost(width, height, mode, copies=1))
+    for target in targets:
+        cost += estimate_cost(target['width'], target['height'], copies=1)
+    return cost
+
+@bp.app_errorhandler(AdmissionError)
+def admission_refused(e):
+    if request.path == url_for('main.picture'):
+        flash(str(e))
+        return redirect(url_for('main.picture'))
+    response = jsonify({'success': False, 'error': str(e)})
+    response.status_code = e.status
+    if e.retry_after:
+        response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+@bp.app_errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    message = f"That file is too large. The limit is {current_app.config['MAX_UPLOAD_MB']} MB."
+    if request.path == url_for('main.picture'):
+        flash(message)
+        return redirect(url_for('main.picture'))
+    return jsonify({'success': False, 'error': message}), 413
+
+class InvalidBody(Exception):
+    pass
+
+def json_object():
+    # The JSON request body, {} when there is none. Arrays and scalars are
+    # a 400 rather than an AttributeError on the first data.get().
+    data = request.get_json(silent=True)
+    if data is None:
+        return {}
+    if not isinstance(data, dict):
+        raise InvalidBody('The request body must be a JSON object')
+    return data
+
+@bp.app_errorhandler(InvalidBody)
+def invalid_body(e):
+    return jsonify({'success': False, 'error': str(e)}), 400
+
+@bp.route('/', methods=["GET", "POST"])
 def home_page():
     return render_template("index.html")
 
-@app.route('/picture', methods=['GET', 'POST'])
+@bp.route('/picture', methods=['GET', 'POST'])
 def picture():
     if not current_user.is_authenticated:
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     if request.method == 'POST':
-        if 'file' not in request.files:
+        # The multipart body is read and parsed on first access
+        with app_metrics.stage('receive'):
+            files = request.files
+        if 'file' not in files:
             flash('No file selected')
             return redirect(request.url)
             
-        file = request.files['file']
+        file = files['file']
         if file.filename == '':
             flash('No file selected')
             return redirect(request.url)
             
-        if file and allowed_file(file.filename):
-            # Instead of saving, pass the file directly to the template
-            file_data = base64.b64encode(file.read()).decode()
-            return render_template('crop_picture.html', 
-                                image_data=file_data, 
-                                filename=secure_filename(file.filename))
+        if file:
+            # Spool to disk in chunks, hashing and checking the format on the way
+            try:
+                with app_metrics.stage('spool'):
+                    upload = spool_upload(file.stream, storage.temp_dir(), current_app.config['MAX_UPLOAD_BYTES'])
+                new_picture = add_picture(upload, file.filename)
+            except UploadError as e:
+                flash(str(e))
+                return redirect(request.url)
+            return render_cropper(new_picture)
     
-    return render_template('picture.html')
+    return render_template('picture.html', chunk_size=current_app.config['UPLOAD_CHUNK_MB'] * 1024 * 1024)
+
+def add_picture(upload, filename):
+    # Stores a spooled upload and records it for the current user
+    new_picture = Picture(
+        user_id=current_user.id,
+        filename=secure_filename(filename),
+        original_path=store_original(upload),
+        cropped_path='',
+        upload_date=datetime.date.today(),
+    )
+    db.session.add(new_picture)
+    db.session.commit()
+    hash_indexes.invalidate(current_user.id)
+    return new_picture
+
+@bp.route('/uploads', methods=['POST'])
+def create_upload():
+    # Starts a resumable upload: {"filename", "size", "sha256", "chunk_size"}.
+    # sha256 and chunk_size are optional.
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
 
-@app.route('/crop-picture/<int:picture_id>', methods=['GET', 'POST'])
+    data = json_object()
+    filename = secure_filename(data.get('filename') or '')
+    if not filename:
+        return jsonify({'success': False, 'error': 'A filename is required'}), 400
+    try:
+        size = int(data.get('size'))
+        chunk_size = int(data.get('chunk_size') or current_app.config['UPLOAD_CHUNK_MB'] * 1024 * 1024)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Size and chunk size must be numbers'}), 400
+    if not 0 < size <= current_app.config['MAX_UPLOAD_BYTES']:
+        return jsonify({'success': False, 'error': f"The limit is {current_app.config['MAX_UPLOAD_MB']} MB"}), 413
+    chunk_size = max(MIN_UPLOAD_CHUNK_BYTES, min(chunk_size, current_app.config['UPLOAD_CHUNK_MB'] * 1024 * 1024))
+    sha256 = data.get('sha256') or None
+    if sha256 is not None and not (isinstance(sha256, str) and len(sha256) == 64
+                                   and all(c in '0123456789abcdef' for c in sha256.lower())):
+        return jsonify({'success': False, 'error': 'sha256 must be 64 hex digits'}), 400
+    sha256 = sha256 and sha256.lower()
+
+    expire_upload_sessions()
+    upload = UploadSession(id=secrets.token_urlsafe(24), user_id=current_user.id, filename=filename,
+                           size=size, chunk_size=chunk_size, sha256=sha256,
+                           created_at=datetime.datetime.now())
+    db.session.add(upload)
+    db.session.commit()
+    os.makedirs(upload_chunk_dir(upload.id), exist_ok=True)
+    return jsonify(upload_status(upload)), 201
+
+def upload_chunk_dir(upload_id):
+    return os.path.join(current_app.config['CHUNK_UPLOAD_FOLDER'], upload_id)
+
+def upload_status(upload):
+    count = chunk_count(upload.size, upload.chunk_size)
+    received = received_chunks(upload_chunk_dir(upload.id))
+    return {
+        'success': True,
+        'upload_id': upload.id,
+        'size': upload.size,
+        'chunk_size': upload.chunk_size,
+        'chunk_count': count,
+        'received': received,
+        'missing': sorted(set(range(count)) - set(received)),
+    }
+
+def expire_upload_sessions():
+    # Abandoned uploads are cleared out whenever a new one starts
+    cutoff = datetime.datetime.now() - datetime.timedelta(hours=current_app.config['UPLOAD_SESSION_HOURS'])
+    for upload in UploadSession.query.filter(UploadSession.created_at < cutoff).all():
+        discard_upload(upload)
+    db.session.commit()
+
+def discard_upload(upload):
+    shutil.rmtree(upload_chunk_dir(upload.id), ignore_errors=True)
+    db.session.delete(upload)
+
+@bp.route('/uploads/<upload_id>', methods=['GET', 'DELETE'])
+def upload_session(upload_id):
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+
+    upload = UploadSession.query.filter_by(id=upload_id, user_id=current_user.id).first_or_404()
+    if request.method == 'DELETE':
+        discard_upload(upload)
+        db.session.commit()
+        return jsonify({'success': True})
+    # What has arrived so far, so a client can resume with only the missing chunks
+    return jsonify(upload_status(upload))
+
+@bp.route('/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+
+    upload = UploadSession.query.filter_by(id=upload_id, user_id=current_user.id).first_or_404()
+    if not 0 <= index < chunk_count(upload.size, upload.chunk_size):
+        return jsonify({'success': False, 'error': 'Chunk number out of range'}), 400
+    # The session row is all this needs; don't hold the connection while the body arrives
+    length = chunk_length(index, upload.size, upload.chunk_size)
+    db.session.close()
+
+    try:
+        write_chunk(upload_chunk_dir(upload_id), index, request.stream, length)
+    except UploadError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except FileNotFoundError:
+        # Completed or discarded by another request
+        return jsonify({'success': False, 'error': 'Upload not found'}), 404
+    return jsonify({'success': True, 'index': index})
+
+@bp.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    # Reassembles the chunks through the same path as a single-shot upload
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+
+    upload = UploadSession.query.filter_by(id=upload_id, user_id=current_user.id).first_or_404()
+    status = upload_status(upload)
+    if status['missing']:
+        return jsonify(dict(status, success=False, error='Some chunks have not arrived')), 409
+
+    reader = ChunkReader(upload_chunk_dir(upload.id), status['chunk_count'])
+    try:
+        spooled = spool_upload(reader, storage.temp_dir(), current_app.config['MAX_UPLOAD_BYTES'])
+    except UploadError as e:
+        discard_upload(upload)
+        db.session.commit()
+        return jsonify({'success': False, 'error': str(e)}), 400
+    finally:
+        reader.close()
+
+    if upload.sha256 and spooled.sha256 != upload.sha256:
+        # Drop the chunks but keep the session, so the client can send them again
+        os.remove(spooled.path)
+        shutil.rmtree(upload_chunk_dir(upload.id), ignore_errors=True)
+        os.makedirs(upload_chunk_dir(upload.id), exist_ok=True)
+        return jsonify({'success': False, 'error': 'The uploaded file does not match its hash'}), 422
+
+    # The session row goes in the same commit as the picture, and the chunks
+    # only after it, so a refused attempt (pixel budget busy) can be retried
+    filename = upload.filename
+    db.session.delete(upload)
+    try:
+        new_picture = add_picture(spooled, filename)
+    except UploadError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except BaseException:
+        db.session.rollback()
+        raise
+    shutil.rmtree(upload_chunk_dir(upload_id), ignore_errors=True)
+    return jsonify({'success': True, 'picture_id': new_picture.id,
+                    'crop_url': url_for('main.crop_picture', picture_id=new_picture.id)})
+
+def store_original(upload):
+    # Returns the storage key for a spooled upload. Content we already have
+    # only gets its reference count bumped, with no write or decode.
+    key = content_key(upload.sha256, EXTENSIONS[upload.format])
+    if add_original_reference(upload.sha256):
+        os.remove(upload.path)
+        return key
+
+    # Header read only, no pixel decode
+    try:
+        with app_metrics.stage('probe'):
+            info = probe_image(upload.path)
+        if info.format not in ALLOWED_FORMATS:
+            raise ProbeError('File is not a JPEG, PNG or GIF image')
+        if info.width * info.height > current_app.config['MAX_IMAGE_PIXELS']:
+            raise ProbeError(f"Image is larger than {current_app.config['MAX_IMAGE_PIXELS'] // 1_000_000} megapixels")
+    except ProbeError as e:
+        os.remove(upload.path)
+        raise UploadError(str(e))
+    width, height = info.width, info.height
+
+    # Admitted before anything is stored, so a refused upload leaves nothing behind
+    cost = estimate_cost(width, height, info.mode, copies=2)
+    try:
+        pixel_budget.acquire(cost)
+    except AdmissionError:
+        os.remove(upload.path)
+        raise
+    try:
+        with app_metrics.stage('store'):
+            storage.put_file(key, upload.path)
+        store_previews(key, preview_levels(width, height))
+    finally:
+        pixel_budget.release(cost)
+    with app_metrics.stage('hash'):
+        phash = thumbnail_hash(key)
+    try:
+        with db.session.begin_nested():
+            db.session.add(StoredOriginal(
+                content_hash=upload.sha256,
+                storage_key=key,
+                format=upload.format,
+                size=upload.size,
+                width=width,
+                height=height,
+                ref_count=1,
+                phash=phash,
+            ))
+    except IntegrityError:
+        # Someone stored the same content at the same time
+        add_original_reference(upload.sha256)
+    return key
+
+def thumbnail_hash(key):
+    # Perceptual hash of a stored original, taken from its small thumbnail
+    from phash import dhash, to_signed
+    thumbnail = preview_key(key, THUMBNAIL_SIZE)
+    return to_signed(dhash(storage.local_path(thumbnail) or storage.open(thumbnail)))
+
+def store_previews(key, levels):
+    # The library thumbnail comes last in the chain, so it costs almost nothing
+    previews = build_previews(storage.local_path(key) or storage.open(key), list(levels) + [THUMBNAIL_SIZE],
+                              stage=app_metrics.stage)
+    for level, output in previews:
+        with app_metrics.stage('store'):
+            storage.put_stream(preview_key(key, level), output)
+
+def add_original_reference(content_hash):
+    result = db.session.execute(
+        db.update(StoredOriginal)
+        .where(StoredOriginal.content_hash == content_hash)
+        .values(ref_count=StoredOriginal.ref_count + 1)
+    )
+    return result.rowcount > 0
+
+def release_original(storage_key):
+    # Drops one reference. Returns the content hash if the original is no
+    # longer used, for delete_original_files() once the transaction has
+    # committed. The row stays behind at ref_count 0 until then, so an upload
+    # of the same content in between takes it back instead of storing it again.
+    db.session.execute(
+        db.update(StoredOriginal)
+        .where(StoredOriginal.storage_key == storage_key)
+        .values(ref_count=StoredOriginal.ref_count - 1)
+    )
+    return db.session.execute(
+        db.select(StoredOriginal.content_hash)
+        .where(StoredOriginal.storage_key == storage_key, StoredOriginal.ref_count <= 0)
+    ).scalar()
+
+def delete_original_files(content_hash):
+    # Deletes the row only if it is still unused, and the files before that
+    # commits: the row stays locked meanwhile, so an upload of the same
+    # content waits in add_original_reference() and then stores it afresh
+    # rather than having its files removed from under it.
+    original = db.session.execute(
+        db.delete(StoredOriginal)
+        .where(StoredOriginal.content_hash == content_hash, StoredOriginal.ref_count <= 0)
+        .returning(StoredOriginal.storage_key, StoredOriginal.width, StoredOriginal.height)
+    ).first()
+    try:
+        if original:
+            storage.delete(original.storage_key)
+            for level in preview_levels(original.width, original.height) + [THUMBNAIL_SIZE]:
+                storage.delete(preview_key(original.storage_key, level))
+    except BaseException:
+        db.session.rollback()
+        raise
+    db.session.commit()
+
+def original_source(picture):
+    # Path or file object Pillow and send_file can read the original from
+    return storage.local_path(picture.original_path) or storage.open(picture.original_path)
+
+@bp.route('/crop-picture/<int:picture_id>', methods=['GET', 'POST'])
 def crop_picture(picture_id=None):
     if not current_user.is_authenticated:
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     # Handle multiple picture IDs from form
     picture_ids = request.form.getlist('image_ids[]')
@@ -190,34 +755,286 @@ def crop_picture(picture_id=None):
     if not pictures:
         abort(404)  # Not found if no pictures exist
     
-    return render_template('crop_picture.html', pictures=pictures)
+    return render_cropper(pictures[0], pictures)
+
+def render_cropper(picture, pictures=None):
+    # The page loads the smallest preview level that fits and maps the box
+    # back to the full-resolution original when exporting
+    original = StoredOriginal.query.filter_by(storage_key=picture.original_path).first()
+    levels = preview_levels(original.width, original.height) if original else []
+    full_long_edge = max(original.width, original.height) if original else None
+    return render_template('crop_picture.html', picture=picture, pictures=pictures,
+                           preview_levels=levels, full_long_edge=full_long_edge,
+                           export_presets=export_presets_for(current_user.id))
+
+def export_presets_for(user_id):
+    # Built-in presets, then shared ones from the database, then the user's own
+    presets = dict(BUILTIN_EXPORT_PRESETS)
+    rows = ExportPreset.query.filter(
+        db.or_(ExportPreset.user_id.is_(None), ExportPreset.user_id == user_id)
+    ).order_by(ExportPreset.user_id.is_(None).desc(), ExportPreset.name).all()
+    for row in rows:
+        presets[row.name] = row.sizes
+    return presets
+
+@bp.route('/picture/<int:picture_id>/preview/<int:level>')
+def picture_preview(picture_id, level):
+    if not current_user.is_authenticated:
+        abort(401)
+
+    picture = Picture.query.filter_by(id=picture_id, user_id=current_user.id).first_or_404()
+    original = StoredOriginal.query.filter_by(storage_key=picture.original_path).first_or_404()
+    levels = preview_levels(original.width, original.height)
+    if level not in levels:
+        abort(404)
+
+    key = preview_key(original.storage_key, level)
+    if not storage.exists(key):
+        # Originals stored before previews existed
+        with pixel_budget.reserve(estimate_cost(original.width, original.height, copies=2)):
+            store_previews(original.storage_key, levels)
+    response = send_file(storage.local_path(key) or storage.open(key), mimetype='image/jpeg',
+                         conditional=True, max_age=31536000)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+@bp.route('/picture/<int:picture_id>/thumbnail')
+def picture_thumbnail(picture_id):
+    if not current_user.is_authenticated:
+        abort(401)
+
+    picture = Picture.query.filter_by(id=picture_id, user_id=current_user.id).first_or_404()
+    key = preview_key(picture.original_path, THUMBNAIL_SIZE)
+    if not storage.exists(key):
+        store_thumbnail(StoredOriginal.query.filter_by(storage_key=picture.original_path).first_or_404())
+    response = send_file(storage.local_path(key) or storage.open(key), mimetype='image/jpeg',
+                         conditional=True, max_age=31536000)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+def store_thumbnail(original):
+    # Originals stored before thumbnails existed. Made from the smallest
+    # preview when there is one, so the original is rarely decoded.
+    levels = preview_levels(original.width, original.height)
+    source_key = original.storage_key
+    cost = estimate_cost(original.width, original.height, copies=2)
+    if levels and storage.exists(preview_key(original.storage_key, levels[0])):
+        source_key = preview_key(original.storage_key, levels[0])
+        cost = estimate_cost(levels[0], levels[0], copies=2)
+    with pixel_budget.reserve(cost):
+        for level, output in build_previews(storage.local_path(source_key) or storage.open(source_key), [THUMBNAIL_SIZE]):
+            storage.put_stream(preview_key(original.storage_key, level), output)
+
+@bp.route('/library')
+def library():
+    if not current_user.is_authenticated:
+        return redirect(url_for('main.login'))
+
+    try:
+        pictures, next_cursor = library_page(request.args.get('cursor'))
+    except CursorError:
+        return redirect(url_for('main.library'))
+    return render_template('library.html', pictures=pictures, next_cursor=next_cursor)
+
+@bp.route('/api/pictures')
+def api_pictures():
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 200)
+        pictures, next_cursor = library_page(request.args.get('cursor'), limit)
+    except (CursorError, ValueError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({
+        'success': True,
+        'pictures': [{
+            'id': picture.id,
+            'filename': picture.filename,
+            'upload_date': picture.upload_date.isoformat(),
+            'thumbnail_url': url_for('main.picture_thumbnail', picture_id=picture.id),
+            'crop_url': url_for('main.crop_picture', picture_id=picture.id),
+        } for picture in pictures],
+        'next_cursor': next_cursor,
+    })
+
+def library_page(cursor, limit=50):
+    # Newest first. Keyset pagination on the (user_id, upload_date, id)
+    # index, so a page deep into a large library is as cheap as the first.
+    query = Picture.query.filter(Picture.user_id == current_user.id)
+    return keyset_page(query, [Picture.upload_date, Picture.id], cursor, limit)
+
+# Near-duplicate search over each user's perceptual hashes. phash (and
+# NumPy with it) is imported by the functions that use it, so workers that
+# never see an upload or a duplicate search don't load it.
+hash_indexes = SignatureCache()
+MAX_HASH_DISTANCE = 16
+
+def user_hash_index(user_id):
+    from phash import HashIndex, from_signed
+    # The cached index is also rebuilt when another process has added or
+    # removed pictures, which shows up as a new count or highest id
+    signature = db.session.execute(
+        db.select(db.func.count(Picture.id), db.func.max(Picture.id)).where(Picture.user_id == user_id)
+    ).one()
+
+    def load():
+        rows = db.session.execute(
+            db.select(Picture.id, StoredOriginal.phash)
+            .join(StoredOriginal, StoredOriginal.storage_key == Picture.original_path)
+            .where(Picture.user_id == user_id, StoredOriginal.phash.is_not(None))
+        )
+        return ((picture_id, from_signed(phash)) for picture_id, phash in rows)
+
+    return hash_indexes.get(user_id, tuple(signature), lambda: HashIndex(load()))
+
+def hash_distance_arg():
+    from phash import DEFAULT_DISTANCE
+    distance = int(request.args.get('distance', DEFAULT_DISTANCE))
+    if not 0 <= distance <= MAX_HASH_DISTANCE:
+        raise ValueError(f'Distance must be from 0 to {MAX_HASH_DISTANCE}')
+    return distance
+
+def picture_summaries(picture_ids):
+    pictures = Picture.query.filter(Picture.id.in_(picture_ids)).all()
+    return {picture.id: {
+        'id': picture.id,
+        'filename': picture.filename,
+        'thumbnail_url': url_for('main.picture_thumbnail', picture_id=picture.id),
+        'crop_url': url_for('main.crop_picture', picture_id=picture.id),
+    } for picture in pictures}
+
+@bp.route('/picture/<int:picture_id>/similar')
+def similar_pictures(picture_id):
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+
+    try:
+        distance = hash_distance_arg()
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    Picture.query.filter_by(id=picture_id, user_id=current_user.id).first_or_404()
+    index = user_hash_index(current_user.id)
+    if picture_id not in index:
+        return jsonify({'success': False, 'error': 'This picture has not been hashed yet'}), 409
+
+    matches = [(other, d) for other, d in index.search(index[picture_id], distance) if other != picture_id]
+    summaries = picture_summaries([other for other, _ in matches])
+    return jsonify({'success': True, 'similar': [dict(summaries[other], distance=d) for other, d in matches]})
+
+@bp.route('/api/duplicates')
+def duplicate_groups():
+    # Groups of the user's pictures that are near-duplicates of each other
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+
+    try:
+        distance = hash_distance_arg()
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    groups = user_hash_index(current_user.id).groups(distance)
+    summaries = picture_summaries([picture_id for group in groups for picture_id in group])
+    return jsonify({'success': True, 'groups': [[summaries[picture_id] for picture_id in group] for group in groups]})
+
+@bp.route('/picture/<int:picture_id>/original')
+def picture_original(picture_id):
+    if not current_user.is_authenticated:
+        abort(401)
+
+    picture = Picture.query.filter_by(id=picture_id, user_id=current_user.id).first_or_404()
+    # Originals never change once stored, so the browser can keep them
+    response = send_file(original_source(picture), mimetype=mimetypes.guess_type(picture.original_path)[0],
+                         conditional=True, max_age=31536000)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+@bp.route('/smart-crop/<int:picture_id>')
+def smart_crop_picture(picture_id):
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+
+    picture = Picture.query.filter_by(id=picture_id, user_id=current_user.id).first_or_404()
+    aspect = None
+    if request.args.get('aspect'):
+        try:
+            aspect = parse_aspect(request.args['aspect'])
+        except CropError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+    # Box in full-resolution pixels, ready for cropper.setData()
+    # Only a small proxy is analysed, but PNGs and GIFs are decoded in full first
+    from smart_crop import smart_crop
+    with pixel_budget.reserve(original_cost(picture, copies=1)):
+        box = smart_crop(original_source(picture), aspect)
+    return jsonify(dict(box, success=True))
 
-@app.route('/save-cropped-image', methods=['POST'])
+@bp.route('/delete-picture/<int:picture_id>', methods=['POST'])
+def delete_picture(picture_id):
+    if not current_user.is_authenticated:
+        return jsonify({'error': 'Not authenticated'}), 401
+
+    picture = Picture.query.filter_by(id=picture_id, user_id=current_user.id).first_or_404()
+    orphan = release_original(picture.original_path)
+    db.session.delete(picture)
+    db.session.commit()
+    hash_indexes.invalidate(current_user.id)
+    if orphan:
+        delete_original_files(orphan)
+    return jsonify({'success': True})
+
+@bp.route('/save-cropped-image', methods=['POST'])
 def save_cropped_image():
     if not current_user.is_authenticated:
         return jsonify({'success': False, 'error': 'Not authenticated'})
 
+    # Crop box from Cropper.js getData(), cropped here from the stored original
+    if request.is_json:
+        with app_metrics.stage('receive'):
+            data = json_object()
+        return crop_stored_picture(data)
+
+    # Canvas sent as a Blob body or a multipart file part, read as a stream
+    if request.mimetype == 'multipart/form-data':
+        with app_metrics.stage('receive'):
+            files = request.files
+        if 'cropped_image' in files:
+            cropped = files['cropped_image']
+            original_filename = request.form.get('original_filename') or cropped.filename
+            # Werkzeug closes request files before the response is sent, so copy it out
+            with app_metrics.stage('spool'):
+                spooled = spool_stream(cropped.stream)
+            return send_cropped_stream(spooled, cropped.mimetype, original_filename)
+    if request.mimetype.startswith('image/') or request.mimetype == 'application/octet-stream':
+        original_filename = request.args.get('original_filename')
+        with app_metrics.stage('receive'):
+            spooled = spool_stream(request.stream)
+        return send_cropped_stream(spooled, request.mimetype, original_filename)
+
     try:
         # Get the cropped image data and original filename from the request
-        image_data = request.form.get('cropped_image')
-        original_filename = request.form.get('original_filename')
+        with app_metrics.stage('receive'):
+            image_data = request.form.get('cropped_image')
+            original_filename = request.form.get('original_filename')
         
         if not image_data or not original_filename:
             return jsonify({'success': False, 'error': 'No image data or filename received'})
 
-        # Remove the data URL prefix to get just the base64 data
-        image_data = image_data.split(',')[1]
+        # Split the data URL into its mimetype and the base64 data
+        header, image_data = image_data.split(',', 1)
+        mimetype = header[len('data:'):].split(';')[0] or 'image/png'
         
         # Convert base64 to binary
         image_binary = base64.b64decode(image_data)
         
-        # Create the new filename
-        name, ext = os.path.splitext(original_filename)
-        new_filename = f"{name}_cropped{ext}"
+        # Create the new filename, with the extension of what the canvas produced
+        new_filename = cropped_filename(original_filename, mimetype)
         
         # Create response with file download headers
         response = make_response(image_binary)
-        response.headers.set('Content-Type', 'image/png')
+        response.headers.set('Content-Type', mimetype)
         response.headers.set('Content-Disposition', 'attachment', filename=new_filename)
         
         return response
@@ -225,13 +1042,154 @@ def save_cropped_image():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+CHUNK_SIZE = 64 * 1024
+
+def spool_stream(stream):
+    # Copy to a temp file chunk by chunk; small bodies stay in memory
+    spool = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+def send_cropped_stream(stream, mimetype, original_filename):
+    if not original_filename:
+        return jsonify({'success': False, 'error': 'No image data or filename received'})
+
+    mimetype = mimetype if mimetype and mimetype.startswith('image/') else 'image/png'
+    return send_file(stream, mimetype=mimetype, as_attachment=True,
+                     download_name=cropped_filename(secure_filename(original_filename), mimetype))
+
+def cropped_filename(original_filename, mimetype):
+    # name_cropped.ext, with ext matching what is actually sent
+    name, ext = os.path.splitext(original_filename)
+    ext = mimetypes.guess_extension(mimetype) or ext
+    return f"{name}_cropped{ext}"
+
+def crop_stored_picture(data):
+    picture = Picture.query.filter_by(id=data.get('picture_id'), user_id=current_user.id).first()
+    if not picture:
+        return jsonify({'success': False, 'error': 'Picture not found'}), 404
+
+    try:
+        box = parse_crop_box(data)
+        options = parse_encode_options(data)
+    except CropError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    fmt = options['format'] or FORMATS_BY_EXTENSION[os.path.splitext(picture.original_path)[1]]
+
+    # The key covers everything that changes the output bytes, so it is a strong ETag
+    key = RenditionCache.make_key(picture.original_path, box, fmt=fmt, quality=options['quality'],
+                                  metadata=options['metadata'])
+    if request.if_none_match.contains(key):
+        response = make_response('', 304)
+        set_rendition_headers(response, key)
+        return response
+
+    path = renditions.get(key)
+    if not path:
+        try:
+            with pixel_budget.reserve(crop_cost(picture, box)):
+                output, mimetype = crop_image(original_source(picture), box, fmt, options['quality'], options['metadata'],
+                                              stage=app_metrics.stage)
+        except CropError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        with app_metrics.stage('store'):
+            path = renditions.put(key, output)
+
+    name = os.path.splitext(picture.filename)[0]
+    response = send_file(path, mimetype=MIMETYPES[fmt], as_attachment=True,
+                         download_name=f"{name}_cropped{OUTPUT_EXTENSIONS[fmt]}", etag=False)
+    set_rendition_headers(response, key)
+    return response
+
+def set_rendition_headers(response, key):
+    response.set_etag(key)
+    response.cache_control.no_cache = None
+    response.cache_control.private = True
+    response.cache_control.max_age = 31536000
+    response.cache_control.immutable = True
+
+@bp.route('/export-presets', methods=['GET', 'POST'])
+def export_presets():
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+
+    if request.method == 'POST':
+        data = json_object()
+        name = (data.get('name') or '').strip()
+        if not name:
+            return jsonify({'success': False, 'error': 'A preset needs a name'}), 400
+        try:
+            parse_export_sizes(data.get('sizes'), current_app.config['MAX_IMAGE_PIXELS'])
+        except CropError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        # Only the admin account can add presets for everyone
+        user_id = None if data.get('shared') and current_user.id == 1 else current_user.id
+        preset = ExportPreset.query.filter_by(user_id=user_id, name=name).first()
+        if preset:
+            preset.sizes = data['sizes']
+        else:
+            db.session.add(ExportPreset(user_id=user_id, name=name, sizes=data['sizes']))
+        db.session.commit()
+
+    return jsonify({'success': True, 'presets': export_presets_for(current_user.id)})
+
+@bp.route('/export-preset', methods=['POST'])
+def export_preset():
+    # Every size of a preset for one crop, from one decode, returned as a ZIP
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+
+    data = json_object()
+    picture = Picture.query.filter_by(id=data.get('picture_id'), user_id=current_user.id).first()
+    if not picture:
+        return jsonify({'success': False, 'error': 'Picture not found'}), 404
+    preset = data.get('preset')
+    sizes = export_presets_for(current_user.id).get(preset) if isinstance(preset, str) else None
+    if sizes is None:
+        return jsonify({'success': False, 'error': 'Unknown export preset'}), 404
+
+    try:
+        box = parse_crop_box(data)
+        targets = parse_export_sizes(sizes, current_app.config['MAX_IMAGE_PIXELS'])
+    except CropError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    name = os.path.splitext(picture.filename)[0]
+    cost = crop_cost(picture, box, targets)
+    if data.get('async'):
+        pixel_budget.check(cost)
+        return enqueue_job('export', {'picture_id': picture.id, 'box': box, 'targets': targets, 'name': name})
 
-@app.route('/price-page', methods=["GET", "POST"])
+    try:
+        with pixel_budget.reserve(cost):
+            results = export_bundle(original_source(picture), box, targets, name)
+    except CropError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    response = Response(stream_zip(results), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename=f"{secure_filename(name)}_{secure_filename(preset)}.zip")
+    return response
+
+@bp.route('/picture/<int:picture_id>/crop')
+def crop_picture_get(picture_id):
+    # GET form of the JSON crop so browsers and proxies can revalidate with If-None-Match
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    return crop_stored_picture(dict(request.args.items(), picture_id=picture_id))
+
+
+@bp.route('/price-page', methods=["GET", "POST"])
 def price_page():
     return render_template("price_page.html")
 
 
-@app.route('/register', methods=["GET", "POST"])
+@bp.route('/register', methods=["GET", "POST"])
 def register():
     form = RegisterForm()
     if form.validate_on_submit():
@@ -241,7 +1199,7 @@ def register():
             user = result.scalar()
             if user:
                 flash("You've already signed up with that email, log in instead!")
-                return redirect(url_for('login'))
+                return redirect(url_for('main.login'))
 
             # Generate verification token
             verification_token = secrets.token_urlsafe(32)
@@ -265,23 +1223,23 @@ def register():
                 verification_token=verification_token,
             )
             
-            # Send verification email before committing to database
-            if send_verification_email(form.email.data.lower(), verification_token):
-                db.session.add(new_user)
-                db.session.commit()
-                flash("Please check your email to verify your account before logging in. If you don't see the email, please check your spam folder. Email will come from mwdynamics@gmail.com")
-                return redirect(url_for("login"))
-            else:
-                return redirect(url_for("register"))
+            # The user and their verification email are saved together, and
+            # the email is sent in the background, not during the request
+            db.session.add(new_user)
+            queue_verification_email(form.email.data.lower(), verification_token)
+            db.session.commit()
+            outbox_sender.notify()
+            flash("Please check your email to verify your account before logging in. If you don't see the email, please check your spam folder. Email will come from mwdynamics@gmail.com")
+            return redirect(url_for("main.login"))
                 
-        except Exception as e:
-            print(f"Registration error: {str(e)}")
+        except Exception:
+            current_app.logger.exception("Registration error")
             flash("An error occurred during registration. Please try again.")
-            return redirect(url_for("register"))
+            return redirect(url_for("main.register"))
             
     return render_template("register.html", form=form, current_user=current_user)
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     form = LoginForm()
     if form.validate_on_submit():
@@ -291,34 +1249,41 @@ def login():
         
         if not user:
             flash("That email does not exist, please try again.")
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         elif not check_password_hash(user.password, password):
             flash('Password incorrect, please try again.')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         elif not user.verified:
             flash('Please verify your email before logging in.')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         else:
             login_user(user)
-            if user.picture_count == 0:
-                return redirect(url_for('price_page'))
+            if credit_balance(user.id) <= 0:
+                return redirect(url_for('main.price_page'))
             else:
-                return redirect(url_for('picture'))
+                return redirect(url_for('main.picture'))
 
     return render_template("login.html", form=form, current_user=current_user)
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     logout_user()
-    return redirect(url_for('home_page'))
+    return redirect(url_for('main.home_page'))
 
 #for test of Stripe
 YOUR_DOMAIN = 'http://127.0.0.1:5002'
 #for live of Stripe
 DOMAIN2 = 'https://studyvant.com'
 
-@app.route('/create-checkout-session', methods=['POST', 'GET'])
+def stripe_api():
+    # Imported on the first checkout rather than by every worker at boot
+    import stripe
+    stripe.api_key = os.environ.get('STRIPE_API')
+    return stripe
+
+@bp.route('/create-checkout-session', methods=['POST', 'GET'])
 def create_checkout_session():
+    stripe = stripe_api()
     plan = request.args.get('plan')
     try:
         if plan == '10':
@@ -360,29 +1325,64 @@ def create_checkout_session():
         return str(e)
     return redirect(checkout_session.url, code=303)
 
-@app.route('/cancel', methods=['POST', 'GET'])
+@bp.route('/cancel', methods=['POST', 'GET'])
 def cancel_session():
-    return redirect(url_for('price_page'))
+    return redirect(url_for('main.price_page'))
 
-@app.route('/success', methods=['POST', 'GET'])
+@bp.route('/success', methods=['POST', 'GET'])
 def success_session():
-    with app.app_context():
-        plan = request.args.get('plan')
-        g_user = current_user.get_id()
-        completed_update = db.session.execute(db.select(User).where(User.id == g_user)).scalar()
-        completed_update.picture_count = completed_update.picture_count + int(plan)
-        db.session.commit()
-    return redirect(url_for('picture_selector'))
+    plan = request.args.get('plan')
+    g_user = current_user.get_id()
+    add_credits(int(g_user), int(plan), f'purchase:{plan}')
+    db.session.commit()
+    forget_user(g_user)
+    return redirect(url_for('main.picture'))
 
-@app.route('/privacy-policy', methods=['POST', 'GET'])
+def add_credits(user_id, delta, reason):
+    # A single INSERT, so concurrent changes never overwrite each other.
+    # The caller commits.
+    db.session.execute(db.insert(CreditEntry).values(
+        user_id=user_id, delta=delta, reason=reason, applied=False, created_at=datetime.datetime.now()))
+
+def credit_balance(user_id):
+    pending = db.select(db.func.coalesce(db.func.sum(CreditEntry.delta), 0)).where(
+        CreditEntry.user_id == user_id, CreditEntry.applied.is_(False)).scalar_subquery()
+    return db.session.execute(db.select(User.picture_count + pending).where(User.id == user_id)).scalar()
+
+def compact_credits():
+    # Folds unapplied ledger entries into User.picture_count. The entries
+    # are claimed by the same UPDATE that marks them applied, so two
+    # compactions running at once can never both count an entry.
+    claimed = db.session.execute(
+        db.update(CreditEntry).where(CreditEntry.applied.is_(False)).values(applied=True)
+        .returning(CreditEntry.user_id, CreditEntry.delta)
+    ).all()
+    totals = {}
+    for user_id, delta in claimed:
+        totals[user_id] = totals.get(user_id, 0) + delta
+    for user_id, total in totals.items():
+        db.session.execute(db.update(User).where(User.id == user_id).values(picture_count=User.picture_count + total))
+    db.session.commit()
+    for user_id in totals:
+        forget_user(user_id)
+    return len(claimed)
+
+config['CREDIT_COMPACT_SECONDS'] = int(os.environ.get('CREDIT_COMPACT_SECONDS', 300))
+
+@bp.cli.command('compact-credits')
+def compact_credits_command():
+    """Fold pending credit ledger entries into users' picture counts."""
+    print(f'{compact_credits()} ledger entries applied')
+
+@bp.route('/privacy-policy', methods=['POST', 'GET'])
 def privacy_policy():
     return render_template("privacy_policy.html")
 
-@app.route('/terms-and-conditions', methods=['POST', 'GET'])
+@bp.route('/terms-and-conditions', methods=['POST', 'GET'])
 def terms_and_conditions():
     return render_template("terms_and_conditions.html")
 
-@app.route('/change-password', methods=["GET", "POST"])
+@bp.route('/change-password', methods=["GET", "POST"])
 def change_password():
     form = ChangePassword()
     g_user = current_user.get_id()
@@ -395,24 +1395,25 @@ def change_password():
         # Email doesn't exist
         if not user:
             flash("That email does not exist, please try again.")
-            return redirect(url_for('change_password'))
+            return redirect(url_for('main.change_password'))
         # Password incorrect
         elif not check_password_hash(user.password, password):
             flash('Password incorrect, please try again.')
-            return redirect(url_for('change_password'))
+            return redirect(url_for('main.change_password'))
         else:
-            completed_update = db.session.execute(db.select(User).where(User.id == g_user)).scalar()
+            completed_update = db.session.get(User, int(g_user))
             completed_update.password = generate_password_hash(
                     new_password,
                     method='pbkdf2:sha256',
                     salt_length=8)
             db.session.commit()
+            forget_user(g_user)
             flash('Password Changed')
-            return redirect(url_for('change_password'))
+            return redirect(url_for('main.change_password'))
 
     return render_template("change_password.html", form=form, current_user=current_user)
 
-@app.route('/feedback', methods=['POST', 'GET'])
+@bp.route('/feedback', methods=['POST', 'GET'])
 def feedback():
     form=Feedback_Form()
     if form.validate_on_submit():
@@ -424,149 +1425,166 @@ def feedback():
         )
         db.session.add(new_feedback)
         db.session.commit()
+        feedback_page_cache.clear()
         flash('Feedback submitted! Thank you for taking the time to help.')
-    feedback_list = Feedback.query.all()
-    # Get list of feedback IDs user has upvoted
+
+    is_admin = current_user.is_authenticated and current_user.id == 1
+    try:
+        feedback_items, feedback_ids = feedback_page(request.args.get('cursor'), is_admin)
+    except CursorError:
+        return redirect(url_for('main.feedback'))
+    # Get list of feedback IDs on this page the user has upvoted
     upvoted_feedback_ids = []
-    if current_user.is_authenticated:
-        upvoted_feedback_ids = [f.id for f in current_user.upvoted_feedback]
-    return render_template("feedback.html", form=form, feedback_list=feedback_list, upvoted_feedback_ids=upvoted_feedback_ids)
+    if current_user.is_authenticated and feedback_ids:
+        upvoted_feedback_ids = db.session.execute(
+            db.select(FeedbackUpvote.feedback_id).where(
+                FeedbackUpvote.user_id == current_user.id,
+                FeedbackUpvote.feedback_id.in_(feedback_ids),
+            )
+        ).scalars().all()
+    return render_template("feedback.html", form=form, feedback_items=feedback_items, upvoted_feedback_ids=upvoted_feedback_ids)
+
+FEEDBACK_PAGE_SIZE = 20
+# Rendered first page of the feedback list. It is the same for every
+# visitor (the admin's has delete buttons), so it is cached and this user's
+# votes are marked on the page afterwards. Cleared by submit, delete and
+# upvote; other processes see changes once the ttl runs out.
+config['FEEDBACK_CACHE_SECONDS'] = int(os.environ.get('FEEDBACK_CACHE_SECONDS', 30))
+feedback_page_cache = TTLCache(config['FEEDBACK_CACHE_SECONDS'])
 
-@app.route('/delete-feedback/<feedback_id>', methods=['POST'])
+def feedback_page(cursor, is_admin):
+    # (html, feedback ids) for one page of feedback, most upvoted first
+    if not cursor:
+        cached = feedback_page_cache.get(is_admin)
+        if cached:
+            return cached
+    feedback_list, next_cursor = keyset_page(Feedback.query, [Feedback.upvote_count, Feedback.id], cursor, FEEDBACK_PAGE_SIZE)
+    page = (
+        Markup(render_template('feedback_list.html', feedback_list=feedback_list, next_cursor=next_cursor, is_admin=is_admin)),
+        [f.id for f in feedback_list],
+    )
+    if not cursor:
+        feedback_page_cache.set(is_admin, page)
+    return page
+
+@bp.route('/delete-feedback/<feedback_id>', methods=['POST'])
 def delete_feedback(feedback_id):
     feedback = Feedback.query.get_or_404(feedback_id)
     db.session.delete(feedback)
     db.session.commit()
+    feedback_page_cache.clear()
     return jsonify({'success': True})
 
 # Add new route to handle upvotes
-@app.route('/upvote/<int:feedback_id>', methods=['POST'])
+@bp.route('/upvote/<int:feedback_id>', methods=['POST'])
 def upvote_feedback(feedback_id):
     if not current_user.is_authenticated:
         return jsonify({'error': 'Must be logged in to upvote'}), 401
         
-    feedback = Feedback.query.get_or_404(feedback_id)
-    
-    # Check if user already upvoted
-    existing_upvote = FeedbackUpvote.query.filter_by(
-        user_id=current_user.id,
-        feedback_id=feedback_id
-    ).first()
-    
-    if existing_upvote:
-        # Remove upvote if already voted
-        db.session.delete(existing_upvote)
-        feedback.upvote_count -= 1
-    else:
-        # Add new upvote
-        new_upvote = FeedbackUpvote(user_id=current_user.id, feedback_id=feedback_id)
-        db.session.add(new_upvote)
-        feedback.upvote_count += 1
-    
+    Feedback.query.get_or_404(feedback_id)
+
+    # Toggle: remove the vote if there is one, otherwise add it. The unique
+    # index turns a racing second insert into an IntegrityError instead of
+    # a duplicate vote, and the count only moves by what actually changed.
+    removed = db.session.execute(db.delete(FeedbackUpvote).where(
+        FeedbackUpvote.user_id == current_user.id,
+        FeedbackUpvote.feedback_id == feedback_id,
+    )).rowcount
+    change = -removed
+    upvoted = False
+    if not removed:
+        upvoted = True
+        try:
+            with db.session.begin_nested():
+                db.session.execute(db.insert(FeedbackUpvote).values(user_id=current_user.id, feedback_id=feedback_id))
+            change = 1
+        except IntegrityError:
+            # Another click already added it
+            change = 0
+
+    if change:
+        # Counted in the database, so concurrent votes are never lost
+        db.session.execute(db.update(Feedback).where(Feedback.id == feedback_id)
+                           .values(upvote_count=Feedback.upvote_count + change))
     db.session.commit()
-    return jsonify({'upvote_count': feedback.upvote_count})
+    feedback_page_cache.clear()
+    upvote_count = db.session.execute(db.select(Feedback.upvote_count).where(Feedback.id == feedback_id)).scalar()
+    return jsonify({'upvote_count': upvote_count, 'upvoted': upvoted})
 
-def send_verification_email(email, token):
-    try:
-        sender_email = os.environ.get('EMAIL_ADDRESS')
-        sender_password = os.environ.get('EMAIL_PASSWORD')
-        
-        if not sender_email or not sender_password:
-            print("Email credentials not found in environment variables")
-            flash("Error sending verification email. Please contact support.")
-            return False
-        
-        # Create MIME message
-        msg = MIMEMultipart()
-        msg['From'] = sender_email
-        msg['To'] = email
-        msg['Subject'] = f"Verify Your {APP_NAME} Account"
-        
-        # Create HTML body
-        html = f"""
-        <html>
-            <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
-                <div style="background-color: #f8f9fa; padding: 20px; text-align: center;">
-                    <h1 style="color: #333;">Welcome to {APP_NAME}!</h1>
+def queue_verification_email(email, token):
+    # Adds the email to the outbox; it goes out when the caller commits
+    html = f"""
+    <html>
+        <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
+            <div style="background-color: #f8f9fa; padding: 20px; text-align: center;">
+                <h1 style="color: #333;">Welcome to {APP_NAME}!</h1>
+            </div>
+            <div style="padding: 20px;">
+                <p>Thank you for registering! Please verify your email address to complete your account setup.</p>
+                <div style="text-align: center; margin: 30px 0;">
+                    <a href="{YOUR_DOMAIN}/verify/{token}" 
+                       style="background-color: #007bff; color: white; padding: 12px 25px; 
+                              text-decoration: none; border-radius: 5px;">
+                        Verify Email
+                    </a>
                 </div>
-                <div style="padding: 20px;">
-                    <p>Thank you for registering! Please verify your email address to complete your account setup.</p>
-                    <div style="text-align: center; margin: 30px 0;">
-                        <a href="{YOUR_DOMAIN}/verify/{token}" 
-                           style="background-color: #007bff; color: white; padding: 12px 25px; 
-                                  text-decoration: none; border-radius: 5px;">
-                            Verify Email
-                        </a>
-                    </div>
-                    <p style="color: #666; font-size: 0.9em;">
-                        If the button doesn't work, copy and paste this link into your browser:<br>
-                        {YOUR_DOMAIN}/verify/{token}
-                    </p>
-                </div>
-            </body>
-        </html>
-        """
-        
-        msg.attach(MIMEText(html, 'html'))
-        
-        # Send email
-        with smtplib.SMTP("smtp.gmail.com", port=587) as connection:
-            connection.starttls()
-            try:
-                connection.login(user=sender_email, password=sender_password)
-                connection.send_message(msg)
-                return True
-            except smtplib.SMTPAuthenticationError:
-                print("Failed to authenticate with Gmail")
-                flash("Error sending verification email. Please contact support.")
-                return False
-                
-    except Exception as e:
-        print(f"Error sending email: {str(e)}")
-        flash("Error sending verification email. Please contact support.")
-        return False
+                <p style="color: #666; font-size: 0.9em;">
+                    If the button doesn't work, copy and paste this link into your browser:<br>
+                    {YOUR_DOMAIN}/verify/{token}
+                </p>
+            </div>
+        </body>
+    </html>
+    """
+    now = datetime.datetime.now()
+    db.session.add(OutboxEmail(
+        to_address=email,
+        subject=f"Verify Your {APP_NAME} Account",
+        html=html,
+        next_attempt_at=now,
+        created_at=now,
+    ))
 
-@app.route('/verify/<token>')
+@bp.route('/verify/<token>')
 def verify_email(token):
     user = User.query.filter_by(verification_token=token).first()
     if user:
         user.verified = True
         user.verification_token = None  # Clear the token after use
         db.session.commit()
+        forget_user(user.id)
         flash("Your email has been verified! You can now log in.")
     else:
         flash("Invalid verification token.")
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/resend-verification', methods=['POST'])
+@bp.route('/resend-verification', methods=['POST'])
 def resend_verification():
     email = request.form.get('email')
     if not email:
         flash("Please enter your email address first.")
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
         
     user = User.query.filter_by(email=email.lower()).first()
     if not user:
         flash("No account found with that email address.")
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
         
     if user.verified:
         flash("This email is already verified.")
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
         
     # Generate new verification token
     new_token = secrets.token_urlsafe(32)
     user.verification_token = new_token
+    queue_verification_email(user.email, new_token)
     db.session.commit()
-    
-    if send_verification_email(email, new_token):
-        flash("Verification email has been resent. Please check your inbox and spam folder. Email will come from mwdynamics@gmail.com")
-    else:
-        flash("Error sending verification email. Please try again or contact support.")
-    
-    return redirect(url_for('login'))
+    outbox_sender.notify()
 
-@app.route('/user-dashboard', methods=['POST', 'GET'])
+    flash("Verification email has been resent. Please check your inbox and spam folder. Email will come from mwdynamics@gmail.com")
+    return redirect(url_for('main.login'))
+
+@bp.route('/user-dashboard', methods=['POST', 'GET'])
 def user_dashboard():
     # Get today's date
     today = datetime.date.today()
@@ -576,25 +1594,25 @@ def user_dashboard():
     new_users = User.query.filter(
         User.date_of_signup >= three_days_ago
     ).all()
-    # Get current user
-    current_user_data = User.query.filter_by(id=current_user.id).first()
+    # Get current user, from the identity map if load_user already read it
+    current_user_data = db.session.get(User, current_user.id)
     return render_template("user_dashboard.html", new_users=new_users, current_user_data=current_user_data)
 
-@app.route('/education-resources', methods=['POST', 'GET'])
+@bp.route('/education-resources', methods=['POST', 'GET'])
 def education_resources():
     return render_template("education_resources.html")
 
-@app.route('/crop-multiple-pictures', methods=['POST'])
+@bp.route('/crop-multiple-pictures', methods=['POST'])
 def crop_multiple_pictures():
     if not current_user.is_authenticated:
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     # Get selected picture IDs from form
     picture_ids = request.form.getlist('picture_ids')
     
     if not picture_ids:
         flash('No pictures selected')
-        return redirect(url_for('picture'))
+        return redirect(url_for('main.picture'))
     
     # Get all pictures that belong to current user
     pictures = Picture.query.filter(
@@ -604,11 +1622,289 @@ def crop_multiple_pictures():
     
     if not pictures:
         flash('No valid pictures found')
-        return redirect(url_for('picture'))
+        return redirect(url_for('main.picture'))
     
-    return render_template('crop_picture.html', pictures=pictures)
+    return render_cropper(pictures[0], pictures)
+
+@bp.route('/crop-batch', methods=['POST'])
+def crop_batch():
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+
+    data = json_object() if request.is_json else request.form.to_dict()
+    picture_ids = data.get('picture_ids') if request.is_json else request.form.getlist('picture_ids')
+    if not picture_ids:
+        return jsonify({'success': False, 'error': 'No pictures selected'}), 400
+
+    try:
+        spec = parse_batch_spec(data, current_app.config['MAX_IMAGE_PIXELS'])
+        picture_ids = [int(pid) for pid in picture_ids]
+    except (CropError, TypeError, ValueError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    # Get all pictures that belong to current user
+    pictures = Picture.query.filter(
+        Picture.id.in_(picture_ids),
+        Picture.user_id == current_user.id
+    ).all()
+    if not pictures:
+        return jsonify({'success': False, 'error': 'No valid pictures found'}), 404
+
+    cost = batch_cost(pictures, spec)
+    if data.get('async'):
+        pixel_budget.check(cost)
+        return enqueue_job('batch', {'picture_ids': [picture.id for picture in pictures], 'spec': spec})
+
+    # Held until the ZIP has been sent, whether or not the client reads it all
+    pixel_budget.acquire(cost)
+
+    # Each crop is written into the ZIP as soon as its pool process finishes
+    results = run_batch(batch_items(pictures), spec, current_app.config['BATCH_WORKERS'])
+    response = Response(stream_zip(results), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename='cropped_pictures.zip')
+    response.call_on_close(lambda: pixel_budget.release(cost))
+    return response
+
+def batch_cost(pictures, spec):
+    # Up to BATCH_WORKERS crops are decoded at once, so charge that many of
+    # the largest, each with the resized output it is making
+    largest = max(original_cost(picture) for picture in pictures)
+    if spec['mode'] == 'resolution':
+        largest += estimate_cost(spec['width'], spec['height'], copies=1)
+    return largest * min(len(pictures), current_app.config['BATCH_WORKERS'])
+
+def batch_items(pictures):
+    # (name, source) pairs for run_batch(); sources must be picklable
+    items = []
+    for picture in pictures:
+        name, ext = os.path.splitext(picture.filename)
+        source = storage.local_path(picture.original_path)
+        if source is None:
+            with storage.open(picture.original_path) as f:
+                source = BytesIO(f.read())
+        items.append((f"{name}_cropped{ext}", source))
+    return items
+
+def enqueue_job(kind, params):
+    now = datetime.datetime.now()
+    job = CropJob(user_id=current_user.id, kind=kind, params=params, status='queued',
+                  progress=0, attempts=0, max_attempts=3, created_at=now, updated_at=now)
+    db.session.add(job)
+    db.session.commit()
+    return jsonify({'success': True, 'job_id': job.id,
+                    'status_url': url_for('main.job_status', job_id=job.id)}), 202
+
+def job_result_path(job_id):
+    return os.path.join(current_app.config['JOB_RESULT_FOLDER'], f'{job_id}.zip')
+
+def run_batch_job(job, report_progress):
+    params = job.params
+    pictures = Picture.query.filter(
+        Picture.id.in_(params['picture_ids']),
+        Picture.user_id == job.user_id
+    ).all()
+    total = len(pictures)
+
+    def counted(results):
+        for done, result in enumerate(results, 1):
+            report_progress(done * 100 // total)
+            yield result
+
+    path = job_result_path(job.id)
+    with pixel_budget.reserve(batch_cost(pictures, params['spec']), max_wait=JOB_ADMISSION_WAIT_SECONDS):
+        write_zip(path, counted(run_batch(batch_items(pictures), params['spec'], current_app.config['BATCH_WORKERS'])))
+    return path
+
+def run_export_job(job, report_progress):
+    params = job.params
+    picture = Picture.query.filter_by(id=params['picture_id'], user_id=job.user_id).first()
+    if not picture:
+        raise CropError('Picture no longer exists')
+    source = batch_items([picture])[0][1]
+    cost = crop_cost(picture, params['box'], params['targets'])
+    with pixel_budget.reserve(cost, max_wait=JOB_ADMISSION_WAIT_SECONDS):
+        report_progress(10)
+        # Same pool as batch crops, so the decode does not run in the web process
+        future = get_pool(current_app.config['BATCH_WORKERS']).submit(
+            export_bundle, source, params['box'], params['targets'], params['name'])
+        results = future.result()
+    report_progress(90)
+    path = job_result_path(job.id)
+    write_zip(path, results)
+    return path
+
+# Queued jobs have no client waiting on them, so they can wait longer for
+# room in the pixel budget before counting as a failed attempt
+JOB_ADMISSION_WAIT_SECONDS = 60
+
+# Finished jobs and their ZIPs are kept this long for the client to fetch
+config['JOB_RETENTION_HOURS'] = float(os.environ.get('JOB_RETENTION_HOURS', 72))
+config['JOB_EXPIRE_SECONDS'] = int(os.environ.get('JOB_EXPIRE_SECONDS', 3600))
+
+def expire_jobs():
+    # Deletes done and failed jobs older than JOB_RETENTION_HOURS with their
+    # result files, plus temp files left behind by workers that died while
+    # writing. Rows go first, so a result is never served after its file is gone.
+    cutoff = datetime.datetime.now() - datetime.timedelta(hours=current_app.config['JOB_RETENTION_HOURS'])
+    expired = db.session.execute(
+        db.delete(CropJob).where(CropJob.status.in_(('done', 'failed')), CropJob.updated_at < cutoff)
+        .returning(CropJob.result_path)
+    ).scalars().all()
+    db.session.commit()
+    for path in expired:
+        if path:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    folder = current_app.config['JOB_RESULT_FOLDER']
+    for entry in os.scandir(folder):
+        if entry.name.endswith('.part') and entry.stat().st_mtime < cutoff.timestamp():
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+    return len(expired)
+
+@bp.cli.command('expire-jobs')
+def expire_jobs_command():
+    """Delete finished crop jobs and their results once past retention."""
+    print(f'{expire_jobs()} jobs expired')
+
+job_runner = JobRunner(db, CropJob, {'batch': run_batch_job, 'export': run_export_job},
+                       threads=config['CROP_JOB_THREADS'],
+                       periodic=[(config['CREDIT_COMPACT_SECONDS'], compact_credits),
+                                 (config['JOB_EXPIRE_SECONDS'], expire_jobs)])
+
+# Outgoing mail. Login is skipped when no credentials are set, e.g. for a
+# local relay.
+config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
+config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 587))
+config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', '1') != '0'
+config['MAIL_SENDER'] = os.environ.get('MAIL_SENDER') or os.environ.get('EMAIL_ADDRESS') or 'mwdynamics@gmail.com'
+# Messages sent over one SMTP session before it is reopened
+config['MAIL_SESSION_MESSAGES'] = int(os.environ.get('MAIL_SESSION_MESSAGES', 100))
+# Set to 0 where `flask send-mail` runs as its own process instead
+config['MAIL_SEND_IN_BACKGROUND'] = os.environ.get('MAIL_SEND_IN_BACKGROUND', '1') != '0'
+
+outbox_sender = OutboxSender(
+    db, OutboxEmail,
+    SMTPConnection(config['MAIL_SERVER'], config['MAIL_PORT'],
+                   os.environ.get('EMAIL_ADDRESS'), os.environ.get('EMAIL_PASSWORD'),
+                   starttls=config['MAIL_USE_TLS'], max_messages=config['MAIL_SESSION_MESSAGES']),
+    config['MAIL_SENDER'])
+
+# Database engine profile, see database.py. WEB_CONCURRENCY is gunicorn's
+# worker count and WEB_THREADS its --threads; with the job and mail threads
+# they size the PostgreSQL pool. Set DB_STATEMENT_TIMEOUT_MS=0 for
+# migrations that may run longer than a request should.
+config['DB_PROFILE'] = profile_for(config['SQLALCHEMY_DATABASE_URI'], os.environ.get('DB_PROFILE', 'auto'))
+config['SQLITE_PRAGMAS'] = sqlite_pragmas(int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 15000)),
+                                          int(os.environ.get('SQLITE_MMAP_MB', 128)))
+config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+    config['DB_PROFILE'],
+    workers=int(os.environ.get('WEB_CONCURRENCY', 1)),
+    threads=int(os.environ.get('WEB_THREADS', 1)) + config['CROP_JOB_THREADS'] + config['MAIL_SEND_IN_BACKGROUND'],
+    max_connections=int(os.environ.get('DB_MAX_CONNECTIONS', 90)),
+    pool_recycle=int(os.environ.get('DB_POOL_RECYCLE_SECONDS', 1800)),
+    statement_timeout_ms=int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 30000)),
+)
+
+@bp.before_app_request
+def start_job_runner():
+    job_runner.ensure_started()
+    if current_app.config['MAIL_SEND_IN_BACKGROUND']:
+        outbox_sender.ensure_started()
+
+@bp.cli.command('backfill-phash')
+def backfill_phash():
+    """Compute perceptual hashes for originals stored without one."""
+    done, failed, last = 0, 0, ''
+    while True:
+        # Walks content_hash order so originals that fail are not retried forever
+        originals = (StoredOriginal.query
+                     .filter(StoredOriginal.phash.is_(None), StoredOriginal.content_hash > last)
+                     .order_by(StoredOriginal.content_hash).limit(200).all())
+        if not originals:
+            break
+        for original in originals:
+            try:
+                if not storage.exists(preview_key(original.storage_key, THUMBNAIL_SIZE)):
+                    store_thumbnail(original)
+                original.phash = thumbnail_hash(original.storage_key)
+                done += 1
+            except (OSError, AdmissionError) as e:
+                failed += 1
+                print(f'{original.storage_key}: {e}')
+        last = originals[-1].content_hash
+        db.session.commit()
+        print(f'{done} originals hashed, {failed} failed')
+
+@bp.cli.command('send-mail')
+def send_mail():
+    """Send queued emails in the foreground."""
+    outbox_sender.run_forever()
+
+@bp.cli.command('crop-worker')
+def crop_worker():
+    """Run queued crop jobs in the foreground."""
+    job_runner.run_forever(worker_name('cli'))
+
+@bp.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+
+    job = CropJob.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job.progress,
+        'attempts': job.attempts,
+        'error': job.error,
+        'result_url': url_for('main.job_result', job_id=job.id) if job.status == 'done' else None,
+    })
+
+@bp.route('/jobs/<int:job_id>/result')
+def job_result(job_id):
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+
+    job = CropJob.query.filter_by(id=job_id, user_id=current_user.id, status='done').first_or_404()
+    return send_file(job.result_path, mimetype='application/zip', as_attachment=True,
+                     download_name=f'crop_job_{job.id}.zip')
+
+@bp.route('/metrics')
+def metrics():
+    # Prometheus scrape target, for every worker sharing METRICS_DIR. Only
+    # answered over loopback, so scrape it from the host or a sidecar.
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(404)
+    return Response(app_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def create_app():
+    # gunicorn 'main:create_app()'; the flask command finds it on its own
+    app = Flask(__name__)
+    app.config.from_mapping(config)
+    ckeditor.init_app(app)
+    bootstrap.init_app(app)
+    login_manager.init_app(app)
+    db.init_app(app)
+    app.register_blueprint(bp)
+    app_metrics.init_app(app)
+    with app.app_context():
+        tune_engine(db.engine, app.config['DB_PROFILE'], app.config['SQLITE_PRAGMAS'])
+        app_metrics.instrument_engine(db.engine)
+    job_runner.init_app(app)
+    outbox_sender.init_app(app)
+    return app
 
 if __name__ == "__main__":
+    app = create_app()
+    with app.app_context():
+        init_db()
     app.run(debug=True, port=5002)
 
 
@@ -0,0 +1,360 @@
+import atexit
+import contextvars
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+# Upper bounds in seconds; the +Inf bucket is implicit
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Endpoint label for work done outside a request (job threads, CLI)
+BACKGROUND = 'background'
+# Endpoint label for requests that matched no route
+UNMATCHED = 'unmatched'
+
+
+class RequestStats:
+    # What the current request has done so far, for the per-request figures
+    __slots__ = ('endpoint', 'statements', 'db_seconds', 'stages')
+
+    def __init__(self):
+        self.endpoint = None
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.stages = {}
+
+
+_current = contextvars.ContextVar('request_stats', default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def _format_number(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Metrics:
+    # Counters, gauges and histograms for this process, written every
+    # flush_seconds by a background thread to <directory>/<pid>-<token>.json.
+    # render() merges the files of every process sharing the directory, so
+    # whichever gunicorn worker answers a scrape reports the totals for all
+    # of them, at most flush_seconds old. When a worker exits its counters
+    # and histograms are folded into archive.json so they never go
+    # backwards; its gauges are dropped.
+
+    def __init__(self, directory, flush_seconds=1.0):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self._kinds = {}
+        self._values = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._pid = None
+        self._path = None
+
+        self.gauge('http_requests_in_flight', 'Requests being handled or sent right now')
+        self.histogram('http_request_duration_seconds',
+                       'Time from the start of a request to the last byte of its response')
+        self.counter('http_requests_total', 'Requests by endpoint, method and status')
+        self.counter('http_request_bytes_total', 'Request body bytes received, by Content-Length')
+        self.counter('http_response_bytes_total', 'Response body bytes sent')
+        self.counter('db_statements_total', 'SQL statements executed')
+        self.histogram('db_statement_duration_seconds', 'Time per SQL statement')
+        self.histogram('db_statements_per_request', 'SQL statements executed by one request', COUNT_BUCKETS)
+        self.histogram('db_seconds_per_request', 'Time one request spent in SQL statements')
+        self.histogram('image_stage_seconds',
+                       'Time one request spent in each stage of its image work, send included')
+
+    def counter(self, name, help):
+        self._kinds[name] = ('counter', help, None)
+
+    def gauge(self, name, help):
+        self._kinds[name] = ('gauge', help, None)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        self._kinds[name] = ('histogram', help, tuple(buckets))
+
+    def inc(self, name, amount=1, **labels):
+        # Counters and gauges; a gauge goes down with a negative amount
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._check_process()
+            self._values[key] = self._values.get(key, 0) + amount
+            self._dirty = True
+
+    def observe(self, name, value, **labels):
+        buckets = self._kinds[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._check_process()
+            # A count per bucket, then the +Inf bucket, then the sum
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(buckets) + 2)
+            counts[bisect_left(buckets, value)] += 1
+            counts[-1] += value
+            self._dirty = True
+
+    def _check_process(self):
+        # First record in this process, or the first since a fork: values
+        # inherited from the parent are in the parent's file already
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._path = os.path.join(self.directory, f'{self._pid}-{uuid.uuid4().hex[:8]}.json')
+        self._values = {}
+        threading.Thread(target=self._flush_forever, daemon=True, name='metrics-flush').start()
+        atexit.register(self.flush)
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty or self._pid != os.getpid():
+                return
+            values = [[name, labels, value if not isinstance(value, list) else list(value)]
+                      for (name, labels), value in self._values.items()]
+            self._dirty = False
+            path = self._path
+        os.makedirs(self.directory, exist_ok=True)
+        self._write(path, {'pid': os.getpid(), 'values': values})
+
+    def _write(self, path, data):
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+
+    def _read(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _merge(self, totals, values, gauges=True):
+        for name, labels, value in values:
+            kind = self._kinds.get(name)
+            if kind is None or (kind[0] == 'gauge' and not gauges):
+                continue
+            key = (name, tuple(tuple(pair) for pair in labels))
+            if kind[0] != 'histogram':
+                totals[key] = totals.get(key, 0) + value
+                continue
+            current = totals.get(key)
+            if current is None:
+                totals[key] = list(value)
+            elif len(current) == len(value):
+                totals[key] = [a + b for a, b in zip(current, value)]
+
+    def collect(self):
+        # {(name, labels): value} summed over every process, live or exited
+        self.flush()
+        os.makedirs(self.directory, exist_ok=True)
+        archive_path = os.path.join(self.directory, 'archive.json')
+        totals = {}
+        with open(os.path.join(self.directory, 'archive.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            archive = self._read(archive_path) or {'values': []}
+            archived = {}
+            self._merge(archived, archive['values'])
+            dead = []
+            for filename in sorted(os.listdir(self.directory)):
+                if not filename.endswith('.json') or filename == 'archive.json':
+                    continue
+                path = os.path.join(self.directory, filename)
+                data = self._read(path)
+                if data is None:
+                    continue
+                if _pid_alive(data['pid']):
+                    self._merge(totals, data['values'])
+                else:
+                    self._merge(archived, data['values'], gauges=False)
+                    dead.append(path)
+            if dead:
+                self._write(archive_path, {'pid': 0, 'values': [
+                    [name, [list(pair) for pair in labels], value] for (name, labels), value in archived.items()]})
+                for path in dead:
+                    os.remove(path)
+        self._merge(totals, [[name, labels, value] for (name, labels), value in archived.items()])
+        return totals
+
+    def render(self):
+        # Prometheus text exposition format, version 0.0.4
+        totals = self.collect()
+        lines = []
+        for name, (kind, help, buckets) in self._kinds.items():
+            series = sorted((labels, value) for (series_name, labels), value in totals.items() if series_name == name)
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in series:
+                if kind != 'histogram':
+                    lines.append(f'{name}{_format_labels(labels)} {_format_number(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], value[:-1]):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else _format_number(bound)
+                    lines.append(f'{name}_bucket{_format_labels(labels, [("le", le)])} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_number(value[-1])}')
+                lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+    @contextmanager
+    def stage(self, name):
+        # Times one stage of the current request's image work. A stage
+        # entered more than once in a request is reported as one total.
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stats = _current.get()
+            if stats is None:
+                self.observe('image_stage_seconds', elapsed, endpoint=BACKGROUND, stage=name)
+            else:
+                stats.stages[name] = stats.stages.get(name, 0.0) + elapsed
+
+    def init_app(self, app):
+        app.wsgi_app = RequestMetrics(app.wsgi_app, self)
+
+        @app.before_request
+        def record_endpoint():
+            from flask import request
+            stats = _current.get()
+            if stats is not None:
+                stats.endpoint = request.endpoint
+
+    def instrument_engine(self, engine):
+        # Statement counts and times, for the request that ran them
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - conn.info['metrics_start'].pop()
+            stats = _current.get()
+            endpoint = BACKGROUND if stats is None else stats.endpoint or UNMATCHED
+            if stats is not None:
+                stats.statements += 1
+                stats.db_seconds += elapsed
+            self.inc('db_statements_total', endpoint=endpoint)
+            self.observe('db_statement_duration_seconds', elapsed, endpoint=endpoint)
+
+
+class RequestMetrics:
+    # WSGI middleware around the Flask app. A request is timed from when it
+    # reaches the app until the server closes its response, so sending the
+    # body counts too; that last part is also reported as the "send" stage
+    # for requests that timed any image stages.
+
+    def __init__(self, wsgi_app, metrics):
+        self.wsgi_app = wsgi_app
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        stats = RequestStats()
+        _current.set(stats)
+        start = time.perf_counter()
+        self.metrics.inc('http_requests_in_flight')
+        response = {}
+
+        def capture(status, headers, exc_info=None):
+            response['status'] = status.split(' ', 1)[0]
+            response['length'] = next((int(value) for key, value in headers if key.lower() == 'content-length'), None)
+            return start_response(status, headers, exc_info)
+
+        try:
+            body = self.wsgi_app(environ, capture)
+        except BaseException:
+            response.setdefault('status', '500')
+            self._finish(environ, stats, start, start, response, 0)
+            raise
+        returned = time.perf_counter()
+
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if response.get('length') is not None and file_wrapper and isinstance(body, file_wrapper):
+            # Wrapping a file response would stop the server using sendfile,
+            # so hook its close() instead
+            close = getattr(body, 'close', None)
+
+            def close_and_finish():
+                try:
+                    if close:
+                        close()
+                finally:
+                    self._finish(environ, stats, start, returned, response, response['length'])
+
+            body.close = close_and_finish
+            return body
+        return self._counted(body, environ, stats, start, returned, response)
+
+    def _counted(self, body, environ, stats, start, returned, response):
+        sent = 0
+        try:
+            for chunk in body:
+                sent += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            self._finish(environ, stats, start, returned, response, sent)
+
+    def _finish(self, environ, stats, start, returned, response, sent):
+        end = time.perf_counter()
+        _current.set(None)
+        metrics = self.metrics
+        endpoint = stats.endpoint or UNMATCHED
+        metrics.inc('http_requests_in_flight', -1)
+        metrics.observe('http_request_duration_seconds', end - start, endpoint=endpoint)
+        metrics.inc('http_requests_total', endpoint=endpoint, method=environ.get('REQUEST_METHOD', ''),
+                    status=response.get('status', ''))
+        try:
+            received = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            received = 0
+        metrics.inc('http_request_bytes_total', received, endpoint=endpoint)
+        metrics.inc('http_response_bytes_total', sent, endpoint=endpoint)
+        metrics.observe('db_statements_per_request', stats.statements, endpoint=endpoint)
+        metrics.observe('db_seconds_per_request', stats.db_seconds, endpoint=endpoint)
+        if stats.stages:
+            stats.stages['send'] = end - returned
+            for name, seconds in stats.stages.items():
+                metrics.observe('image_stage_seconds', seconds, endpoint=endpoint, stage=name)
@@ -0,0 +1,24 @@
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+
+
+def upgrade_schema(db):
+    # create_all() only creates tables that are missing. This brings tables
+    # that already exist up to date with the models: it adds indexes and any
+    # new nullable columns. Nothing is ever dropped or altered.
+    engine = db.engine
+    inspector = inspect(engine)
+    existing = set(inspector.get_table_names())
+    preparer = engine.dialect.identifier_preparer
+
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing:
+                continue
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns and column.nullable:
+                    ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                    conn.exec_driver_sql(f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {ddl}')
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
@@ -0,0 +1,50 @@
+import base64
+import datetime
+import json
+
+from sqlalchemy import Date, DateTime, tuple_
+
+
+class CursorError(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    # Opaque, URL-safe token holding the sort key of the last row sent
+    data = json.dumps(values, default=lambda v: v.isoformat(), separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError
+        return [_load(column, value) for column, value in zip(columns, values)]
+    except (ValueError, TypeError):
+        raise CursorError('Invalid cursor')
+
+
+def _load(column, value):
+    if isinstance(column.type, DateTime):
+        return datetime.datetime.fromisoformat(value)
+    if isinstance(column.type, Date):
+        return datetime.date.fromisoformat(value)
+    # Anything else must already be the column's type, not a list or object
+    if not isinstance(value, column.type.python_type) or isinstance(value, bool):
+        raise ValueError
+    return value
+
+
+def keyset_page(query, columns, cursor=None, limit=50):
+    # One page of query, newest first by `columns` (the last of which must be
+    # unique, e.g. the id). Instead of OFFSET, the page starts just below the
+    # cursor's sort key, so with an index on the columns every page costs the
+    # same however deep it is. Returns (rows, next_cursor or None).
+    if cursor:
+        query = query.filter(tuple_(*columns) < tuple_(*decode_cursor(cursor, columns)))
+    rows = query.order_by(*(column.desc() for column in columns)).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor([getattr(rows[-1], column.key) for column in columns])
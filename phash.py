@@ -0,0 +1,141 @@
+from collections import defaultdict
+from functools import lru_cache
+from itertools import combinations
+
+import numpy as np
+from PIL import Image
+
+
+# dHash: a 9x8 greyscale proxy, one bit per horizontally adjacent pair
+HASH_WIDTH = 9
+HASH_HEIGHT = 8
+# Default "near-duplicate" distance, out of 64 bits
+DEFAULT_DISTANCE = 6
+
+
+def dhash(source):
+    # 64-bit difference hash of an image. Robust to rescaling, recompression
+    # and small edits; anything made from the same shot lands within a few bits.
+    with Image.open(source) as img:
+        img.draft('L', (HASH_WIDTH * 8, HASH_HEIGHT * 8))
+        small = img.convert('L').resize((HASH_WIDTH, HASH_HEIGHT), Image.Resampling.BOX)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def to_signed(value):
+    # Databases store 64-bit integers signed
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def from_signed(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+# Set bits in each byte value, for counting bits across a whole array
+_POPCOUNT = np.array([bin(n).count('1') for n in range(256)], dtype=np.uint8)
+
+
+class HashIndex:
+    # Multi-index hashing: each 64-bit hash is split into four 16-bit
+    # chunks, and every chunk position gets a sorted table of its values.
+    # Two hashes within distance k must match within k // 4 bits in at
+    # least one chunk, so a search only looks up the query's chunks (and
+    # their near neighbours) in those tables and checks the few candidates
+    # it finds in full, instead of comparing against every hash. Everything
+    # is held in NumPy arrays, so a million hashes are a few dozen MB and
+    # add nothing for the garbage collector to walk. The index is built once
+    # and rebuilt, not updated, when the hashes change.
+
+    CHUNKS = 4
+    CHUNK_BITS = 16
+
+    def __init__(self, items=()):
+        items = list(items)
+        self.keys = np.array([key for key, _ in items], dtype=np.int64)
+        self.values = np.array([value for _, value in items], dtype=np.uint64)
+        self.key_order = np.argsort(self.keys, kind='stable')
+        self.tables = []
+        for n in range(self.CHUNKS):
+            chunks = ((self.values >> np.uint64(n * self.CHUNK_BITS)) & np.uint64(0xFFFF)).astype(np.uint16)
+            order = np.argsort(chunks, kind='stable').astype(np.int32)
+            self.tables.append((chunks[order], order))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _position(self, key):
+        n = np.searchsorted(self.keys, key, sorter=self.key_order)
+        if n < len(self.keys) and self.keys[self.key_order[n]] == key:
+            return self.key_order[n]
+        return None
+
+    def __contains__(self, key):
+        return self._position(key) is not None
+
+    def __getitem__(self, key):
+        position = self._position(key)
+        if position is None:
+            raise KeyError(key)
+        return int(self.values[position])
+
+    def items(self):
+        return zip(self.keys.tolist(), self.values.tolist())
+
+    def search(self, value, distance=DEFAULT_DISTANCE):
+        # [(key, distance)] for every hash within `distance` of value, nearest first
+        masks = _flip_masks(distance // self.CHUNKS, self.CHUNK_BITS)
+        candidates = []
+        for n, (chunks, order) in enumerate(self.tables):
+            neighbours = masks ^ np.uint16((value >> (n * self.CHUNK_BITS)) & 0xFFFF)
+            starts = np.searchsorted(chunks, neighbours, 'left')
+            ends = np.searchsorted(chunks, neighbours, 'right')
+            hit = ends > starts
+            candidates.extend(order[start:end] for start, end in zip(starts[hit], ends[hit]))
+        if not candidates:
+            return []
+
+        positions = np.unique(np.concatenate(candidates))
+        differing = self.values[positions] ^ np.uint64(value)
+        distances = _POPCOUNT[differing.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+        close = distances <= distance
+        found = list(zip(self.keys[positions[close]].tolist(), distances[close].tolist()))
+        found.sort(key=lambda pair: (pair[1], pair[0]))
+        return found
+
+    def groups(self, distance=DEFAULT_DISTANCE):
+        # Lists of keys linked by chains of near-duplicates, largest first.
+        # Keys with no near-duplicate are left out.
+        parent = {}
+
+        def root(key):
+            parent.setdefault(key, key)
+            while parent[key] != key:
+                parent[key] = parent[parent[key]]
+                key = parent[key]
+            return key
+
+        for key, value in self.items():
+            for other, _ in self.search(value, distance):
+                a, b = root(key), root(other)
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+
+        members = defaultdict(list)
+        for key in parent:
+            members[root(key)].append(key)
+        return sorted((sorted(keys) for keys in members.values() if len(keys) > 1),
+                      key=lambda keys: (-len(keys), keys[0]))
+
+
+@lru_cache(maxsize=None)
+def _flip_masks(radius, bits):
+    # XOR masks for every way of flipping up to `radius` of `bits` bits
+    return np.array([sum(1 << p for p in positions)
+                     for r in range(radius + 1) for positions in combinations(range(bits), r)], dtype=np.uint16)
+
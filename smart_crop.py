@@ -0,0 +1,161 @@
+import numpy as np
+from PIL import Image, ImageOps
+
+
+# Long edge of the proxy the maps are computed on
+PROXY_SIZE = 256
+# Window sizes tried, as a fraction of the largest window with the aspect
+SCALES = (1.0, 0.9, 0.8, 0.7, 0.6)
+# Score bonus per unit of area left out, so a tighter crop wins when it
+# keeps nearly all of the interesting content
+TIGHTNESS = 0.15
+# Weights of the three maps in the combined saliency map
+EDGE_WEIGHT = 0.4
+ENTROPY_WEIGHT = 0.3
+SKIN_WEIGHT = 0.3
+
+
+def load_proxy(source):
+    # Returns the proxy as a float32 RGB array and the size of the full
+    # image as displayed (after EXIF orientation).
+    with Image.open(source) as img:
+        full_size = img.size[::-1] if _swaps_axes(img) else img.size
+        # JPEG: decode straight at 1/2, 1/4 or 1/8 scale in the DCT
+        img.draft('RGB', (PROXY_SIZE, PROXY_SIZE))
+        img = ImageOps.exif_transpose(img).convert('RGB')
+        img.thumbnail((PROXY_SIZE, PROXY_SIZE), Image.Resampling.BILINEAR, reducing_gap=2.0)
+        return np.asarray(img, dtype=np.float32), full_size
+
+
+def _swaps_axes(img):
+    # EXIF orientations 5-8 rotate by 90 degrees
+    return img.getexif().get(0x0112, 1) in (5, 6, 7, 8)
+
+
+def integral(values):
+    # Summed-area table with a zero row and column in front
+    table = np.zeros((values.shape[0] + 1, values.shape[1] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(values, axis=0), axis=1, out=table[1:, 1:])
+    return table
+
+
+def window_sums(table, height, width):
+    # Sum of every height x width window, as an array indexed by top-left corner
+    return (table[height:, width:] - table[:-height, width:]
+            - table[height:, :-width] + table[:-height, :-width])
+
+
+def box_filter(values, radius):
+    # Mean over a (2r+1)^2 neighbourhood via the integral image, edge-clamped
+    padded = np.pad(values, radius, mode='edge')
+    size = 2 * radius + 1
+    return window_sums(integral(padded), size, size) / (size * size)
+
+
+def edge_map(gray):
+    edges = np.zeros_like(gray)
+    edges[:, 1:] += np.abs(np.diff(gray, axis=1))
+    edges[1:, :] += np.abs(np.diff(gray, axis=0))
+    return edges
+
+
+def entropy_map(gray, bins=8, radius=4):
+    # Local Shannon entropy of the quantized grey levels around each pixel
+    levels = np.minimum((gray * (bins / 256.0)).astype(np.int32), bins - 1)
+    entropy = np.zeros_like(gray)
+    for level in range(bins):
+        p = box_filter((levels == level).astype(np.float32), radius)
+        entropy -= p * np.log2(np.maximum(p, 1e-12))
+    return entropy
+
+
+def skin_map(rgb):
+    # Skin-tone chroma range in YCbCr, smoothed so single pixels do not count
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    cb = 128 - 0.168736 * r - 0.331264 * g + 0.5 * b
+    cr = 128 + 0.5 * r - 0.418688 * g - 0.081312 * b
+    luma = 0.299 * r + 0.587 * g + 0.114 * b
+    skin = (cb >= 77) & (cb <= 127) & (cr >= 133) & (cr <= 173) & (luma > 40)
+    return box_filter(skin.astype(np.float32), 2)
+
+
+def _normalized(values):
+    peak = values.max()
+    return values / peak if peak > 0 else values
+
+
+def saliency_map(rgb):
+    gray = rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    return (EDGE_WEIGHT * _normalized(edge_map(gray))
+            + ENTROPY_WEIGHT * _normalized(entropy_map(gray))
+            + SKIN_WEIGHT * _normalized(skin_map(rgb)))
+
+
+def connected_region(mask, y, x):
+    # The True positions of mask 4-connected to (y, x), grown a step at a time
+    region = np.zeros_like(mask)
+    region[y, x] = True
+    while True:
+        grown = region.copy()
+        grown[1:, :] |= region[:-1, :]
+        grown[:-1, :] |= region[1:, :]
+        grown[:, 1:] |= region[:, :-1]
+        grown[:, :-1] |= region[:, 1:]
+        grown &= mask
+        if np.array_equal(grown, region):
+            return region
+        region = grown
+
+
+def best_window(saliency, aspect):
+    # Scores every position of each window size in one vectorized pass per
+    # size. Returns (x, y, width, height) in proxy pixels.
+    height, width = saliency.shape
+    table = integral(saliency)
+    total = table[-1, -1] or 1.0
+
+    if width / height > aspect:
+        max_w, max_h = height * aspect, height
+    else:
+        max_w, max_h = width, width / aspect
+
+    best = None
+    for scale in SCALES:
+        w = max(1, min(width, round(max_w * scale)))
+        h = max(1, min(height, round(max_h * scale)))
+        sums = window_sums(table, h, w)
+        peak_y, peak_x = np.unravel_index(sums.argmax(), sums.shape)
+        peak = sums[peak_y, peak_x]
+        # Near-ties usually mean the subject fits anywhere in a range of
+        # positions; take the middle of that range to centre it. Only the
+        # range around the peak counts: with two subjects the ties form two
+        # ranges, and the middle of both would frame neither.
+        ys, xs = np.nonzero(connected_region(sums >= peak * 0.99, peak_y, peak_x))
+        y, x = round(ys.mean()), round(xs.mean())
+        score = peak / total + TIGHTNESS * (1 - (w * h) / (width * height))
+        if best is None or score > best[0]:
+            best = (score, int(x), int(y), w, h)
+    return best[1:]
+
+
+def smart_crop(source, aspect=None):
+    # Crop box in full-resolution pixels for the given width/height ratio,
+    # or the image's own ratio when aspect is None.
+    rgb, (full_width, full_height) = load_proxy(source)
+    if aspect is None:
+        aspect = full_width / full_height
+    x, y, w, h = best_window(saliency_map(rgb), aspect)
+
+    scale_x = full_width / rgb.shape[1]
+    scale_y = full_height / rgb.shape[0]
+    box_width = min(full_width, round(w * scale_x))
+    box_height = round(box_width / aspect)
+    if box_height > full_height:
+        box_height = full_height
+        box_width = min(full_width, round(box_height * aspect))
+    return {
+        'x': min(round(x * scale_x), full_width - box_width),
+        'y': min(round(y * scale_y), full_height - box_height),
+        'width': box_width,
+        'height': box_height,
+    }
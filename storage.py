@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+
+
+def content_key(sha256, ext):
+    # Two levels of 256 shard directories keep each directory small even
+    # with millions of originals: ab/cd/abcd...ef.jpg
+    return f"{sha256[:2]}/{sha256[2:4]}/{sha256}{ext}"
+
+
+def preview_key(original_key, level):
+    # Previews sit next to their original: ab/cd/abcd...ef_800.jpg
+    return f"{os.path.splitext(original_key)[0]}_{level}.jpg"
+
+
+class StorageBackend:
+    # Where stored files live. Keys are relative, '/'-separated paths.
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def put_file(self, key, src_path):
+        # Moves a finished local file into place under `key`. Readers must
+        # never see a partially written file.
+        raise NotImplementedError
+
+    def put_stream(self, key, fileobj):
+        fd, tmp_path = tempfile.mkstemp(dir=self.temp_dir(), suffix='.part')
+        with os.fdopen(fd, 'wb') as out:
+            shutil.copyfileobj(fileobj, out)
+        self.put_file(key, tmp_path)
+
+    def open(self, key):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def local_path(self, key):
+        # Filesystem path for `key` if the backend has one, else None
+        return None
+
+    def temp_dir(self):
+        # Directory for spooling uploads before put_file()
+        return tempfile.gettempdir()
+
+
+class LocalBackend(StorageBackend):
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(self.temp_dir(), exist_ok=True)
+
+    def _path(self, key):
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ValueError(f'Invalid storage key: {key}')
+        return path
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def put_file(self, key, src_path):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.replace(src_path, path)
+        except OSError:
+            # Different filesystem: copy next to the target, then rename
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+            with os.fdopen(fd, 'wb') as out, open(src_path, 'rb') as src:
+                shutil.copyfileobj(src, out)
+            os.replace(tmp_path, path)
+            os.remove(src_path)
+
+    def open(self, key):
+        return open(self._path(key), 'rb')
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def local_path(self, key):
+        return self._path(key)
+
+    def temp_dir(self):
+        # Inside the root so put_file() is a same-filesystem rename
+        return os.path.join(self.root, 'tmp')
+
+
+BACKENDS = {
+    'local': LocalBackend,
+}
+
+
+def make_backend(name, **options):
+    try:
+        backend_class = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f'Unknown storage backend: {name}')
+    return backend_class(**options)
@@ -0,0 +1,141 @@
+import hashlib
+import os
+import tempfile
+from collections import namedtuple
+
+
+CHUNK_SIZE = 64 * 1024
+
+# Leading bytes of the formats we accept
+SIGNATURES = (
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'GIF87a', 'GIF'),
+    (b'GIF89a', 'GIF'),
+)
+
+EXTENSIONS = {
+    'JPEG': '.jpg',
+    'PNG': '.png',
+    'GIF': '.gif',
+}
+
+FORMATS_BY_EXTENSION = {ext: fmt for fmt, ext in EXTENSIONS.items()}
+
+SpooledUpload = namedtuple('SpooledUpload', ['path', 'sha256', 'format', 'size'])
+
+
+class UploadError(ValueError):
+    pass
+
+
+class UploadTooLarge(UploadError):
+    pass
+
+
+def sniff_format(head):
+    for signature, fmt in SIGNATURES:
+        if head.startswith(signature):
+            return fmt
+    return None
+
+
+def spool_upload(stream, directory, max_bytes, chunk_size=CHUNK_SIZE):
+    # Copies the upload to a temp file in `directory` in fixed-size chunks,
+    # hashing and sniffing the format in the same pass. Only one chunk is
+    # ever held in memory. The caller moves or removes the returned path.
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    digest = hashlib.sha256()
+    head = b''
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f'Upload is larger than {max_bytes} bytes')
+                if len(head) < 16:
+                    head += chunk[:16 - len(head)]
+                digest.update(chunk)
+                out.write(chunk)
+
+        fmt = sniff_format(head)
+        if not fmt:
+            raise UploadError('File is not a JPEG, PNG or GIF image')
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    return SpooledUpload(tmp_path, digest.hexdigest(), fmt, size)
+
+
+# Resumable uploads: the client sends numbered chunks of a fixed size (the
+# last may be shorter) in any order, each to its own file, then the chunks
+# are read back in order through spool_upload() like a single-shot upload.
+
+def chunk_count(size, chunk_size):
+    return max(1, -(-size // chunk_size))
+
+
+def chunk_length(index, size, chunk_size):
+    # Bytes chunk `index` must hold
+    return min(chunk_size, size - index * chunk_size)
+
+
+def write_chunk(directory, index, stream, length, chunk_size=CHUNK_SIZE):
+    # Writes one chunk to directory/<index>. Written under a temp name and
+    # renamed, so a chunk cut off part way is never seen as received and a
+    # repeated chunk simply replaces the earlier copy.
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                data = stream.read(chunk_size)
+                if not data:
+                    break
+                size += len(data)
+                if size > length:
+                    break
+                out.write(data)
+        if size != length:
+            raise UploadError(f'Chunk {index} should be {length} bytes')
+        os.replace(tmp_path, os.path.join(directory, str(index)))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def received_chunks(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(int(name) for name in os.listdir(directory) if name.isdigit())
+
+
+class ChunkReader:
+    # Minimal read() over the chunk files in order, for spool_upload()
+
+    def __init__(self, directory, count):
+        self.paths = [os.path.join(directory, str(index)) for index in range(count)]
+        self.current = None
+
+    def read(self, size=-1):
+        while True:
+            if self.current is None:
+                if not self.paths:
+                    return b''
+                self.current = open(self.paths.pop(0), 'rb')
+            data = self.current.read(size)
+            if data:
+                return data
+            self.current.close()
+            self.current = None
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None